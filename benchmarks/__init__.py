@@ -0,0 +1,22 @@
+"""
+Benchmarks of `capone`'s posting and query APIs.
+
+The benchmarks run against the Postgres database configured for the test
+suite, in a test database of their own, which is seeded with
+`--transactions` Transactions between random Ledgers with random Orders as
+evidence.  Seeding writes them with `COPY` through
+`capone.synthetic.generate_dataset`; with `--keepdb` the test database is
+kept, and only topped up to `--transactions`, so a large dataset need only
+be seeded once.
+
+From the root of the repository:
+
+    POSTGRES_HOST=localhost python -m benchmarks \\
+        --transactions 100000 --keepdb --output after.json
+
+Each benchmark is timed `--repetitions` times and reported with the number
+of queries it makes.  Save the results of two commits with `--output` and
+compare them with:
+
+    python -m benchmarks --compare before.json after.json
+"""
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import django
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'capone.tests.settings')
+    django.setup()
+
+    if sys.argv[1:2] == ['load']:
+        from benchmarks.load import main
+        sys.exit(main(sys.argv[2:]))
+
+    from benchmarks.suite import main
+    sys.exit(main())
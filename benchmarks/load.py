@@ -0,0 +1,338 @@
+"""
+A load test of concurrent postings, run by `python -m benchmarks load`.
+
+Workers, each with a connection of its own, post random Transactions at the
+same time for `--duration` seconds.  A `--hot-fraction` of the entries are
+in a few `--hot-ledgers`, whose locks the workers contend for, and the rest
+are spread over the other Ledgers; all the postings draw their evidence
+from a shared pool of `--evidence` Orders, so that they also update the
+same LedgerBalances.  Workers are threads, or processes with `--processes`.
+
+From the root of the repository:
+
+    POSTGRES_HOST=localhost python -m benchmarks load \\
+        --workers 16 --hot-ledgers 2 --hot-fraction 0.5 --duration 30
+
+The report has the throughput of the postings, percentiles of their
+latency and of the time they waited for the locks on their Ledgers, and
+the retries and failures by cause.  Measuring the time spent waiting for
+locks costs each posting a round trip of its own; see
+`capone.instrumentation`.  Afterwards, the LedgerBalances are checked
+against the LedgerEntries, and the command fails if any of them is wrong or
+any Transaction doesn't balance.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.db import connection
+from django.db import connections
+from django.utils import timezone
+
+from benchmarks.suite import benchmark_database
+from benchmarks.suite import Dataset
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.signals import posting_measured
+from capone.signals import posting_retried
+from capone.utils import find_unbalanced_transactions
+from capone.utils import verify_ledger_balances
+
+
+PERCENTILES = [50, 90, 99]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks load',
+        description='Load test concurrent capone postings.')
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='the number of workers posting at the same time')
+    parser.add_argument(
+        '--processes', action='store_true',
+        help='run the workers in processes instead of threads')
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='the number of seconds to post for')
+    parser.add_argument(
+        '--ledgers', type=int, default=100,
+        help='the number of Ledgers to post to')
+    parser.add_argument(
+        '--hot-ledgers', type=int, default=2,
+        help='the number of Ledgers that are posted to most')
+    parser.add_argument(
+        '--hot-fraction', type=float, default=0.5,
+        help='the fraction of entries in the hot Ledgers')
+    parser.add_argument(
+        '--evidence', type=int, default=100,
+        help='the number of Orders the postings share as evidence')
+    parser.add_argument(
+        '--entries', type=int, default=2,
+        help='the number of entries in each Transaction')
+    parser.add_argument(
+        '--void-fraction', type=float, default=0.1,
+        help='the fraction of postings that void an earlier Transaction')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the seed of the random postings')
+    parser.add_argument(
+        '--keepdb', action='store_true',
+        help='keep the test database for the next run')
+    parser.add_argument(
+        '--output', help='save the report as JSON to this file')
+    args = parser.parse_args(argv)
+    if not 0 < args.hot_ledgers < args.ledgers:
+        parser.error('--hot-ledgers must be between 0 and --ledgers')
+    if args.entries < 2 or args.entries % 2:
+        parser.error('--entries must be an even number of at least 2')
+    return args
+
+
+class WorkerStats(object):
+    """
+    What one worker measured.
+    """
+    def __init__(self):
+        self.postings = 0
+        self.voids = 0
+        self.latencies = []
+        self.lock_waits = []
+        self.retries = Counter()
+        self.failures = Counter()
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+_local = threading.local()
+
+
+def record_measurement(sender, durations, **kwargs):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.lock_waits.append(durations.get('lock', 0))
+
+
+def record_retry(sender, exception, **kwargs):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.retries[_cause(exception)] += 1
+
+
+def _cause(exception):
+    """
+    Name the cause of `exception`: its Postgres error, if it has one.
+    """
+    pgerror = getattr(exception.__cause__, 'pgerror', None)
+    if pgerror:
+        return pgerror.split('\n', 1)[0].replace('ERROR:', '').strip()
+    return type(exception).__name__
+
+
+class LoadMix(object):
+    """
+    Random postings over hot and cold Ledgers and shared evidence.
+    """
+    def __init__(self, rng, dataset, args):
+        self.rng = rng
+        self.user = dataset.user
+        self.type = dataset.type
+        self.hot = dataset.ledgers[:args.hot_ledgers]
+        self.cold = dataset.ledgers[args.hot_ledgers:]
+        self.evidence = dataset.orders[:args.evidence]
+        self.entries = args.entries
+        self.hot_fraction = args.hot_fraction
+
+    def ledger(self):
+        return self.rng.choice(
+            self.hot if self.rng.random() < self.hot_fraction
+            else self.cold)
+
+    def posting(self):
+        amounts = [
+            Decimal(self.rng.randint(1, 100000)) / 100
+            for _ in range(self.entries // 2)
+        ]
+        return dict(
+            user=self.user,
+            evidence=[self.rng.choice(self.evidence)],
+            ledger_entries=[
+                (self.ledger(), debit(amount)) for amount in amounts
+            ] + [
+                (self.ledger(), credit(amount)) for amount in amounts
+            ],
+            type=self.type,
+            posted_timestamp=timezone.now(),
+        )
+
+
+def work(mix, deadline, void_fraction):
+    """
+    Post from `mix` until `deadline` and return the `WorkerStats`.
+    """
+    stats = _local.stats = WorkerStats()
+    posted = []
+    try:
+        while time.perf_counter() < deadline:
+            voiding = posted and mix.rng.random() < void_fraction
+            started = time.perf_counter()
+            try:
+                if voiding:
+                    void_transaction(
+                        posted.pop(mix.rng.randrange(len(posted))),
+                        mix.user)
+                else:
+                    posted.append(create_transaction(**mix.posting()))
+            except Exception as e:
+                stats.failures[_cause(e)] += 1
+                continue
+            stats.latencies.append(time.perf_counter() - started)
+            stats.postings += 1
+            stats.voids += bool(voiding)
+    finally:
+        _local.stats = None
+        connection.close()
+    return stats
+
+
+def _process_worker(arguments):
+    mix, deadline, void_fraction = arguments
+    return work(mix, deadline, void_fraction).as_dict()
+
+
+def run_workers(dataset, args):
+    """
+    Run `args.workers` workers and return the stats of each as a dict.
+    """
+    mixes = [
+        LoadMix(random.Random('{}-{}'.format(args.seed, i)), dataset, args)
+        for i in range(args.workers)
+    ]
+    # Each process must open a connection of its own.
+    connections.close_all()
+    deadline = time.perf_counter() + args.duration
+
+    if args.processes:
+        with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+            return pool.map(_process_worker, [
+                (mix, deadline, args.void_fraction) for mix in mixes])
+
+    results = [None] * args.workers
+
+    def thread_worker(i):
+        results[i] = work(mixes[i], deadline, args.void_fraction).as_dict()
+
+    threads = [
+        threading.Thread(target=thread_worker, args=(i,))
+        for i in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentiles(values):
+    """
+    Return the `PERCENTILES` and the maximum of `values`, in milliseconds.
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    summary = {
+        'p{}'.format(p): values[min(len(values) * p // 100, len(values) - 1)]
+        * 1000
+        for p in PERCENTILES
+    }
+    summary['max'] = values[-1] * 1000
+    return summary
+
+
+def summarize(results, elapsed):
+    postings = sum(result['postings'] for result in results)
+    retries = Counter()
+    failures = Counter()
+    for result in results:
+        retries.update(result['retries'])
+        failures.update(result['failures'])
+    return {
+        'postings': postings,
+        'voids': sum(result['voids'] for result in results),
+        'seconds': elapsed,
+        'throughput': postings / elapsed,
+        'latency_ms': percentiles(
+            [t for result in results for t in result['latencies']]),
+        'lock_wait_ms': percentiles(
+            [t for result in results for t in result['lock_waits']]),
+        'retries': dict(retries),
+        'failures': dict(failures),
+    }
+
+
+def print_summary(summary):
+    def line(name, milliseconds):
+        print('{:<12} {}'.format(name, ' '.join(
+            '{} {:.2f}ms'.format(key, value)
+            for key, value in milliseconds.items())))
+
+    print('{} postings ({} voids) in {:.1f}s: {:.1f}/s'.format(
+        summary['postings'], summary['voids'], summary['seconds'],
+        summary['throughput']))
+    line('latency', summary['latency_ms'])
+    line('lock wait', summary['lock_wait_ms'])
+    for name in ['retries', 'failures']:
+        print('{:<12} {}'.format(name, sum(summary[name].values())))
+        for cause, count in sorted(summary[name].items()):
+            print('  {:>8}  {}'.format(count, cause))
+    for name in ['drifted_balances', 'unbalanced_transactions']:
+        print('{:<24} {}'.format(name.replace('_', ' '), summary[name]))
+
+
+def run(args):
+    with benchmark_database(args.keepdb):
+        dataset = Dataset(random.Random(args.seed), args.ledgers)
+        dataset.add_evidence(max(args.evidence - len(dataset.orders), 0))
+
+        posting_measured.connect(record_measurement)
+        posting_retried.connect(record_retry)
+        try:
+            started = time.perf_counter()
+            results = run_workers(dataset, args)
+            summary = summarize(results, time.perf_counter() - started)
+        finally:
+            posting_measured.disconnect(record_measurement)
+            posting_retried.disconnect(record_retry)
+
+        drift = verify_ledger_balances()
+        unbalanced = find_unbalanced_transactions()
+        summary['drifted_balances'] = len(drift)
+        summary['unbalanced_transactions'] = len(unbalanced)
+        for row in drift:
+            print('Drifted: {}'.format(row), file=sys.stderr)
+        for transaction_id, total in unbalanced:
+            print('Unbalanced: Transaction {} totals {}'.format(
+                transaction_id, total), file=sys.stderr)
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    summary = run(args)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(
+                dict(summary, arguments=vars(args)),
+                output, indent=2, sort_keys=True)
+    return 1 if summary['drifted_balances'] or summary[
+        'unbalanced_transactions'] else 0
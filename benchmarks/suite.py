@@ -0,0 +1,373 @@
+"""
+The benchmarks run by `python -m benchmarks`.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+
+import django
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_databases
+from django.test.utils import teardown_databases
+from django.utils import timezone
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.api.queries import get_balances_for_object
+from capone.api.queries import get_balances_for_objects
+from capone.columnar import entry_columns
+from capone.columnar import validate_columns
+from capone.synthetic import generate_dataset
+from capone.synthetic import synthetic_ledgers
+from capone.models import get_or_create_manual_transaction_type
+from capone.models import MatchType
+from capone.models import Transaction
+from capone.tests.factories import CreditCardTransactionFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+from capone.tests.models import CreditCardTransaction
+from capone.tests.models import Order
+from capone.utils import rebuild_ledger_balances
+
+
+# Benchmarks whose median time grows by more than this are flagged when
+# comparing results.
+SLOWER_THRESHOLD = 1.1
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark capone.')
+    parser.add_argument(
+        '--transactions', type=int, default=10000,
+        help='the number of Transactions to seed the database with')
+    parser.add_argument(
+        '--ledgers', type=int, default=20,
+        help='the number of Ledgers to post to')
+    parser.add_argument(
+        '--repetitions', type=int, default=20,
+        help='the number of times to run each benchmark')
+    parser.add_argument(
+        '--keepdb', action='store_true',
+        help='keep the seeded test database for the next run')
+    parser.add_argument(
+        '--filter', default='',
+        help='only run benchmarks whose names contain this')
+    parser.add_argument(
+        '--output', help='save the results as JSON to this file')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='compare two saved results instead of running benchmarks')
+    return parser.parse_args(argv)
+
+
+class Dataset(object):
+    """
+    The seeded objects that benchmarks draw from.
+    """
+    def __init__(self, rng, ledgers):
+        self.rng = rng
+        # A kept database already has the objects of earlier runs, so the
+        # factories' sequences continue after them.
+        UserFactory.reset_sequence(get_user_model().objects.count())
+        OrderFactory.reset_sequence(Order.objects.count())
+
+        self.user = UserFactory()
+        self.type = get_or_create_manual_transaction_type()
+        self.ledgers = synthetic_ledgers(ledgers)
+        self.orders = list(Order.objects.all())
+        self.cards = list(CreditCardTransaction.objects.all())
+
+    def add_evidence(self, count):
+        self.orders.extend(Order.objects.bulk_create(
+            OrderFactory.build_batch(count)))
+        self.cards.extend(CreditCardTransaction.objects.bulk_create(
+            CreditCardTransactionFactory.build_batch(count // 2)))
+
+    def evidence(self, count):
+        """
+        Return `count` different random evidence objects, mostly Orders.
+        """
+        evidence = []
+        while len(evidence) < count:
+            obj = self.rng.choice(
+                self.cards if self.rng.random() < 0.2 else self.orders)
+            if obj not in evidence:
+                evidence.append(obj)
+        return evidence
+
+    def posting(self, entries=2, evidence=1):
+        """
+        Return the arguments of a random balanced `create_transaction`.
+        """
+        amounts = [
+            Decimal(self.rng.randint(1, 100000)) / 100
+            for _ in range(entries // 2)
+        ]
+        ledger_entries = [
+            (self.rng.choice(self.ledgers), debit(amount))
+            for amount in amounts
+        ] + [
+            (self.rng.choice(self.ledgers), credit(amount))
+            for amount in amounts
+        ]
+        return dict(
+            user=self.user,
+            evidence=self.evidence(evidence),
+            ledger_entries=ledger_entries,
+            type=self.type,
+            posted_timestamp=timezone.now(),
+        )
+
+
+def seed(dataset, transactions):
+    """
+    Generate random Transactions until there are `transactions` of them.
+
+    They are written with `COPY` by `generate_dataset`, in the dataset's
+    Ledgers and with its Orders as evidence.
+    """
+    missing = transactions - Transaction.objects.count()
+    if missing <= 0:
+        return
+    # Each Order is evidence for about ten Transactions.
+    dataset.add_evidence(max(missing // 10, 10))
+
+    started = time.perf_counter()
+
+    def progress(counts):
+        print('Seeded {} of {} Transactions ({:.0f}/s)'.format(
+            counts.transactions, missing,
+            counts.transactions / (time.perf_counter() - started)),
+            file=sys.stderr)
+
+    generate_dataset(
+        missing,
+        dataset.user,
+        ContentType.objects.get_for_model(Order),
+        dataset.type,
+        seed=dataset.rng.randrange(2 ** 32),
+        ledgers=len(dataset.ledgers),
+        evidence=max(order.id for order in dataset.orders),
+        progress=progress,
+    )
+
+
+def columns(dataset, entries):
+    """
+    Return columns of `entries` entries of balanced two-entry postings.
+    """
+    rng = np.random.RandomState(dataset.rng.randrange(2 ** 32))
+    amounts = rng.randint(1, 10 ** 8, size=entries // 2)
+    return (
+        np.arange(entries) // 2,
+        rng.choice([ledger.id for ledger in dataset.ledgers], size=entries),
+        np.stack([amounts, -amounts], axis=1).ravel(),
+    )
+
+
+def benchmarks(dataset):
+    """
+    Yield `(name, setup, run)` for each benchmark.
+
+    `setup` is called, untimed, before each repetition, and its result is
+    passed to `run`, which is timed.
+    """
+    for entries, evidence in [(2, 1), (10, 1), (2, 5), (50, 10)]:
+        yield (
+            'create_transaction[entries={},evidence={}]'.format(
+                entries, evidence),
+            lambda entries=entries, evidence=evidence: dataset.posting(
+                entries, evidence),
+            lambda posting: create_transaction(**posting),
+        )
+
+    yield (
+        'void_transaction',
+        lambda: create_transaction(**dataset.posting(entries=4, evidence=2)),
+        lambda transaction: void_transaction(transaction, dataset.user),
+    )
+
+    for match_type in MatchType:
+        yield (
+            'filter_by_related_objects[{}]'.format(match_type.name),
+            lambda: dataset.evidence(2),
+            lambda evidence, match_type=match_type: (
+                Transaction.objects
+                .filter_by_related_objects(evidence, match_type=match_type)
+                .count()
+            ),
+        )
+
+    yield (
+        'get_balances_for_object',
+        lambda: dataset.rng.choice(dataset.orders),
+        get_balances_for_object,
+    )
+    yield (
+        'get_balances_for_objects[100]',
+        lambda: dataset.rng.sample(dataset.orders, 100),
+        get_balances_for_objects,
+    )
+    yield (
+        'validate_columns[entries=1000000]',
+        lambda: columns(dataset, 1000000),
+        lambda columns: validate_columns(*columns),
+    )
+    yield (
+        'entry_columns',
+        lambda: None,
+        lambda _: entry_columns(),
+    )
+    yield (
+        'rebuild_ledger_balances',
+        lambda: None,
+        lambda _: rebuild_ledger_balances(),
+    )
+
+
+def run_benchmark(setup, run, repetitions):
+    """
+    Time `repetitions` calls of `run` and count the queries of one more.
+    """
+    times = []
+    for _ in range(repetitions):
+        argument = setup()
+        started = time.perf_counter()
+        run(argument)
+        times.append(time.perf_counter() - started)
+
+    argument = setup()
+    with CaptureQueriesContext(connection) as queries:
+        run(argument)
+
+    return {
+        'repetitions': repetitions,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+        'queries': len(queries),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def benchmark_database(keepdb):
+    """
+    Run the block in a test database, which is kept if `keepdb` is true.
+    """
+    # Don't keep every query in memory while timing.
+    settings.DEBUG = False
+    old_config = setup_databases(
+        verbosity=0, interactive=False, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0, keepdb=keepdb)
+
+
+def run(args):
+    with benchmark_database(args.keepdb):
+        dataset = Dataset(random.Random(0), args.ledgers)
+        seed(dataset, args.transactions)
+        results = {}
+        for name, setup, function in benchmarks(dataset):
+            if args.filter not in name:
+                continue
+            results[name] = run_benchmark(
+                setup,
+                function,
+                1 if name == 'rebuild_ledger_balances'
+                else args.repetitions,
+            )
+            print_result(name, results[name])
+        transactions = Transaction.objects.count()
+
+    return {
+        'commit': git_commit(),
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'transactions': transactions,
+        'results': results,
+    }
+
+
+def print_result(name, result):
+    print('{:<45} {:>10.3f}ms median {:>10.3f}ms min {:>5} queries'.format(
+        name, result['median'] * 1000, result['min'] * 1000,
+        result['queries']))
+
+
+def compare(before_path, after_path):
+    """
+    Print the change in each benchmark's median time and query count.
+
+    Return whether any benchmark got slower or makes more queries.
+    """
+    with open(before_path) as before_file:
+        before = json.load(before_file)
+    with open(after_path) as after_file:
+        after = json.load(after_file)
+
+    print('{} ({} Transactions) -> {} ({} Transactions)'.format(
+        before['commit'], before['transactions'],
+        after['commit'], after['transactions']))
+    regressed = False
+    for name, result in sorted(after['results'].items()):
+        if name not in before['results']:
+            print('{:<45} new'.format(name))
+            continue
+        old = before['results'][name]
+        ratio = result['median'] / old['median']
+        flag = ''
+        if ratio > SLOWER_THRESHOLD or result['queries'] > old['queries']:
+            flag = '  <-- regression'
+            regressed = True
+        print('{:<45} {:>10.3f}ms -> {:>10.3f}ms ({:.2f}x), '
+              '{} -> {} queries{}'.format(
+                  name, old['median'] * 1000, result['median'] * 1000,
+                  ratio, old['queries'], result['queries'], flag))
+    return regressed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        return 1 if compare(*args.compare) else 0
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
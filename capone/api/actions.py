@@ -1,22 +1,92 @@
+import random
+import time
+from collections import namedtuple
 from datetime import datetime
 from functools import partial
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import F
+from django.db import connection
+from django.db import DatabaseError
+from django.db import OperationalError
+from django.db.models import prefetch_related_objects
 from django.db.transaction import atomic
+from django.utils import timezone
+from psycopg2 import errorcodes
 
 from capone.api.queries import validate_transaction
+from capone.cache import get_ledger
+from capone.cache import invalidate_balances_on_commit
+from capone.exceptions import IdempotencyKeyReusedException
 from capone.exceptions import UnvoidableTransactionException
+from capone.instrumentation import add_duration
+from capone.instrumentation import add_rows
+from capone.instrumentation import is_measuring
+from capone.instrumentation import measure_posting
+from capone.instrumentation import phase
 from capone.models import get_or_create_manual_transaction_type
-from capone.models import Ledger
-from capone.models import LedgerBalance
 from capone.models import LedgerEntry
 from capone.models import Transaction
-from capone.models import TransactionRelatedObject
+from capone.signals import posting_retried
+from capone.utils import LOCK_LEDGERS_SQL
+
+
+RETRIABLE_ERROR_CODES = {
+    errorcodes.SERIALIZATION_FAILURE,
+    errorcodes.DEADLOCK_DETECTED,
+    errorcodes.LOCK_NOT_AVAILABLE,
+}
+
+
+def _run_with_retry(function, *args, **kwargs):
+    """
+    Call `function` in an atomic block, retrying it if it hits a conflict.
+
+    A conflict is a deadlock, serialization failure, or lock timeout.  It is
+    only retried if this atomic block is the outermost one: inside a
+    caller's atomic block the whole database transaction has to be rolled
+    back, which only the caller can do.  There are up to
+    `CAPONE_POSTING_RETRIES` retries (default 3), after sleeping for a random
+    time of up to `CAPONE_POSTING_RETRY_BACKOFF` seconds (default 0.05),
+    doubled for each further retry.  `posting_retried` is sent before each
+    retry.
+    """
+    if connection.in_atomic_block:
+        with atomic():
+            result = function(*args, **kwargs)
+            committing = time.perf_counter()
+        add_duration('commit', time.perf_counter() - committing)
+        return result
+
+    retries = getattr(settings, 'CAPONE_POSTING_RETRIES', 3)
+    backoff = getattr(settings, 'CAPONE_POSTING_RETRY_BACKOFF', 0.05)
+    attempt = 1
+    while True:
+        try:
+            with atomic():
+                result = function(*args, **kwargs)
+                committing = time.perf_counter()
+            add_duration('commit', time.perf_counter() - committing)
+            return result
+        except OperationalError as e:
+            if (
+                attempt > retries
+                or getattr(e.__cause__, 'pgcode', None)
+                not in RETRIABLE_ERROR_CODES
+            ):
+                raise
+            delay = random.uniform(0, backoff * 2 ** (attempt - 1))
+            posting_retried.send(
+                sender=Transaction,
+                function=function,
+                attempt=attempt,
+                exception=e,
+                delay=delay,
+            )
+            time.sleep(delay)
+            attempt += 1
 
 
-@atomic
 def void_transaction(
     transaction,
     user,
@@ -34,52 +104,76 @@ def void_transaction(
 
     If the posted_timestamp or type is not given, they will be the same
     as the voided Transaction.
+
+    This function is atomic and is retried on conflicts: see
+    `_run_with_retry`.
     """
-    try:
-        transaction.voided_by
-    except Transaction.DoesNotExist:
-        # Because OneToOne fields throw an exception instead of returning
-        # None!
-        pass
-    else:
-        raise UnvoidableTransactionException(
-            "Cannot void the same Transaction #({id}) more than once."
-            .format(id=transaction.transaction_id))
+    with measure_posting(void_transaction):
+        voiding_transaction = _run_with_retry(
+            _void_transaction,
+            transaction,
+            user,
+            notes,
+            type,
+            posted_timestamp,
+        )
+    # Only link the Transactions once the voiding Transaction is written, so
+    # that a retried attempt doesn't find `transaction.voided_by` set.
+    voiding_transaction.voids = transaction
+    transaction.is_voided = True
+    return voiding_transaction
 
-    evidence = [
-        tro.related_object for tro in transaction.related_objects.all()
-    ]
 
-    ledger_entries = [
-        LedgerEntry(
-            ledger=ledger_entry.ledger,
-            amount=-ledger_entry.amount,
-        )
-        for ledger_entry in transaction.entries.all()
-    ]
+def _void_transaction(transaction, user, notes, type, posted_timestamp):
+    with phase('prepare'):
+        try:
+            transaction.voided_by
+        except Transaction.DoesNotExist:
+            # Because OneToOne fields throw an exception instead of returning
+            # None!
+            pass
+        else:
+            raise UnvoidableTransactionException(
+                "Cannot void the same Transaction #({id}) more than once."
+                .format(id=transaction.transaction_id))
 
-    if notes is None:
-        notes = 'Voiding transaction {}'.format(transaction)
+        # The voiding Transaction only needs the keys of the evidence and the
+        # Ledger ids of the entries, so neither is resolved to an object.
+        # Whatever the caller already prefetched, e.g. with
+        # `Transaction.objects.with_entries().with_evidence()`, is reused.
+        prefetch_related_objects([transaction], 'entries', 'related_objects')
 
-    if posted_timestamp is None:
-        posted_timestamp = transaction.posted_timestamp
+        evidence_keys = [
+            (tro.related_object_content_type_id, tro.related_object_id)
+            for tro in transaction.related_objects.all()
+        ]
 
-    if type is None:
-        type = transaction.type
+        ledger_entries = [
+            LedgerEntry(
+                ledger_id=ledger_entry.ledger_id,
+                amount=-ledger_entry.amount,
+            )
+            for ledger_entry in transaction.entries.all()
+        ]
 
-    voiding_transaction = create_transaction(
-        evidence=evidence,
-        ledger_entries=ledger_entries,
-        notes=notes,
-        posted_timestamp=posted_timestamp,
-        type=type,
-        user=user,
-    )
+        if notes is None:
+            notes = 'Voiding transaction {}'.format(transaction)
 
-    voiding_transaction.voids = transaction
-    voiding_transaction.save()
+        if posted_timestamp is None:
+            posted_timestamp = transaction.posted_timestamp
 
-    return voiding_transaction
+        if type is None:
+            type = transaction.type
+
+    return _create_transaction(
+        user,
+        evidence_keys,
+        ledger_entries,
+        notes,
+        type,
+        posted_timestamp,
+        voids_id=transaction.id,
+    )
 
 
 def _credit_or_debit(amount, reverse):
@@ -106,7 +200,6 @@ credit = partial(_credit_or_debit, reverse=True)
 debit = partial(_credit_or_debit, reverse=False)
 
 
-@atomic
 def create_transaction(
     user,
     evidence=(),
@@ -114,21 +207,131 @@ def create_transaction(
     notes='',
     type=None,
     posted_timestamp=None,
+    idempotency_key=None,
 ):
     """
     Create a Transaction with LedgerEntries and TransactionRelatedObjects.
 
+    `ledger_entries` may be unsaved LedgerEntries or `(ledger, amount)`
+    pairs, where `ledger` is a Ledger or the name or number of one.
+
+    If `idempotency_key` is given and a Transaction with that key has
+    already been created, that Transaction is returned instead and nothing
+    is written, so a posting can safely be repeated, e.g. after a timeout.
+    The LedgerEntries passed in are then left unsaved.  If that Transaction
+    has other entries or evidence, the key was reused for another posting
+    and IdempotencyKeyReusedException is raised.
+
     This function is atomic and validates its input before writing to the DB.
+    It is retried on conflicts: see `_run_with_retry`.
     """
-    # Lock the ledgers to which we are posting to serialize the update
-    # of LedgerBalances.
-    list(
-        Ledger.objects
-        .filter(id__in=(
-            ledger_entry.ledger.id for ledger_entry in ledger_entries))
-        .order_by('id')  # Avoid deadlocks.
-        .select_for_update()
-    )
+    with measure_posting(create_transaction):
+        with phase('prepare'):
+            prepared = _prepare_transaction(
+                user,
+                evidence,
+                ledger_entries,
+                notes,
+                type,
+                posted_timestamp,
+                idempotency_key,
+            )
+        return _run_with_retry(_create_transaction, **prepared)
+
+
+PostingResult = namedtuple('PostingResult', ['transaction', 'exception'])
+
+
+def create_transactions(postings):
+    """
+    Create many Transactions in one database transaction.
+
+    `postings` is a sequence of dicts of keyword arguments to
+    `create_transaction`.  The Ledgers of all of them are locked at once and
+    the whole batch is committed together, so posting a batch costs one
+    commit instead of one per Transaction.
+
+    Return a `PostingResult` for each posting, in order: either the
+    `transaction` created (or found by its `idempotency_key`), or the
+    `exception` that stopped it from being created.  Each posting is written
+    in its own savepoint, so one that fails doesn't affect the others.
+
+    This function is atomic and is retried on conflicts as a whole: see
+    `_run_with_retry`.  Foreign keys are checked as each posting is written
+    rather than at commit; inside a caller's atomic block, this also checks
+    the caller's pending deferred constraints.
+    """
+    with measure_posting(create_transactions):
+        prepared = []
+        with phase('prepare'):
+            for posting in postings:
+                try:
+                    prepared.append(_prepare_transaction(**posting))
+                except Exception as e:
+                    prepared.append(e)
+
+        return _run_with_retry(
+            _create_transactions, prepared, connection.in_atomic_block)
+
+
+def _create_transactions(prepared, nested):
+    with phase('lock'), connection.cursor() as cursor:
+        # The foreign keys are deferred until commit, so without checking
+        # them immediately a posting with, say, a deleted User would only
+        # fail when the whole batch is committed.
+        cursor.execute(
+            CHECK_CONSTRAINTS_SQL + LOCK_LEDGERS_SQL,
+            {'ledger_ids': sorted({
+                ledger_entry.ledger_id
+                for posting in prepared
+                if not isinstance(posting, Exception)
+                for ledger_entry in posting['ledger_entries']
+            })},
+        )
+
+    results = []
+    for posting in prepared:
+        if isinstance(posting, Exception):
+            results.append(PostingResult(None, posting))
+            continue
+        try:
+            with atomic():
+                transaction = _create_transaction(
+                    lock_ledgers=False, **posting)
+        except DatabaseError as e:
+            if getattr(e.__cause__, 'pgcode', None) in RETRIABLE_ERROR_CODES:
+                raise
+            results.append(PostingResult(None, e))
+        except IdempotencyKeyReusedException as e:
+            results.append(PostingResult(None, e))
+        else:
+            results.append(PostingResult(transaction, None))
+
+    if nested:
+        # Leave the caller's database transaction as it was.
+        with connection.cursor() as cursor:
+            cursor.execute(DEFER_CONSTRAINTS_SQL)
+    return results
+
+
+def _prepare_transaction(
+    user,
+    evidence=(),
+    ledger_entries=(),
+    notes='',
+    type=None,
+    posted_timestamp=None,
+    idempotency_key=None,
+):
+    """
+    Validate the arguments of `create_transaction` for `_create_transaction`.
+    """
+    ledger_entries = [
+        ledger_entry if isinstance(ledger_entry, LedgerEntry)
+        else LedgerEntry(
+            ledger=get_ledger(ledger_entry[0]), amount=ledger_entry[1])
+        for ledger_entry in ledger_entries
+    ]
 
     if not posted_timestamp:
         posted_timestamp = datetime.now()
@@ -142,43 +345,288 @@ def create_transaction(
         posted_timestamp,
     )
 
-    transaction = Transaction.objects.create(
-        created_by=user,
+    return {
+        'user': user,
+        'evidence_keys': [
+            (ContentType.objects.get_for_model(related_object).id,
+             related_object.id)
+            for related_object in evidence
+        ],
+        'ledger_entries': ledger_entries,
+        'notes': notes,
+        'type': type,
+        'posted_timestamp': posted_timestamp,
+        'idempotency_key': idempotency_key,
+    }
+
+
+CHECK_CONSTRAINTS_SQL = 'SET CONSTRAINTS ALL IMMEDIATE;\n'
+
+DEFER_CONSTRAINTS_SQL = 'SET CONSTRAINTS ALL DEFERRED;\n'
+
+WRITE_TRANSACTION_SQL = '''\
+WITH
+  new_transaction AS (
+    INSERT INTO
+      capone_transaction (
+        transaction_id,
+        voids_id,
+        is_void,
+        is_voided,
+        notes,
+        idempotency_key,
+        created_by_id,
+        posted_timestamp,
+        created_at,
+        modified_at,
+        type_id)
+    VALUES (
+      %(transaction_id)s,
+      %(voids_id)s,
+      %(is_void)s,
+      false,
+      %(notes)s,
+      %(idempotency_key)s,
+      %(created_by_id)s,
+      %(posted_timestamp)s,
+      %(now)s,
+      %(now)s,
+      %(type_id)s)
+    -- A Transaction with this key was already posted: write nothing else.
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING id),
+  entry AS (
+    SELECT *
+    FROM
+      unnest(
+        %(entry_ids)s::uuid[],
+        %(entry_ledger_ids)s::integer[],
+        %(amounts)s::numeric[]
+      ) AS entry (entry_id, ledger_id, amount)),
+  new_entries AS (
+    INSERT INTO
+      capone_ledgerentry (
+        transaction_id,
+        ledger_id,
+        entry_id,
+        amount,
+        posted_timestamp,
+        created_at,
+        modified_at)
+    SELECT
+      new_transaction.id,
+      entry.ledger_id,
+      entry.entry_id,
+      entry.amount,
+      %(posted_timestamp)s,
+      %(now)s,
+      %(now)s
+    FROM
+      new_transaction, entry
+    RETURNING transaction_id, entry_id, id),
+  evidence AS (
+    SELECT *
+    FROM
+      unnest(
+        %(content_type_ids)s::integer[],
+        %(object_ids)s::integer[]
+      ) AS evidence (content_type_id, object_id)),
+  new_related_objects AS (
+    INSERT INTO
+      capone_transactionrelatedobject (
+        transaction_id,
+        related_object_content_type_id,
+        related_object_id,
+        created_at,
+        modified_at)
+    SELECT
+      new_transaction.id,
+      evidence.content_type_id,
+      evidence.object_id,
+      %(now)s,
+      %(now)s
+    FROM
+      new_transaction, evidence),
+  new_balances AS (
+    INSERT INTO
+      capone_ledgerbalance (
+        ledger_id,
+        related_object_content_type_id,
+        related_object_id,
+        balance,
+        created_at,
+        modified_at)
+    SELECT
+      entry.ledger_id,
+      evidence.content_type_id,
+      evidence.object_id,
+      SUM(entry.amount),
+      %(now)s,
+      %(now)s
+    FROM
+      new_transaction, entry, evidence
+    GROUP BY
+      entry.ledger_id,
+      evidence.content_type_id,
+      evidence.object_id
+    ON CONFLICT (ledger_id, related_object_content_type_id, related_object_id)
+    DO UPDATE SET
+      balance = capone_ledgerbalance.balance + EXCLUDED.balance,
+      modified_at = EXCLUDED.modified_at),
+  voided AS (
+    UPDATE capone_transaction
+    SET is_voided = true
+    FROM new_transaction
+    WHERE capone_transaction.id = %(voids_id)s)
+SELECT transaction_id, entry_id, id FROM new_entries;
+'''
+
+
+def _db_value(instance, field_name):
+    field = instance._meta.get_field(field_name)
+    return field.get_db_prep_save(getattr(instance, field.attname), connection)
+
+
+def _create_transaction(
+    user,
+    evidence_keys,
+    ledger_entries,
+    notes,
+    type,
+    posted_timestamp,
+    voids_id=None,
+    idempotency_key=None,
+    lock_ledgers=True,
+):
+    """
+    Write a Transaction that has already been validated in one round trip.
+
+    Unless `lock_ledgers` is false because the caller already holds the
+    locks, the Ledgers of `ledger_entries` are locked in the same round
+    trip.
+
+    `evidence_keys` are the `(content_type_id, object_id)` pairs of its
+    evidence.  If `voids_id` is given, the new Transaction voids the
+    Transaction with that id.  If a Transaction with `idempotency_key` was
+    already posted, nothing is written and that Transaction is returned,
+    after checking that it is the same posting.
+
+    Unlike `Transaction.save`, this doesn't call `full_clean` and doesn't
+    send `pre_save` or `post_save`: `create_transaction` has already
+    validated everything that `full_clean` would, and the database checks
+    the foreign keys.
+    """
+    now = timezone.now()
+    transaction = Transaction(
+        voids_id=voids_id,
+        is_void=voids_id is not None,
         notes=notes,
+        idempotency_key=idempotency_key,
+        created_by=user,
         posted_timestamp=posted_timestamp,
         type=type or get_or_create_manual_transaction_type(),
+        created_at=now,
+        modified_at=now,
     )
-
     for ledger_entry in ledger_entries:
         ledger_entry.transaction = transaction
-        for related_object in evidence:
-            content_type = ContentType.objects.get_for_model(related_object)
-            num_updated = (
-                LedgerBalance.objects
-                .filter(
-                    ledger=ledger_entry.ledger,
-                    related_object_content_type=content_type,
-                    related_object_id=related_object.id)
-                .update(balance=F('balance') + ledger_entry.amount)
+        ledger_entry.posted_timestamp = posted_timestamp
+        ledger_entry.created_at = now
+        ledger_entry.modified_at = now
+
+    params = {
+        'ledger_ids': sorted({
+            ledger_entry.ledger_id for ledger_entry in ledger_entries}),
+        'transaction_id': transaction.transaction_id,
+        'voids_id': transaction.voids_id,
+        'is_void': transaction.is_void,
+        'notes': notes,
+        'idempotency_key': idempotency_key,
+        'created_by_id': transaction.created_by_id,
+        'posted_timestamp': _db_value(transaction, 'posted_timestamp'),
+        'now': _db_value(transaction, 'created_at'),
+        'type_id': transaction.type_id,
+        'entry_ids': [
+            ledger_entry.entry_id for ledger_entry in ledger_entries],
+        'entry_ledger_ids': [
+            ledger_entry.ledger_id for ledger_entry in ledger_entries],
+        'amounts': [
+            _db_value(ledger_entry, 'amount')
+            for ledger_entry in ledger_entries
+        ],
+        'content_type_ids': [key[0] for key in evidence_keys],
+        'object_ids': [key[1] for key in evidence_keys],
+    }
+    with connection.cursor() as cursor:
+        if lock_ledgers and is_measuring():
+            # Lock separately so that the time spent waiting is measured.
+            with phase('lock'):
+                cursor.execute(LOCK_LEDGERS_SQL, params)
+            lock_ledgers = False
+        with phase('write'):
+            cursor.execute(
+                LOCK_LEDGERS_SQL + WRITE_TRANSACTION_SQL if lock_ledgers
+                else WRITE_TRANSACTION_SQL,
+                params,
             )
-            assert num_updated <= 1
-            if num_updated == 0:
-                # The first use of this evidence model in a ledger transaction.
-                LedgerBalance.objects.create(
-                    ledger=ledger_entry.ledger,
-                    related_object_content_type=content_type,
-                    related_object_id=related_object.id,
-                    balance=ledger_entry.amount)
-
-    LedgerEntry.objects.bulk_create(ledger_entries)
-
-    transaction_related_objects = [
-        TransactionRelatedObject(
-            related_object=piece,
-            transaction=transaction,
+            rows = cursor.fetchall()
+
+    if not rows:
+        transaction = (
+            Transaction.objects
+            .using(connection.alias)
+            .prefetch_related('entries', 'related_objects')
+            .get(idempotency_key=idempotency_key)
         )
-        for piece in evidence
-    ]
-    TransactionRelatedObject.objects.bulk_create(transaction_related_objects)
+        _check_repeated_posting(transaction, ledger_entries, evidence_keys)
+        return transaction
+
+    transaction.id = rows[0][0]
+    transaction._state.adding = False
+    transaction._state.db = connection.alias
+    entry_pks = {entry_id: pk for transaction_id, entry_id, pk in rows}
+    for ledger_entry in ledger_entries:
+        ledger_entry.id = entry_pks[ledger_entry.entry_id]
+        ledger_entry.transaction_id = transaction.id
+        ledger_entry._state.adding = False
+        ledger_entry._state.db = connection.alias
+
+    ledger_ids = {ledger_entry.ledger_id for ledger_entry in ledger_entries}
+    # The Transaction, entries, evidence, LedgerBalances, and voided
+    # Transaction.
+    add_rows(
+        1
+        + len(ledger_entries)
+        + len(evidence_keys)
+        + len(ledger_ids) * len(set(evidence_keys))
+        + (voids_id is not None)
+    )
+    invalidate_balances_on_commit(ledger_ids, evidence_keys)
 
     return transaction
+
+
+def _check_repeated_posting(transaction, ledger_entries, evidence_keys):
+    """
+    Check that a repeated posting matches the `transaction` it repeats.
+
+    Raise IdempotencyKeyReusedException if `transaction` doesn't have the
+    same Ledgers and amounts as `ledger_entries` or the same evidence as
+    `evidence_keys`.
+    """
+    def entries(ledger_entries):
+        return sorted(
+            (ledger_entry.ledger_id, ledger_entry.amount)
+            for ledger_entry in ledger_entries
+        )
+
+    if (
+        entries(transaction.entries.all()) != entries(ledger_entries)
+        or {
+            (tro.related_object_content_type_id, tro.related_object_id)
+            for tro in transaction.related_objects.all()
+        } != set(evidence_keys)
+    ):
+        raise IdempotencyKeyReusedException(
+            "Transaction {} with idempotency key {!r} has other entries or "
+            "evidence.".format(transaction, transaction.idempotency_key))
@@ -0,0 +1,96 @@
+"""
+Coroutine versions of the `capone` API for ASGI applications.
+
+The Django ORM and psycopg2 are synchronous, so these run the synchronous
+API with `asgiref.sync.sync_to_async`; they need Django 3.0 or later.
+Postings and balance reads run in `sync_to_async`'s pool of worker threads
+rather than in the one thread that Django uses for database access from
+async code, so that concurrent calls don't wait for each other.  Each
+worker thread has its own database connection, so there can be as many
+connections as workers; like a request's, a connection is closed after
+each call unless `CONN_MAX_AGE` keeps it open.  Calls therefore can't take
+part in a database transaction of the caller's.
+
+`aledger_statement` reads its chunks from one server-side cursor, so it
+runs in Django's database thread, which runs one call at a time.  To
+serve many concurrent balance reads, batch them:
+`aget_balances_for_objects` reads the balances of any number of evidence
+models with one query.  To post from many coroutines at a high rate,
+submit the postings to a `capone.api.ingestion.PostingQueue` and await
+`asyncio.wrap_future(postings.submit(...))`, which commits them in
+batches.
+"""
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from capone.api.actions import create_transaction
+from capone.api.actions import void_transaction
+from capone.api.queries import get_balances_for_objects
+from capone.api.queries import ledger_statement
+
+
+def _in_worker_thread(function):
+    """
+    Return a coroutine function that calls `function` in a worker thread.
+    """
+    def call(*args, **kwargs):
+        close_old_connections()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(call, thread_sensitive=False)
+
+
+async def acreate_transaction(*args, **kwargs):
+    """
+    Coroutine version of `create_transaction`.
+    """
+    return await _in_worker_thread(create_transaction)(*args, **kwargs)
+
+
+async def avoid_transaction(*args, **kwargs):
+    """
+    Coroutine version of `void_transaction`.
+    """
+    return await _in_worker_thread(void_transaction)(*args, **kwargs)
+
+
+async def aget_balances_for_objects(objs, using=None):
+    """
+    Coroutine version of `get_balances_for_objects`.
+    """
+    return await _in_worker_thread(get_balances_for_objects)(
+        objs, using=using)
+
+
+async def aledger_statement(
+        ledger, start=None, end=None, after=None, chunk_size=2000,
+        using=None):
+    """
+    Asynchronous iterator version of `ledger_statement`.
+
+    Each chunk of `chunk_size` lines is read in one call to Django's
+    database thread, so other coroutines can run between chunks.
+    """
+    lines = ledger_statement(
+        ledger,
+        start=start,
+        end=end,
+        after=after,
+        chunk_size=chunk_size,
+        using=using,
+    )
+    read_chunk = sync_to_async(lambda: list(islice(lines, chunk_size)))
+    try:
+        while True:
+            chunk = await read_chunk()
+            if not chunk:
+                break
+            for line in chunk:
+                yield line
+    finally:
+        await sync_to_async(lines.close)()
@@ -0,0 +1,131 @@
+"""
+Group commit for high rates of postings.
+
+Committing a database transaction waits for the database to flush its log,
+so posting each Transaction in its own database transaction limits the rate
+of postings to the rate of commits.  A `PostingQueue` collects postings
+submitted from any number of threads and posts them in batches with
+`create_transactions`, so each commit covers many postings.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.db import close_old_connections
+from django.db import connection
+
+from capone.api.actions import create_transactions
+
+
+_STOP = object()
+
+
+class PostingQueue(object):
+    """
+    Post Transactions in batches from a worker thread.
+
+    `submit` takes the keyword arguments of `create_transaction` and returns
+    a `concurrent.futures.Future` for the Transaction.  Once a posting has
+    been submitted, the worker waits up to `max_delay` seconds for more, up
+    to `batch_size` in all, and then posts them together.  A posting that
+    fails, even because of a foreign key, sets the exception on its own
+    Future; if the whole batch fails, e.g. because its Ledgers couldn't be
+    locked, every Future in it gets that exception.
+
+    Use the queue as a context manager, or call `start` and `stop`:
+
+        with PostingQueue() as postings:
+            future = postings.submit(user=user, ledger_entries=[...])
+            transaction = future.result()
+    """
+    def __init__(self, batch_size=500, max_delay=0.005):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self._thread = threading.Thread(
+            target=self._run, name='capone-posting-queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Post everything submitted so far and stop the worker thread.
+
+        Does nothing if the worker thread isn't running.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, **posting):
+        """
+        Queue a posting and return a Future for its Transaction.
+        """
+        future = Future()
+        self._queue.put((posting, future))
+        return future
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping = self._next_batch()
+                self._post(batch)
+        finally:
+            connection.close()
+
+    def _next_batch(self):
+        """
+        Wait for the next batch and return it and whether to stop after it.
+        """
+        item = self._queue.get()
+        deadline = time.time() + self.max_delay
+        batch = []
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                item = self._queue.get(
+                    timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _post(self, batch):
+        batch = [
+            (posting, future) for posting, future in batch
+            if future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+
+        close_old_connections()
+        try:
+            results = create_transactions(
+                [posting for posting, future in batch])
+        except Exception as e:
+            for posting, future in batch:
+                future.set_exception(e)
+        else:
+            for (posting, future), result in zip(batch, results):
+                if result.exception is None:
+                    future.set_result(result.transaction)
+                else:
+                    future.set_exception(result.exception)
@@ -1,19 +1,30 @@
 import operator
 from collections import defaultdict
+from collections import namedtuple
 from decimal import Decimal
 from functools import reduce
 
 from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db import router
+from django.db.models import Count
+from django.db.models import Q
 
+from capone.cache import cached_balances
+from capone.cache import get_ledger
+from capone.cache import object_balances_cache_key
 from capone.exceptions import ExistingLedgerEntriesException
 from capone.exceptions import NoLedgerEntriesException
 from capone.exceptions import TransactionBalanceException
+from capone.models import Ledger
 from capone.models import LedgerBalance
+from capone.models import LedgerEntry
 from capone.models import MatchType
 from capone.models import Transaction
+from capone.models import TransactionRelatedObject
 
 
-def get_balances_for_object(obj):
+def get_balances_for_object(obj, using=None):
     """
     Return a dict from Ledger to Decimal for an evidence model.
 
@@ -24,18 +35,70 @@ def get_balances_for_object(obj):
     The dict is a `defaultdict` which will return Decimal(0)
     when looking up the balance of a ledger for which the model
     has no associated transactions.
+
+    The balances are read from the database with alias `using`, which
+    defaults to the one chosen by the database routers, and cached if
+    `CAPONE_BALANCE_CACHE` is set: see `capone.cache`.
     """
-    balances = defaultdict(lambda: Decimal(0))
-    content_type = ContentType.objects.get_for_model(obj)
-    ledger_balances = (
-        LedgerBalance
-        .objects
-        .filter(
-            related_object_content_type=content_type,
-            related_object_id=obj.id)
-    )
-    for ledger_balance in ledger_balances:
-        balances[ledger_balance.ledger] = ledger_balance.balance
+    return _get_balances([obj], using)[0]
+
+
+def get_balances_for_objects(objs, using=None):
+    """
+    Return a dict from each evidence model in `objs` to its balances.
+
+    The balances of each model are the same as `get_balances_for_object`
+    returns, but those of all of `objs` are read with a single query, or
+    from the cache with a single lookup.  The models must be saved, since
+    they are the dict's keys.
+    """
+    return dict(zip(objs, _get_balances(objs, using)))
+
+
+def _get_balances(objs, using):
+    """
+    Return the balances of each evidence model in `objs`, in order.
+    """
+    if not objs:
+        return []
+
+    using = using or router.db_for_read(LedgerBalance)
+
+    content_types = ContentType.objects.get_for_models(
+        *[type(obj) for obj in objs])
+    keys = [
+        object_balances_cache_key(content_types[type(obj)].id, obj.id)
+        for obj in objs
+    ]
+
+    def get_ledger_balances(missing_keys):
+        ledger_balances = {key: [] for key in missing_keys}
+        missing_ids = defaultdict(list)
+        for obj, key in zip(objs, keys):
+            if key in ledger_balances:
+                missing_ids[content_types[type(obj)]].append(obj.id)
+        query = reduce(operator.or_, [
+            Q(related_object_content_type=content_type,
+              related_object_id__in=ids)
+            for content_type, ids in missing_ids.items()
+        ])
+        for ledger_balance in (
+            LedgerBalance.objects.using(using)
+            .filter(query)
+            .select_related('ledger')
+        ):
+            ledger_balances[object_balances_cache_key(
+                ledger_balance.related_object_content_type_id,
+                ledger_balance.related_object_id,
+            )].append((ledger_balance.ledger, ledger_balance.balance))
+        return ledger_balances
+
+    cached = cached_balances(
+        list(set(keys)), get_ledger_balances, using=using)
+    balances = []
+    for key in keys:
+        balances.append(defaultdict(lambda: Decimal(0)))
+        balances[-1].update(cached[key])
     return balances
 
 
@@ -74,6 +137,30 @@ def validate_transaction(
             raise ExistingLedgerEntriesException("LedgerEntry already exists.")
 
 
+def get_transactions_by_idempotency_key(idempotency_keys, using=None):
+    """
+    Return a dict from idempotency key to the Transaction posted with it.
+
+    Keys that haven't been used are left out, so a batch of postings can be
+    deduplicated with this single query before creating the rest.  To
+    deduplicate postings, read from the default database rather than a
+    replica that may not have caught up.
+    """
+    return {
+        transaction.idempotency_key: transaction
+        for transaction in Transaction.objects.using(using).filter(
+            idempotency_key__in=idempotency_keys)
+    }
+
+
+TRANSACTION_FIELD_NAMES = [
+    ('notes', 'notes'),
+    ('posted_timestamp', 'posted_timestamp'),
+    ('type', 'type'),
+    ('user', 'created_by'),
+]
+
+
 def assert_transaction_in_ledgers_for_amounts_with_evidence(
         ledger_amount_pairs,
         evidence,
@@ -82,42 +169,393 @@ def assert_transaction_in_ledgers_for_amounts_with_evidence(
     """
     Assert there is exactly one transaction with given entries and evidence.
 
-    The entries are specified as a list of (ledger name, amount) pairs.
+    The entries are specified as a list of (ledger, amount) pairs, where
+    `ledger` is a Ledger or the name or number of one.
 
     If kwargs are given, they are interpreted as values for fields on
     `Transaction`, and it is asserted that the one and only matching
     `Transaction` has these values as well.
     """
-    transactions_in_all_ledgers = reduce(
-        operator.and_,
-        (Transaction.objects.filter(ledgers__name=ledger)
-         for ledger, _ in ledger_amount_pairs),
+    try:
+        ledgers = [get_ledger(ledger) for ledger, _ in ledger_amount_pairs]
+    except Ledger.DoesNotExist:
+        raise Transaction.DoesNotExist(
+            "No Ledger named in {}.".format(ledger_amount_pairs))
+
+    ledger_ids = {ledger.id for ledger in ledgers}
+    transactions_in_all_ledgers = (
+        LedgerEntry.objects
+        .filter(ledger_id__in=ledger_ids)
+        .values('transaction_id')
+        .annotate(ledgers=Count('ledger_id', distinct=True))
+        .filter(ledgers=len(ledger_ids))
+        .values('transaction_id')
     )
     matching_transaction = (
         Transaction
         .objects
         .filter(id__in=transactions_in_all_ledgers)
         .filter_by_related_objects(evidence, match_type=MatchType.EXACT)
+        .with_evidence()
         .get()
     )
 
     matching_pairs = sorted(
-        matching_transaction.entries.values_list('ledger__name', 'amount')
+        matching_transaction.entries.values_list('ledger_id', 'amount')
+    )
+    assert matching_pairs == sorted(
+        (ledger.id, amount)
+        for ledger, (_, amount) in zip(ledgers, ledger_amount_pairs)
     )
-    assert matching_pairs == sorted(ledger_amount_pairs)
 
     related = {o.related_object
                for o in matching_transaction.related_objects.all()}
     assert related == set(evidence)
 
-    TRANSACTION_FIELD_NAMES = [
-        ('notes', 'notes'),
-        ('posted_timestamp', 'posted_timestamp'),
-        ('type', 'type'),
-        ('user', 'created_by'),
-    ]
-
     for arg_name, transaction_name in TRANSACTION_FIELD_NAMES:
         if kwargs.get(arg_name):
             field = getattr(matching_transaction, transaction_name)
             assert field == kwargs[arg_name]
+
+
+def assert_transactions_exist(expectations):
+    """
+    Assert many `assert_transaction_in_ledgers_for_amounts_with_evidence`s.
+
+    Each expectation is a dict of the keyword arguments to
+    `assert_transaction_in_ledgers_for_amounts_with_evidence`:
+    `ledger_amount_pairs`, `evidence`, and optionally `notes`,
+    `posted_timestamp`, `type`, and `user`.  As with that function, each
+    expectation must be met by exactly one Transaction, and Ledgers can be
+    given as Ledgers or their names or numbers.
+
+    Instead of querying for each expectation, all candidate Transactions,
+    their entries, and their evidence are fetched with a few set-based
+    queries and matched in memory.  If any expectations aren't met, a single
+    AssertionError describing all of them is raised.
+    """
+    expectations = list(expectations)
+    if not expectations:
+        return
+
+    evidence_models = {
+        type(obj)
+        for expectation in expectations
+        for obj in expectation['evidence']
+    }
+    content_types = ContentType.objects.get_for_models(*evidence_models)
+
+    def evidence_key(evidence):
+        return frozenset(
+            (content_types[type(obj)].id, obj.pk) for obj in evidence)
+
+    ids_by_content_type = defaultdict(set)
+    for expectation in expectations:
+        for obj in expectation['evidence']:
+            ids_by_content_type[content_types[type(obj)].id].add(obj.pk)
+    has_evidence = reduce(
+        operator.or_,
+        [
+            Q(
+                related_objects__related_object_content_type_id=(
+                    content_type_id),
+                related_objects__related_object_id__in=ids,
+            )
+            for content_type_id, ids in ids_by_content_type.items()
+        ],
+        Q(related_objects__isnull=True),
+    )
+    ledgers = {}
+    for expectation in expectations:
+        for ledger, _ in expectation['ledger_amount_pairs']:
+            if ledger not in ledgers:
+                try:
+                    ledgers[ledger] = get_ledger(ledger).id
+                except Ledger.DoesNotExist:
+                    ledgers[ledger] = None
+    # The entries of each expectation whose Ledgers exist, by index, as
+    # sorted `(ledger_id, amount)` pairs.
+    expected_entries = {
+        index: sorted(
+            (ledgers[ledger], amount)
+            for ledger, amount in expectation['ledger_amount_pairs']
+        )
+        for index, expectation in enumerate(expectations)
+        if all(
+            ledgers[ledger] is not None
+            for ledger, _ in expectation['ledger_amount_pairs']
+        )
+    }
+    ledger_ids = {
+        ledger_id
+        for pairs in expected_entries.values()
+        for ledger_id, _ in pairs
+    }
+    transactions = {
+        values['id']: values
+        for values in (
+            Transaction.objects
+            .filter(has_evidence, entries__ledger_id__in=ledger_ids)
+            .values(
+                'id',
+                'transaction_id',
+                'notes',
+                'posted_timestamp',
+                'type_id',
+                'created_by_id',
+            )
+            .distinct()
+        )
+    }
+
+    entries = defaultdict(list)
+    for transaction_id, ledger_id, amount in (
+        LedgerEntry.objects
+        .filter(transaction_id__in=transactions)
+        .values_list('transaction_id', 'ledger_id', 'amount')
+    ):
+        entries[transaction_id].append((ledger_id, amount))
+
+    evidence_keys = defaultdict(set)
+    for transaction_id, content_type_id, object_id in (
+        TransactionRelatedObject.objects
+        .filter(transaction_id__in=transactions)
+        .values_list(
+            'transaction_id',
+            'related_object_content_type_id',
+            'related_object_id',
+        )
+    ):
+        evidence_keys[transaction_id].add((content_type_id, object_id))
+    transactions_by_evidence = defaultdict(list)
+    for transaction_id in sorted(transactions):
+        transactions_by_evidence[
+            frozenset(evidence_keys[transaction_id])
+        ].append(transaction_id)
+
+    failures = []
+    for index, expectation in enumerate(expectations):
+        description = "Expectation #{} ({} with evidence {})".format(
+            index,
+            list(expectation['ledger_amount_pairs']),
+            list(expectation['evidence']),
+        )
+        if index not in expected_entries:
+            failures.append("{}: Ledger does not exist".format(description))
+            continue
+
+        expected = expected_entries[index]
+        expected_ledger_ids = {ledger_id for ledger_id, _ in expected}
+        candidates = [
+            transaction_id
+            for transaction_id in transactions_by_evidence[
+                evidence_key(expectation['evidence'])]
+            if expected_ledger_ids <= {
+                ledger_id for ledger_id, _ in entries[transaction_id]}
+        ]
+        if len(candidates) != 1:
+            failures.append("{}: {} matching Transactions".format(
+                description, len(candidates)))
+            continue
+
+        transaction = transactions[candidates[0]]
+        actual_entries = sorted(entries[transaction['id']])
+        if actual_entries != expected:
+            failures.append(
+                "{}: Transaction {} has entries {}".format(
+                    description,
+                    transaction['transaction_id'],
+                    actual_entries,
+                )
+            )
+
+        for arg_name, transaction_name in TRANSACTION_FIELD_NAMES:
+            expected = expectation.get(arg_name)
+            if not expected:
+                continue
+            if arg_name in ('type', 'user'):
+                expected = expected.pk
+                transaction_name += '_id'
+            if transaction[transaction_name] != expected:
+                failures.append(
+                    "{}: Transaction {} has {} {!r}, not {!r}".format(
+                        description,
+                        transaction['transaction_id'],
+                        transaction_name,
+                        transaction[transaction_name],
+                        expected,
+                    )
+                )
+
+    assert not failures, "\n".join(failures)
+
+
+class StatementLine(namedtuple(
+        'StatementLine',
+        ['id', 'transaction_id', 'posted_timestamp', 'amount', 'balance'])):
+    """
+    A single LedgerEntry on a Ledger statement with its running balance.
+    """
+    __slots__ = ()
+
+    @property
+    def continuation_token(self):
+        """
+        The `after` argument to `ledger_statement` to resume after this line.
+        """
+        return (self.posted_timestamp, self.id)
+
+
+LEDGER_STATEMENT_OPENING_BALANCE_SQL = '''\
+SELECT
+  COALESCE(SUM(amount), 0)
+FROM
+  capone_ledgerentry
+WHERE
+  ledger_id = %s
+  AND (posted_timestamp, id) <= (%s, %s)
+'''
+
+LEDGER_STATEMENT_SQL = '''\
+SELECT
+  id,
+  transaction_id,
+  posted_timestamp,
+  amount,
+  %s + SUM(amount) OVER (
+    ORDER BY posted_timestamp, id ROWS UNBOUNDED PRECEDING)
+FROM
+  capone_ledgerentry
+WHERE
+  {where}
+ORDER BY
+  posted_timestamp, id
+'''
+
+
+def ledger_statement(
+        ledger, start=None, end=None, after=None, chunk_size=2000,
+        using=None):
+    """
+    Yield a `StatementLine` for each entry in `ledger` in posting order.
+
+    `ledger` is a Ledger or the name or number of one.
+
+    Entries are ordered by `(posted_timestamp, id)` and restricted to those
+    posted at or after `start` and before `end`.  Each line carries the
+    running balance of the Ledger, which starts from the balance of all
+    entries posted before the first line.
+
+    Instead of `start`, a statement can be resumed with the
+    `continuation_token` of the last line read as `after`: this is keyset
+    pagination, so it costs the same no matter how deep into the Ledger it
+    starts.
+
+    Lines are read `chunk_size` at a time from a server-side cursor, so
+    memory use doesn't depend on the number of entries in the Ledger.  They
+    are read from the database with alias `using`, which defaults to the one
+    chosen by the database routers.
+    """
+    ledger = get_ledger(ledger)
+    connection = connections[using or router.db_for_read(LedgerEntry)]
+    where = ['ledger_id = %s']
+    params = [ledger.id]
+
+    if after is None and start is not None:
+        # All ids are positive, so this is the key just before `start`.
+        after = (start, 0)
+
+    if after is None:
+        opening_balance = Decimal(0)
+    else:
+        where.append('(posted_timestamp, id) > (%s, %s)')
+        params.extend(after)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                LEDGER_STATEMENT_OPENING_BALANCE_SQL,
+                [ledger.id] + list(after),
+            )
+            opening_balance = cursor.fetchone()[0]
+
+    if end is not None:
+        where.append('posted_timestamp < %s')
+        params.append(end)
+
+    cursor = connection.chunked_cursor()
+    try:
+        cursor.execute(
+            LEDGER_STATEMENT_SQL.format(where='\n  AND '.join(where)),
+            [opening_balance] + params,
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield StatementLine(*row)
+    finally:
+        cursor.close()
+
+
+class EvidenceHistoryItem(namedtuple(
+        'EvidenceHistoryItem', ['transaction', 'entries', 'balance_deltas'])):
+    """
+    A Transaction in an evidence object's history.
+
+    `entries` are the Transaction's LedgerEntries, with their Ledgers
+    already loaded, and `balance_deltas` maps each Ledger to the change the
+    Transaction made to the evidence object's balance in that Ledger.
+    """
+    __slots__ = ()
+
+
+EvidenceHistoryPage = namedtuple(
+    'EvidenceHistoryPage', ['items', 'next_cursor'])
+
+
+def evidence_history(obj, after=None, limit=50, using=None):
+    """
+    Return an `EvidenceHistoryPage` of the Transactions with `obj` as evidence.
+
+    Transactions are ordered by `(posted_timestamp, id)` and paginated by
+    keyset: pass the `next_cursor` of a page as `after` to get the next
+    page.  `next_cursor` is None on the last page.
+
+    Each page is built with a constant number of queries, no matter how many
+    Transactions or LedgerEntries are on it or how deep into the history
+    it is.  They are run on the database with alias `using`, which defaults
+    to the one chosen by the database routers.
+    """
+    content_type = ContentType.objects.get_for_model(obj)
+    transactions = Transaction.objects.using(using).filter(
+        related_objects__related_object_content_type=content_type,
+        related_objects__related_object_id=obj.id,
+    )
+    if after is not None:
+        posted_timestamp, transaction_id = after
+        transactions = transactions.filter(
+            Q(posted_timestamp__gt=posted_timestamp)
+            | Q(posted_timestamp=posted_timestamp, id__gt=transaction_id)
+        )
+    transactions = list(
+        transactions
+        .order_by('posted_timestamp', 'id')
+        .with_entries()[:limit + 1]
+    )
+
+    next_cursor = None
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        next_cursor = (
+            transactions[-1].posted_timestamp, transactions[-1].id)
+
+    items = []
+    for transaction in transactions:
+        entries = list(transaction.entries.all())
+        balance_deltas = defaultdict(lambda: Decimal(0))
+        for entry in entries:
+            balance_deltas[entry.ledger] += entry.amount
+        items.append(
+            EvidenceHistoryItem(transaction, entries, balance_deltas))
+
+    return EvidenceHistoryPage(items, next_cursor)
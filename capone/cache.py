@@ -0,0 +1,320 @@
+"""
+Caching of reference data and, optionally, of balance reads.
+
+Ledgers and TransactionTypes change very rarely, so they are always cached
+in each process: see `get_ledger` and `get_or_create_transaction_type`.
+Objects are only added to this cache once the database transaction that
+read them commits, and it is cleared whenever a Ledger or TransactionType is
+saved or deleted or the database is flushed.  Use `clear_reference_cache` if
+these tables are changed by other means.  They are always read from the
+default database, so that a new Ledger can be posted to before it reaches
+any read replicas: see `capone.routers`.  ContentTypes are already cached by
+`ContentType.objects`.
+
+Balance reads are only cached if `CAPONE_BALANCE_CACHE` is set to the alias
+of one of the caches in `CACHES`: then `get_balances_for_object` and
+`Ledger.get_balance` are cached.  The alias should
+be dedicated to `capone` because `rebuild_ledger_balances` clears it.  With a
+cache shared between processes, such as memcached or Redis, invalidations
+are seen by every process; a `LocMemCache` (bounded by its `MAX_ENTRIES`
+option) is private to each process, so it should only be used with a short
+`CAPONE_BALANCE_CACHE_TIMEOUT` when there is more than one process posting.
+
+Cached balances are invalidated when the database transaction that changed
+them commits, so a posting that is rolled back never touches the cache.
+Each cached balance is stored with the generation of its key, read before
+the balance is, and an invalidation replaces the generation, so a balance
+read just before an invalidation and stored just after it is never used.
+Reads made in a database transaction that has uncommitted postings bypass
+the cache in both directions, and balances read from a replica are never
+stored in it, because the replica may not have caught up with postings
+whose invalidations have already happened.
+"""
+import threading
+from copy import copy
+from uuid import uuid4
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import connection
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_migrate
+from django.db.models.signals import post_save
+from django.db.transaction import on_commit
+
+
+# Whether this thread's database transaction has postings whose cached
+# balances will be invalidated when it commits.
+_pending = threading.local()
+# Maps ('ledger', field name, value) and ('transactiontype', 'name', value)
+# to model instances.
+_reference_cache = {}
+# Bumped by every clear so that objects read before a clear aren't cached
+# when the transaction that read them commits after it.
+_reference_cache_generation = [0]
+
+
+def clear_reference_cache(**kwargs):
+    """
+    Forget all cached Ledgers and TransactionTypes.
+    """
+    _reference_cache_generation[0] += 1
+    _reference_cache.clear()
+
+
+def _cache_on_commit(cache_function, *objects):
+    generation = _reference_cache_generation[0]
+
+    def cache_objects():
+        if generation == _reference_cache_generation[0]:
+            for obj in objects:
+                cache_function(obj)
+
+    on_commit(cache_objects)
+
+
+for sender in ('capone.Ledger', 'capone.TransactionType'):
+    post_save.connect(clear_reference_cache, sender=sender)
+    post_delete.connect(clear_reference_cache, sender=sender)
+post_migrate.connect(clear_reference_cache)
+
+
+def _cache_ledger(ledger):
+    for field in ('id', 'name', 'number'):
+        _reference_cache['ledger', field, getattr(ledger, field)] = ledger
+
+
+def _cache_transaction_type(transaction_type):
+    _reference_cache[
+        'transactiontype', 'name', transaction_type.name] = transaction_type
+
+
+def _get_ledger(field, value):
+    try:
+        return copy(_reference_cache['ledger', field, value])
+    except KeyError:
+        ledger = (
+            apps.get_model('capone', 'Ledger').objects
+            .using(DEFAULT_DB_ALIAS)
+            .get(**{field: value})
+        )
+        _cache_on_commit(_cache_ledger, ledger)
+        return ledger
+
+
+def get_ledger(ledger):
+    """
+    Return the Ledger referred to by `ledger`: a Ledger, name, or number.
+
+    A name or number returns a copy of the cached Ledger, so changing it
+    doesn't change the cache.  Raises `Ledger.DoesNotExist` if there is no
+    such Ledger.
+    """
+    if isinstance(ledger, apps.get_model('capone', 'Ledger')):
+        return ledger
+    elif isinstance(ledger, str):
+        return _get_ledger('name', ledger)
+    else:
+        return _get_ledger('number', ledger)
+
+
+def get_ledger_by_id(ledger_id):
+    """
+    Return a copy of the Ledger with primary key `ledger_id`.
+    """
+    return _get_ledger('id', ledger_id)
+
+
+def get_or_create_transaction_type(name):
+    """
+    Return the TransactionType named `name`, creating it if necessary.
+    """
+    try:
+        return copy(_reference_cache['transactiontype', 'name', name])
+    except KeyError:
+        transaction_type = (
+            apps.get_model('capone', 'TransactionType')
+            .objects.db_manager(DEFAULT_DB_ALIAS)
+            .get_or_create(name=name)[0]
+        )
+        _cache_on_commit(_cache_transaction_type, transaction_type)
+        return transaction_type
+
+
+def warm_reference_cache():
+    """
+    Load all Ledgers, TransactionTypes, and ContentTypes into their caches.
+    """
+    _cache_on_commit(
+        _cache_ledger,
+        *apps.get_model('capone', 'Ledger').objects.using(DEFAULT_DB_ALIAS)
+    )
+    _cache_on_commit(
+        _cache_transaction_type,
+        *apps.get_model('capone', 'TransactionType').objects.using(
+            DEFAULT_DB_ALIAS)
+    )
+    ContentType.objects.get_for_models(*apps.get_models())
+
+
+def get_balance_cache():
+    """
+    Return the cache named by `CAPONE_BALANCE_CACHE`, or None if unset.
+    """
+    alias = getattr(settings, 'CAPONE_BALANCE_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def ledger_balance_cache_key(ledger_id):
+    return 'capone:ledger:{}'.format(ledger_id)
+
+
+def object_balances_cache_key(content_type_id, object_id):
+    return 'capone:object:{}:{}'.format(content_type_id, object_id)
+
+
+HAS_WRITTEN_SQL = 'SELECT txid_current_if_assigned() IS NOT NULL;\n'
+
+
+def _generation_key(key):
+    return '{}:generation'.format(key)
+
+
+def _balance_cache_timeout():
+    return getattr(settings, 'CAPONE_BALANCE_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+class _BalanceInvalidation(object):
+    """
+    An `on_commit` callback that invalidates cached balances.
+    """
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.keys = keys
+
+    def __call__(self):
+        self.cache.set_many(
+            {_generation_key(key): uuid4().hex for key in self.keys},
+            _balance_cache_timeout(),
+        )
+        self.cache.delete_many(self.keys)
+        _pending.invalidations = False
+
+
+def _has_pending_invalidations():
+    """
+    Return whether the current database transaction has posted to `capone`.
+
+    `invalidate_balances_on_commit` marks this thread until the transaction
+    commits.  Django can't tell when it is rolled back instead, so the mark
+    is only trusted while the current transaction has written something:
+    a transaction that hasn't can't see any uncommitted postings.  A
+    transaction with other writes, or with postings in a savepoint that was
+    rolled back, may bypass the cache for longer than it needs to.
+    """
+    if getattr(_pending, 'invalidations', False) and (
+        connection.in_atomic_block
+    ):
+        with connection.cursor() as cursor:
+            cursor.execute(HAS_WRITTEN_SQL)
+            if cursor.fetchone()[0]:
+                return True
+    _pending.invalidations = False
+    return False
+
+
+def cached_balance(key, compute, using=DEFAULT_DB_ALIAS):
+    """
+    Return the cached value for `key`, calling `compute` on a cache miss.
+
+    `using` is the alias of the database that `compute` reads from.
+    """
+    return cached_balances(
+        [key], lambda keys: {key: compute()}, using)[key]
+
+
+def cached_balances(keys, compute, using=DEFAULT_DB_ALIAS):
+    """
+    Return a dict from each of `keys` to its cached value.
+
+    `compute` is called with the keys missing from the cache and must return
+    a dict of their values, read from the database with alias `using`.
+    """
+    cache = get_balance_cache()
+    if cache is None or _has_pending_invalidations():
+        return compute(keys)
+
+    cached = cache.get_many(
+        list(keys) + [_generation_key(key) for key in keys])
+    generations = {key: cached.get(_generation_key(key)) for key in keys}
+    values = {
+        key: cached[key][1] for key in keys
+        if key in cached
+        and generations[key] is not None
+        and cached[key][0] == generations[key]
+    }
+    missing = [key for key in keys if key not in values]
+    if missing:
+        store = using == DEFAULT_DB_ALIAS
+        if store:
+            # Start the keys' generations before reading their balances.
+            new = [key for key in missing if generations[key] is None]
+            for key in new:
+                cache.add(
+                    _generation_key(key),
+                    uuid4().hex,
+                    _balance_cache_timeout(),
+                )
+            if new:
+                started = cache.get_many(
+                    [_generation_key(key) for key in new])
+                for key in new:
+                    generations[key] = started.get(_generation_key(key))
+        computed = compute(missing)
+        if store:
+            cache.set_many(
+                {
+                    key: (generations[key], value)
+                    for key, value in computed.items()
+                    if generations[key] is not None
+                },
+                _balance_cache_timeout(),
+            )
+        values.update(computed)
+    return values
+
+
+def invalidate_balances_on_commit(ledger_ids, evidence_keys):
+    """
+    Invalidate cached balances once the current database transaction commits.
+
+    `evidence_keys` are `(content_type_id, object_id)` pairs.
+    """
+    cache = get_balance_cache()
+    if cache is None:
+        return
+
+    keys = [ledger_balance_cache_key(ledger_id) for ledger_id in ledger_ids]
+    keys.extend(
+        object_balances_cache_key(content_type_id, object_id)
+        for content_type_id, object_id in evidence_keys
+    )
+    # Outside of a transaction, the invalidation runs and clears this at
+    # once.
+    _pending.invalidations = True
+    on_commit(_BalanceInvalidation(cache, keys))
+
+
+def clear_balance_cache():
+    """
+    Clear all cached balances once the current database transaction commits.
+    """
+    cache = get_balance_cache()
+    if cache is not None:
+        on_commit(cache.clear)
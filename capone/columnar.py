@@ -0,0 +1,344 @@
+"""
+Columns of postings and balances as NumPy arrays.
+
+`validate_columns` checks millions of entries at once, given as columns:
+the index of each entry's Transaction in the batch, its Ledger's id, and
+its amount in integer minor units.  It finds the same problems as
+`validate_transaction` does one Transaction at a time, with grouped sums
+instead of a Python `sum` of Decimals per Transaction.
+
+`entry_columns`, `balance_columns`, and `balance_matrix` read LedgerEntries
+and LedgerBalances the other way, into arrays for analysis, for instance
+with `pandas.DataFrame(entry_columns())`.  Rows are read in chunks from a
+server-side cursor and converted to integers by the database, so no model
+instances or Decimals are built.
+
+This module requires NumPy, which `capone` itself doesn't: install it with
+`pip install capone[numpy]`.
+"""
+from collections import namedtuple
+from collections import OrderedDict
+from decimal import Decimal
+
+import numpy as np
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db import router
+from django.db.transaction import atomic
+
+from capone.exceptions import NoLedgerEntriesException
+from capone.exceptions import TransactionBalanceException
+from capone.models import Ledger
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.utils import MAX_ID
+
+
+ENTRY_COLUMNS_SQL = '''\
+SELECT
+  capone_ledgerentry.id,
+  capone_ledgerentry.transaction_id,
+  capone_ledgerentry.ledger_id,
+  ROUND(capone_ledgerentry.amount * %(scale)s)::bigint,
+  ROUND(EXTRACT(EPOCH FROM capone_ledgerentry.posted_timestamp) * 1000000)
+    ::bigint
+FROM
+  capone_ledgerentry
+WHERE
+  capone_ledgerentry.transaction_id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_ledgerentry.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_ledgerentry.posted_timestamp < %(until)s)
+  AND (%(ledger_ids)s::integer[] IS NULL
+       OR capone_ledgerentry.ledger_id = ANY(%(ledger_ids)s))
+ORDER BY
+  capone_ledgerentry.id
+'''
+
+BALANCE_COLUMNS_SQL = '''\
+SELECT
+  capone_ledgerbalance.ledger_id,
+  capone_ledgerbalance.related_object_content_type_id,
+  capone_ledgerbalance.related_object_id,
+  ROUND(capone_ledgerbalance.balance * %(scale)s)::bigint
+FROM
+  capone_ledgerbalance
+WHERE
+  (%(ledger_ids)s::integer[] IS NULL
+   OR capone_ledgerbalance.ledger_id = ANY(%(ledger_ids)s))
+  AND (%(content_type_id)s::integer IS NULL
+       OR capone_ledgerbalance.related_object_content_type_id
+         = %(content_type_id)s)
+ORDER BY
+  capone_ledgerbalance.id
+'''
+
+
+# `validate_columns` looks Ledger ids up in a table with a slot for every id
+# up to the largest known one, unless that is more than this many slots per
+# known Ledger.
+LOOKUP_TABLE_SLOTS_PER_LEDGER = 16
+
+
+ColumnValidation = namedtuple('ColumnValidation', [
+    # The indexes of the Transactions that don't balance, and their totals.
+    'unbalanced',
+    'mismatches',
+    # The indexes of the Transactions with no entries.
+    'empty',
+    # The indexes of the Transactions with entries in unknown Ledgers.
+    'unknown_ledgers',
+    # The indexes of all the invalid Transactions.
+    'invalid',
+])
+
+
+def validate_columns(
+    transactions,
+    ledger_ids,
+    amounts,
+    count=None,
+    known_ledger_ids=None,
+):
+    """
+    Check a batch of postings given as columns of their entries.
+
+    `transactions`, `ledger_ids`, and `amounts` are sequences or arrays with
+    an item per entry: the index of its Transaction, from 0 to `count - 1`,
+    its Ledger's id, and its amount in integer minor units, such as
+    ten-thousandths to match LedgerEntry.amount.  The entries needn't be
+    sorted by Transaction, though sorted ones are checked faster.  `count`
+    is the number of Transactions, by default one more than the largest
+    index; Transactions without entries are reported as empty.  Ledger ids
+    are checked against `known_ledger_ids`, by default every Ledger's.
+
+    Returns a ColumnValidation of integer arrays of Transaction indexes,
+    sorted; `column_errors` lists them as exceptions.  Totals are summed
+    exactly in 64-bit integers.
+    """
+    transactions = np.asarray(transactions, dtype=np.int64)
+    ledger_ids = np.asarray(ledger_ids, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=np.int64)
+    if not len(transactions) == len(ledger_ids) == len(amounts):
+        raise ValueError("The columns must have the same length.")
+    if count is None:
+        count = int(transactions.max()) + 1 if transactions.size else 0
+    if transactions.size and (
+        transactions.min() < 0 or transactions.max() >= count
+    ):
+        raise ValueError(
+            "Transaction indexes must be from 0 to {}.".format(count - 1))
+    if known_ledger_ids is None:
+        known_ledger_ids = Ledger.objects.values_list('id', flat=True)
+    known_ledger_ids = np.asarray(list(known_ledger_ids), dtype=np.int64)
+
+    # Look Ledger ids up in a table of the known ones, which is faster than
+    # `np.isin` when ids are small and dense.  Ids outside it are looked up
+    # in its last slot, which is never known.  Sparse ids would make the
+    # table too big, so they are looked up with `np.isin` instead.
+    table_size = int(known_ledger_ids.max(initial=-1)) + 2
+    if table_size <= LOOKUP_TABLE_SLOTS_PER_LEDGER * max(
+        known_ledger_ids.size, 1
+    ):
+        is_known = np.zeros(table_size, dtype=bool)
+        is_known[known_ledger_ids] = True
+        in_table = (ledger_ids >= 0) & (ledger_ids < table_size)
+        known = is_known[np.where(in_table, ledger_ids, -1)]
+    else:
+        known = np.isin(ledger_ids, np.unique(known_ledger_ids))
+    unknown_ledgers = np.unique(transactions[~known])
+
+    if np.any(transactions[1:] < transactions[:-1]):
+        order = np.argsort(transactions)
+        amounts = amounts[order]
+    entry_counts = np.bincount(transactions, minlength=count)
+    present = np.flatnonzero(entry_counts)
+    totals = np.zeros(count, dtype=np.int64)
+    if present.size:
+        # Each Transaction's entries are now a run starting where the
+        # previous Transaction's ended.
+        starts = np.cumsum(entry_counts[present]) - entry_counts[present]
+        totals[present] = np.add.reduceat(amounts, starts)
+
+    unbalanced = np.flatnonzero(totals)
+    empty = np.flatnonzero(entry_counts == 0)
+    return ColumnValidation(
+        unbalanced=unbalanced,
+        mismatches=totals[unbalanced],
+        empty=empty,
+        unknown_ledgers=unknown_ledgers,
+        invalid=np.union1d(np.union1d(unbalanced, empty), unknown_ledgers),
+    )
+
+
+def column_errors(validation, decimal_places=4):
+    """
+    List the problems in `validation` as `(index, exception)` pairs.
+
+    Each invalid Transaction has one exception, like those of
+    `validate_transaction`: Ledger.DoesNotExist if it has entries in unknown
+    Ledgers, or else TransactionBalanceException or
+    NoLedgerEntriesException.  Mis-matches are converted from minor units
+    with `decimal_places`.  The pairs are sorted by index.
+    """
+    errors = {}
+    for index, total in zip(
+        validation.unbalanced.tolist(), validation.mismatches.tolist()
+    ):
+        errors[index] = TransactionBalanceException(
+            "Credits do not equal debits. Mis-match of %s."
+            % Decimal(total).scaleb(-decimal_places))
+    for index in validation.empty.tolist():
+        errors[index] = NoLedgerEntriesException(
+            "Transaction has no entries.")
+    for index in validation.unknown_ledgers.tolist():
+        errors[index] = Ledger.DoesNotExist(
+            "Transaction has entries in unknown Ledgers.")
+    return sorted(errors.items())
+
+
+BalanceMatrix = namedtuple('BalanceMatrix', [
+    'object_ids',
+    'ledger_ids',
+    'balances',
+])
+
+
+# NULLs are read as the smallest int64, which is NaT as a datetime64.
+NULL = np.iinfo(np.int64).min
+
+
+def _to_array(rows):
+    try:
+        return np.array(rows, dtype=np.int64)
+    except TypeError:
+        return np.array(
+            [
+                [NULL if value is None else value for value in row]
+                for row in rows
+            ],
+            dtype=np.int64,
+        )
+
+
+def _read_columns(sql, params, names, chunk_size, using):
+    """
+    Return the int64 columns `names` of the rows of `sql` as arrays.
+    """
+    chunks = [[] for _ in names]
+    with atomic(using=using), connections[using].chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for chunk, column in zip(chunks, _to_array(rows).T):
+                chunk.append(column)
+    return OrderedDict(
+        (name, np.concatenate(chunk) if chunk else np.empty(0, np.int64))
+        for name, chunk in zip(names, chunks)
+    )
+
+
+def _ledger_ids(ledger_ids):
+    return None if ledger_ids is None else [int(id) for id in ledger_ids]
+
+
+def entry_columns(
+    since=None,
+    until=None,
+    first_id=0,
+    last_id=MAX_ID,
+    ledger_ids=None,
+    decimal_places=4,
+    chunk_size=100000,
+    using=None,
+):
+    """
+    Return LedgerEntries as an OrderedDict of NumPy arrays, one per column.
+
+    The columns are the int64 `id`, `transaction_id`, `ledger_id`, and
+    `amount`, in minor units with `decimal_places`, and `posted_timestamp`,
+    as datetime64 microseconds in UTC, or NaT for an entry without one,
+    which only exist before migration `0005`.  The entries are those posted
+    from `since` until `until`, of Transactions with ids from `first_id` to
+    `last_id`, and in `ledger_ids` if it is given, in id order.
+
+    Rows are fetched `chunk_size` at a time from a server-side cursor on the
+    database for reading LedgerEntries, or `using`.
+    """
+    columns = _read_columns(
+        ENTRY_COLUMNS_SQL,
+        {
+            'scale': 10 ** decimal_places,
+            'since': since,
+            'until': until,
+            'first_id': first_id,
+            'last_id': last_id,
+            'ledger_ids': _ledger_ids(ledger_ids),
+        },
+        ['id', 'transaction_id', 'ledger_id', 'amount', 'posted_timestamp'],
+        chunk_size,
+        using or router.db_for_read(LedgerEntry),
+    )
+    columns['posted_timestamp'] = columns['posted_timestamp'].view(
+        'datetime64[us]')
+    return columns
+
+
+def balance_columns(
+    ledger_ids=None,
+    content_type=None,
+    decimal_places=4,
+    chunk_size=100000,
+    using=None,
+):
+    """
+    Return LedgerBalances as an OrderedDict of NumPy arrays, one per column.
+
+    The columns are the int64 `ledger_id`, `content_type_id`, `object_id`,
+    and `balance`, in minor units with `decimal_places`.  The balances are
+    those in `ledger_ids` and of evidence of `content_type`, a model or
+    ContentType, if they are given.
+
+    Rows are fetched `chunk_size` at a time from a server-side cursor on the
+    database for reading LedgerBalances, or `using`.
+    """
+    if content_type is not None and not isinstance(content_type, ContentType):
+        content_type = ContentType.objects.get_for_model(content_type)
+    return _read_columns(
+        BALANCE_COLUMNS_SQL,
+        {
+            'scale': 10 ** decimal_places,
+            'ledger_ids': _ledger_ids(ledger_ids),
+            'content_type_id': content_type and content_type.id,
+        },
+        ['ledger_id', 'content_type_id', 'object_id', 'balance'],
+        chunk_size,
+        using or router.db_for_read(LedgerBalance),
+    )
+
+
+def balance_matrix(content_type, ledger_ids=None, **kwargs):
+    """
+    Return the balances of evidence of `content_type` as a BalanceMatrix.
+
+    `balances` is an int64 array with a row for each evidence object with a
+    balance, in `object_ids`, and a column for each Ledger in `ledger_ids`:
+    those given, or else those with balances.  Both are sorted, and
+    balances that weren't recorded are zero.  The matrix is dense, so limit
+    `ledger_ids` when there are many evidence objects.  Other arguments are
+    passed to `balance_columns`.
+    """
+    columns = balance_columns(ledger_ids, content_type, **kwargs)
+    object_ids, rows = np.unique(columns['object_id'], return_inverse=True)
+    if ledger_ids is None:
+        ledger_ids, cols = np.unique(
+            columns['ledger_id'], return_inverse=True)
+    else:
+        ledger_ids = np.unique(np.asarray(ledger_ids, dtype=np.int64))
+        cols = np.searchsorted(ledger_ids, columns['ledger_id'])
+    balances = np.zeros((len(object_ids), len(ledger_ids)), dtype=np.int64)
+    balances[rows, cols] = columns['balance']
+    return BalanceMatrix(object_ids, ledger_ids, balances)
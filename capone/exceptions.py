@@ -24,3 +24,7 @@ class NoLedgerEntriesException(TransactionException):
 
 class ExistingLedgerEntriesException(TransactionException):
     pass
+
+
+class IdempotencyKeyReusedException(TransactionException):
+    pass
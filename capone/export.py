@@ -0,0 +1,284 @@
+"""
+Bulk export of `capone`'s tables with Postgres `COPY`.
+
+`export_tables` streams Transactions, LedgerEntries,
+TransactionRelatedObjects, and LedgerBalances to files without building
+model instances, so memory use doesn't grow with the number of rows.  All
+the tables are read in one REPEATABLE READ database transaction, so they
+are consistent with each other: an export never has entries without their
+Transaction, or balances that include postings whose entries are missing.
+"""
+from collections import OrderedDict
+
+from django.db import connections
+from django.db import router
+from django.db.transaction import atomic
+from django.db.transaction import TransactionManagementError
+
+from capone.models import LedgerEntry
+from capone.pgcopy import copy_query
+from capone.utils import MAX_ID
+
+
+SET_SNAPSHOT_SQL = '''\
+SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY
+'''
+
+TRANSACTIONS_SQL = '''\
+SELECT
+  capone_transaction.id,
+  capone_transaction.transaction_id,
+  capone_transaction.voids_id,
+  capone_transaction.is_void,
+  capone_transaction.is_voided,
+  capone_transaction.notes,
+  capone_transaction.idempotency_key,
+  capone_transaction.created_by_id,
+  capone_transaction.type_id,
+  capone_transaction.posted_timestamp,
+  capone_transaction.created_at
+FROM
+  capone_transaction
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp < %(until)s)
+ORDER BY
+  capone_transaction.id
+'''
+
+JOINED_TRANSACTIONS_SQL = '''\
+SELECT
+  capone_transaction.id,
+  capone_transaction.transaction_id,
+  capone_transaction.voids_id,
+  capone_transaction.is_void,
+  capone_transaction.is_voided,
+  capone_transaction.notes,
+  capone_transaction.idempotency_key,
+  capone_transaction.created_by_id,
+  capone_transaction.type_id,
+  capone_transactiontype.name AS type_name,
+  capone_transaction.posted_timestamp,
+  capone_transaction.created_at
+FROM
+  capone_transaction
+INNER JOIN
+  capone_transactiontype
+    ON (capone_transaction.type_id = capone_transactiontype.id)
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp < %(until)s)
+ORDER BY
+  capone_transaction.id
+'''
+
+ENTRIES_SQL = '''\
+SELECT
+  capone_ledgerentry.id,
+  capone_ledgerentry.transaction_id,
+  capone_ledgerentry.ledger_id,
+  capone_ledgerentry.entry_id,
+  capone_ledgerentry.amount,
+  capone_ledgerentry.posted_timestamp,
+  capone_ledgerentry.created_at
+FROM
+  capone_ledgerentry
+INNER JOIN
+  capone_transaction
+    ON (capone_ledgerentry.transaction_id = capone_transaction.id)
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp < %(until)s)
+ORDER BY
+  capone_ledgerentry.id
+'''
+
+JOINED_ENTRIES_SQL = '''\
+SELECT
+  capone_ledgerentry.id,
+  capone_ledgerentry.transaction_id,
+  capone_transaction.transaction_id AS transaction_uuid,
+  capone_transaction.is_void,
+  capone_transaction.is_voided,
+  capone_ledgerentry.ledger_id,
+  capone_ledger.name AS ledger_name,
+  capone_ledger.number AS ledger_number,
+  capone_ledgerentry.entry_id,
+  capone_ledgerentry.amount,
+  capone_ledgerentry.posted_timestamp,
+  capone_ledgerentry.created_at
+FROM
+  capone_ledgerentry
+INNER JOIN
+  capone_transaction
+    ON (capone_ledgerentry.transaction_id = capone_transaction.id)
+INNER JOIN
+  capone_ledger
+    ON (capone_ledgerentry.ledger_id = capone_ledger.id)
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp < %(until)s)
+ORDER BY
+  capone_ledgerentry.id
+'''
+
+RELATED_OBJECTS_SQL = '''\
+SELECT
+  capone_transactionrelatedobject.id,
+  capone_transactionrelatedobject.transaction_id,
+  capone_transactionrelatedobject.related_object_content_type_id,
+  capone_transactionrelatedobject.related_object_id
+FROM
+  capone_transactionrelatedobject
+INNER JOIN
+  capone_transaction
+    ON (capone_transactionrelatedobject.transaction_id
+        = capone_transaction.id)
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp < %(until)s)
+ORDER BY
+  capone_transactionrelatedobject.id
+'''
+
+JOINED_RELATED_OBJECTS_SQL = '''\
+SELECT
+  capone_transactionrelatedobject.id,
+  capone_transactionrelatedobject.transaction_id,
+  capone_transactionrelatedobject.related_object_content_type_id,
+  django_content_type.app_label,
+  django_content_type.model,
+  capone_transactionrelatedobject.related_object_id
+FROM
+  capone_transactionrelatedobject
+INNER JOIN
+  capone_transaction
+    ON (capone_transactionrelatedobject.transaction_id
+        = capone_transaction.id)
+INNER JOIN
+  django_content_type
+    ON (capone_transactionrelatedobject.related_object_content_type_id
+        = django_content_type.id)
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (%(since)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp >= %(since)s)
+  AND (%(until)s::timestamptz IS NULL
+       OR capone_transaction.posted_timestamp < %(until)s)
+ORDER BY
+  capone_transactionrelatedobject.id
+'''
+
+# LedgerBalances are the current balances, so they aren't filtered.
+BALANCES_SQL = '''\
+SELECT
+  capone_ledgerbalance.id,
+  capone_ledgerbalance.ledger_id,
+  capone_ledgerbalance.related_object_content_type_id,
+  capone_ledgerbalance.related_object_id,
+  capone_ledgerbalance.balance,
+  capone_ledgerbalance.modified_at
+FROM
+  capone_ledgerbalance
+ORDER BY
+  capone_ledgerbalance.id
+'''
+
+JOINED_BALANCES_SQL = '''\
+SELECT
+  capone_ledgerbalance.id,
+  capone_ledgerbalance.ledger_id,
+  capone_ledger.name AS ledger_name,
+  capone_ledger.number AS ledger_number,
+  capone_ledgerbalance.related_object_content_type_id,
+  django_content_type.app_label,
+  django_content_type.model,
+  capone_ledgerbalance.related_object_id,
+  capone_ledgerbalance.balance,
+  capone_ledgerbalance.modified_at
+FROM
+  capone_ledgerbalance
+INNER JOIN
+  capone_ledger
+    ON (capone_ledgerbalance.ledger_id = capone_ledger.id)
+INNER JOIN
+  django_content_type
+    ON (capone_ledgerbalance.related_object_content_type_id
+        = django_content_type.id)
+ORDER BY
+  capone_ledgerbalance.id
+'''
+
+# Maps each table that can be exported to its plain and joined queries.
+TABLES = OrderedDict([
+    ('transactions', (TRANSACTIONS_SQL, JOINED_TRANSACTIONS_SQL)),
+    ('entries', (ENTRIES_SQL, JOINED_ENTRIES_SQL)),
+    ('related_objects', (RELATED_OBJECTS_SQL, JOINED_RELATED_OBJECTS_SQL)),
+    ('balances', (BALANCES_SQL, JOINED_BALANCES_SQL)),
+])
+
+
+def export_tables(
+    files,
+    format='csv',
+    joined=False,
+    since=None,
+    until=None,
+    first_id=0,
+    last_id=MAX_ID,
+    using=None,
+):
+    """
+    Export `capone`'s tables with COPY and return the rows written of each.
+
+    `files` maps the names of the tables to export, from `TABLES`, to
+    binary files to write them to, in the `format` of `copy_query`.  With
+    `joined`, the rows include the names of their Ledgers, TransactionTypes,
+    and evidence ContentTypes, and entries include their Transaction's UUID
+    and void flags.  Transactions and their entries and evidence are
+    filtered to those posted from `since` until `until`, with ids from
+    `first_id` to `last_id`; balances are all exported.
+
+    Reads from the database for reading LedgerEntries, or `using`.  The
+    tables are read under one snapshot, in a database transaction of their
+    own, so this can't be called in an atomic block.
+    """
+    unknown = set(files) - set(TABLES)
+    if unknown:
+        raise ValueError(
+            'Unknown tables: {}'.format(', '.join(sorted(unknown))))
+    using = using or router.db_for_read(LedgerEntry)
+    if connections[using].in_atomic_block:
+        raise TransactionManagementError(
+            "export_tables can't be called in an atomic block, as it must "
+            "start its own database transaction.")
+
+    params = {
+        'since': since,
+        'until': until,
+        'first_id': first_id,
+        'last_id': last_id,
+    }
+    rows = OrderedDict()
+    with atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(SET_SNAPSHOT_SQL)
+        for table, queries in TABLES.items():
+            if table in files:
+                rows[table] = copy_query(
+                    queries[joined], params, files[table], format, cursor)
+    return rows
@@ -0,0 +1,590 @@
+"""
+Bulk import of historical Transactions with Postgres `COPY`.
+
+`import_transactions` validates postings as it streams through them, and
+for each chunk of `chunk_size` valid postings:
+
+1. skips those whose idempotency keys were already imported;
+2. loads the rest into temporary staging tables with `COPY`;
+3. moves them into `capone`'s tables with one set-based statement, which
+   also adds them to the LedgerBalances unless `merge_balances` is false.
+
+Each chunk is committed on its own, so an import that stops part way can be
+restarted from the beginning: the chunks that were committed are skipped by
+their idempotency keys.  Without `merge_balances`, rebuild the
+LedgerBalances afterwards with `capone_rebuild_balances`, which is faster
+for loading into empty tables.
+
+`import_transactions_parallel` does the same on a pool of processes, which
+import postings on disjoint sets of Ledgers, so that they don't wait for
+each other's locks.
+"""
+import csv
+import multiprocessing
+import os
+import uuid
+from collections import namedtuple
+from decimal import Decimal
+from decimal import InvalidOperation
+from itertools import groupby
+from itertools import islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.db import connections
+from django.db.transaction import atomic
+from django.db.transaction import TransactionManagementError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from capone.cache import get_ledger
+from capone.cache import invalidate_balances_on_commit
+from capone.exceptions import NoLedgerEntriesException
+from capone.exceptions import TransactionBalanceException
+from capone.exceptions import TransactionException
+from capone.models import get_or_create_manual_transaction_type
+from capone.pgcopy import copy_rows
+from capone.utils import LOCK_LEDGERS_SQL
+
+
+EXISTING_KEYS_SQL = '''\
+SELECT idempotency_key
+FROM capone_transaction
+WHERE idempotency_key = ANY(%(keys)s)
+'''
+
+CREATE_STAGING_TABLES_SQL = '''\
+CREATE TEMPORARY TABLE IF NOT EXISTS capone_import_transaction (
+  idempotency_key varchar(255) NOT NULL,
+  transaction_id uuid NOT NULL,
+  notes text NOT NULL,
+  posted_timestamp timestamp with time zone NOT NULL);
+
+CREATE TEMPORARY TABLE IF NOT EXISTS capone_import_entry (
+  idempotency_key varchar(255) NOT NULL,
+  ledger_id integer NOT NULL,
+  entry_id uuid NOT NULL,
+  amount numeric(24, 4) NOT NULL);
+
+CREATE TEMPORARY TABLE IF NOT EXISTS capone_import_evidence (
+  idempotency_key varchar(255) NOT NULL,
+  content_type_id integer NOT NULL,
+  object_id integer NOT NULL);
+
+TRUNCATE
+  capone_import_transaction, capone_import_entry, capone_import_evidence;
+'''
+
+MOVE_STAGED_TRANSACTIONS_SQL = '''\
+WITH
+  new_transactions AS (
+    INSERT INTO
+      capone_transaction (
+        transaction_id,
+        voids_id,
+        is_void,
+        is_voided,
+        notes,
+        idempotency_key,
+        created_by_id,
+        posted_timestamp,
+        created_at,
+        modified_at,
+        type_id)
+    SELECT
+      transaction_id,
+      NULL,
+      false,
+      false,
+      notes,
+      idempotency_key,
+      %(created_by_id)s,
+      posted_timestamp,
+      %(now)s,
+      %(now)s,
+      %(type_id)s
+    FROM
+      capone_import_transaction
+    -- Imported since this chunk checked for it: skip it.
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING id, idempotency_key, posted_timestamp),
+  new_entries AS (
+    INSERT INTO
+      capone_ledgerentry (
+        transaction_id,
+        ledger_id,
+        entry_id,
+        amount,
+        posted_timestamp,
+        created_at,
+        modified_at)
+    SELECT
+      new_transactions.id,
+      capone_import_entry.ledger_id,
+      capone_import_entry.entry_id,
+      capone_import_entry.amount,
+      new_transactions.posted_timestamp,
+      %(now)s,
+      %(now)s
+    FROM
+      new_transactions
+    INNER JOIN
+      capone_import_entry
+        ON (capone_import_entry.idempotency_key
+            = new_transactions.idempotency_key)
+    RETURNING transaction_id, ledger_id, amount),
+  new_related_objects AS (
+    INSERT INTO
+      capone_transactionrelatedobject (
+        transaction_id,
+        related_object_content_type_id,
+        related_object_id,
+        created_at,
+        modified_at)
+    SELECT
+      new_transactions.id,
+      capone_import_evidence.content_type_id,
+      capone_import_evidence.object_id,
+      %(now)s,
+      %(now)s
+    FROM
+      new_transactions
+    INNER JOIN
+      capone_import_evidence
+        ON (capone_import_evidence.idempotency_key
+            = new_transactions.idempotency_key)
+    RETURNING
+      transaction_id, related_object_content_type_id, related_object_id),
+  new_balances AS (
+    INSERT INTO
+      capone_ledgerbalance (
+        ledger_id,
+        related_object_content_type_id,
+        related_object_id,
+        balance,
+        created_at,
+        modified_at)
+    SELECT
+      new_entries.ledger_id,
+      new_related_objects.related_object_content_type_id,
+      new_related_objects.related_object_id,
+      SUM(new_entries.amount),
+      %(now)s,
+      %(now)s
+    FROM
+      new_entries
+    INNER JOIN
+      new_related_objects
+        ON (new_related_objects.transaction_id = new_entries.transaction_id)
+    WHERE
+      %(merge_balances)s
+    GROUP BY
+      new_entries.ledger_id,
+      new_related_objects.related_object_content_type_id,
+      new_related_objects.related_object_id
+    ON CONFLICT (ledger_id, related_object_content_type_id, related_object_id)
+    DO UPDATE SET
+      balance = capone_ledgerbalance.balance + EXCLUDED.balance,
+      modified_at = EXCLUDED.modified_at
+    RETURNING 1)
+SELECT
+  (SELECT COUNT(*) FROM new_transactions),
+  (SELECT COUNT(*) FROM new_entries),
+  (SELECT COUNT(*) FROM new_related_objects)
+'''
+
+
+ImportResult = namedtuple('ImportResult', [
+    'imported',
+    'skipped',
+    'entries',
+    'related_objects',
+    'errors',
+])
+
+
+_StagedPosting = namedtuple('_StagedPosting', [
+    'idempotency_key',
+    'posted_timestamp',
+    'notes',
+    'entries',
+    'evidence_keys',
+])
+
+
+def _evidence_key(evidence):
+    """
+    Return the `(content_type_id, object_id)` of a piece of evidence.
+
+    `evidence` is a model instance or a `(content_type, object_id)` pair,
+    where `content_type` is a ContentType, its id, or `'app_label.model'`.
+    """
+    if not isinstance(evidence, tuple):
+        return (ContentType.objects.get_for_model(evidence).id, evidence.pk)
+    content_type, object_id = evidence
+    if isinstance(content_type, str):
+        if '.' not in content_type:
+            raise ValueError(
+                "Evidence type {!r} isn't of the form 'app_label.model'."
+                .format(content_type))
+        content_type = ContentType.objects.get_by_natural_key(
+            *content_type.split('.', 1))
+    elif not isinstance(content_type, ContentType):
+        # Check the id here rather than fail the chunk on the foreign key.
+        content_type = ContentType.objects.get_for_id(content_type)
+    return (content_type.id, int(object_id))
+
+
+def _prepare(posting, keys):
+    """
+    Validate `posting` and return it as a `_StagedPosting`.
+
+    `keys` are the idempotency keys of the chunk so far.
+    """
+    key = posting.get('idempotency_key')
+    if not key:
+        raise ValueError("Posting has no idempotency_key.")
+    if key in keys:
+        raise ValueError(
+            "Idempotency key {!r} is used twice in a chunk.".format(key))
+
+    entries = [
+        (get_ledger(ledger).id, Decimal(amount))
+        for ledger, amount in posting.get('ledger_entries', ())
+    ]
+    total = sum(amount for _, amount in entries)
+    if total != Decimal(0):
+        raise TransactionBalanceException(
+            "Credits do not equal debits. Mis-match of %s." % total)
+    if not entries:
+        raise NoLedgerEntriesException("Transaction has no entries.")
+
+    posted_timestamp = posting.get('posted_timestamp') or timezone.now()
+    if timezone.is_naive(posted_timestamp):
+        # COPY would read a naive timestamp in the connection's time zone,
+        # which is UTC with `USE_TZ`; read it in the current time zone like
+        # `create_transaction` does.
+        posted_timestamp = timezone.make_aware(posted_timestamp)
+
+    return _StagedPosting(
+        key,
+        posted_timestamp,
+        posting.get('notes') or '',
+        entries,
+        sorted({
+            _evidence_key(evidence)
+            for evidence in posting.get('evidence', ())
+        }),
+    )
+
+
+def _import_chunk(chunk, user, type, merge_balances):
+    """
+    Import the `_StagedPosting`s `chunk` and return the counts.
+    """
+    with atomic(), connection.cursor() as cursor:
+        cursor.execute(EXISTING_KEYS_SQL, {
+            'keys': [posting.idempotency_key for posting in chunk]})
+        existing = {row[0] for row in cursor.fetchall()}
+        new = [
+            posting for posting in chunk
+            if posting.idempotency_key not in existing
+        ]
+        if not new:
+            return 0, 0, 0
+
+        cursor.execute(CREATE_STAGING_TABLES_SQL)
+        copy_rows(
+            'capone_import_transaction',
+            ['idempotency_key', 'transaction_id', 'notes', 'posted_timestamp'],
+            (
+                (posting.idempotency_key, uuid.uuid4(), posting.notes,
+                 posting.posted_timestamp)
+                for posting in new
+            ),
+            cursor,
+        )
+        copy_rows(
+            'capone_import_entry',
+            ['idempotency_key', 'ledger_id', 'entry_id', 'amount'],
+            (
+                (posting.idempotency_key, ledger_id, uuid.uuid4(), amount)
+                for posting in new
+                for ledger_id, amount in posting.entries
+            ),
+            cursor,
+        )
+        copy_rows(
+            'capone_import_evidence',
+            ['idempotency_key', 'content_type_id', 'object_id'],
+            (
+                (posting.idempotency_key, content_type_id, object_id)
+                for posting in new
+                for content_type_id, object_id in posting.evidence_keys
+            ),
+            cursor,
+        )
+
+        ledger_ids = sorted({
+            ledger_id for posting in new for ledger_id, _ in posting.entries})
+        evidence_keys = {
+            key for posting in new for key in posting.evidence_keys}
+        if merge_balances:
+            # Lock the Ledgers like a posting, so that the balances are
+            # updated in the same order as postings update them.
+            cursor.execute(LOCK_LEDGERS_SQL, {'ledger_ids': ledger_ids})
+        cursor.execute(MOVE_STAGED_TRANSACTIONS_SQL, {
+            'created_by_id': user.id,
+            'type_id': type.id,
+            'now': timezone.now(),
+            'merge_balances': merge_balances,
+        })
+        counts = cursor.fetchone()
+        # Ledger balances are summed from the entries, so they change even
+        # without `merge_balances`.
+        invalidate_balances_on_commit(ledger_ids, evidence_keys)
+    return counts
+
+
+def _prepare_batch(batch, errors):
+    """
+    Validate the `(index, posting)` pairs `batch`.
+
+    Returns the valid postings as `_StagedPosting`s, and appends the
+    problems with the others to `errors`.
+    """
+    staged = []
+    keys = set()
+    for index, posting in batch:
+        try:
+            prepared = _prepare(posting, keys)
+        except (
+            TransactionException,
+            ObjectDoesNotExist,
+            ValueError,
+            ArithmeticError,
+        ) as e:
+            errors.append((index, posting.get('idempotency_key'), e))
+            continue
+        keys.add(prepared.idempotency_key)
+        staged.append(prepared)
+    return staged
+
+
+def _import_staged(arguments):
+    """
+    Import `_StagedPosting`s in chunks and return the counts.
+
+    Takes one tuple of arguments, so that it can be mapped over a Pool.
+    """
+    staged, user, type, chunk_size, merge_balances = arguments
+    counts = (0, 0, 0)
+    for start in range(0, len(staged), chunk_size):
+        counts = tuple(map(sum, zip(counts, _import_chunk(
+            staged[start:start + chunk_size], user, type, merge_balances))))
+    return counts
+
+
+def _add_counts(result, staged, counts):
+    """
+    Add the counts of importing `staged` postings to the ImportResult.
+    """
+    imported, entries, related_objects = map(sum, zip((0, 0, 0), *counts))
+    return ImportResult(
+        result.imported + imported,
+        result.skipped + staged - imported,
+        result.entries + entries,
+        result.related_objects + related_objects,
+        result.errors,
+    )
+
+
+def import_transactions(
+    postings,
+    user,
+    type=None,
+    chunk_size=10000,
+    merge_balances=True,
+    progress=None,
+):
+    """
+    Import the historical Transactions `postings` and return an ImportResult.
+
+    Each posting is a dict like the arguments of `create_transaction`:
+    `idempotency_key`, which is required, `ledger_entries`, a list of
+    `(ledger, amount)` pairs, where `ledger` is a Ledger, name, or number,
+    and optionally `evidence`, `posted_timestamp`, which is in the current
+    time zone if it is naive, and `notes`.  Evidence can also be given as
+    `(content_type, object_id)` pairs, where `content_type` is a
+    ContentType, its id, or `'app_label.model'`.  The Transactions are
+    created by `user`, of `type` or the manual TransactionType.
+
+    Postings that don't validate aren't imported: they are listed in
+    `ImportResult.errors` as `(index, idempotency_key, exception)`.
+    Postings with idempotency keys that were already used are counted as
+    `skipped`.  After each chunk, `progress(result)` is called with the
+    ImportResult so far.
+    """
+    type = type or get_or_create_manual_transaction_type()
+    result = ImportResult(0, 0, 0, 0, [])
+    postings = enumerate(postings)
+    while True:
+        batch = list(islice(postings, chunk_size))
+        if not batch:
+            return result
+
+        chunk = _prepare_batch(batch, result.errors)
+        result = _add_counts(result, len(chunk), [
+            _import_staged((chunk, user, type, chunk_size, merge_balances))])
+        if progress is not None:
+            progress(result)
+
+
+def _partition(staged, partitions):
+    """
+    Split the `_StagedPosting`s `staged` into `partitions` lists.
+
+    Each Ledger belongs to the partition of the first posting that uses it,
+    which is the least loaded one if none of the posting's Ledgers belong to
+    a partition yet.  So partitions share no Ledgers, and each holds whole
+    connected components of the graph of Ledgers used together, except for
+    the postings that would join Ledgers of different partitions.  Those
+    are returned separately, as `(partitions, crossing)`.
+    """
+    owners = {}
+    loads = [0] * partitions
+    partitioned = [[] for _ in range(partitions)]
+    crossing = []
+    for posting in staged:
+        ledger_ids = {ledger_id for ledger_id, _ in posting.entries}
+        owned = {owners[id] for id in ledger_ids if id in owners}
+        if len(owned) > 1:
+            crossing.append(posting)
+            continue
+        partition = owned.pop() if owned else loads.index(min(loads))
+        for ledger_id in ledger_ids:
+            owners[ledger_id] = partition
+        partitioned[partition].append(posting)
+        loads[partition] += len(posting.entries)
+    return partitioned, crossing
+
+
+def import_transactions_parallel(
+    postings,
+    user,
+    type=None,
+    processes=None,
+    batch_size=100000,
+    chunk_size=10000,
+    merge_balances=True,
+    progress=None,
+):
+    """
+    Import `postings` like `import_transactions`, on a pool of processes.
+
+    This is experimental: it hasn't yet been shown to be faster than
+    `import_transactions` on a multi-core machine.
+
+    Postings are validated `batch_size` at a time and split into one
+    partition per process, by the connected components of the Ledgers they
+    use, so that the processes, each with its own connection, don't wait
+    for each other's Ledger locks.  Postings that would join the Ledgers of
+    different partitions are imported afterwards, by this process.  So the
+    Transactions aren't created in the order of `postings`.  After each
+    batch, `progress(result)` is called with the ImportResult so far.
+
+    `processes` defaults to the number of CPUs.  The processes are forked
+    from this one once its database connections are closed, so this can't
+    be called in an atomic block.
+    """
+    if connection.in_atomic_block:
+        raise TransactionManagementError(
+            "import_transactions_parallel can't be called in an atomic "
+            "block, as it must close its database connections.")
+    processes = processes or os.cpu_count()
+    type = type or get_or_create_manual_transaction_type()
+    result = ImportResult(0, 0, 0, 0, [])
+    postings = enumerate(postings)
+
+    # Each process must open a connection of its own.
+    connections.close_all()
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        while True:
+            batch = list(islice(postings, batch_size))
+            if not batch:
+                return result
+
+            staged = _prepare_batch(batch, result.errors)
+            partitions, crossing = _partition(staged, processes)
+            counts = pool.map(_import_staged, [
+                (partition, user, type, chunk_size, merge_balances)
+                for partition in partitions if partition
+            ])
+            # The processes invalidated the balances in their caches, which
+            # may not be this process's.
+            invalidate_balances_on_commit(
+                {ledger_id for posting in staged
+                 for ledger_id, _ in posting.entries},
+                {key for posting in staged for key in posting.evidence_keys},
+            )
+            counts.append(_import_staged(
+                (crossing, user, type, chunk_size, merge_balances)))
+            result = _add_counts(result, len(staged), counts)
+            if progress is not None:
+                progress(result)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_postings_csv(file, ledger_numbers=False):
+    """
+    Read postings for `import_transactions` from a CSV file.
+
+    The CSV has a header row and the columns `idempotency_key`,
+    `posted_timestamp`, `ledger`, and `amount`, and optionally `evidence`
+    and `notes`; each row is an entry.  A Transaction's entries must be
+    consecutive rows with its idempotency key.  Its `posted_timestamp` and
+    `notes` are read from its first row, and its evidence is every
+    `app_label.model:id` in the space-separated `evidence` columns of its
+    rows.  `ledger` is a Ledger name, or its number if `ledger_numbers`.
+
+    Raises ValueError, naming the line, if a row can't be parsed.
+    """
+    reader = csv.DictReader(file)
+    numbered = ((reader.line_num, row) for row in reader)
+    for key, rows in groupby(
+        numbered, key=lambda numbered: numbered[1]['idempotency_key']
+    ):
+        line_nums, rows = zip(*rows)
+        line_num = line_nums[0]
+        try:
+            posted_timestamp = None
+            if rows[0]['posted_timestamp']:
+                posted_timestamp = parse_datetime(rows[0]['posted_timestamp'])
+                if posted_timestamp is None:
+                    raise ValueError("Invalid posted_timestamp {!r}.".format(
+                        rows[0]['posted_timestamp']))
+            evidence = []
+            ledger_entries = []
+            for line_num, row in zip(line_nums, rows):
+                for item in (row.get('evidence') or '').split():
+                    content_type, _, object_id = item.rpartition(':')
+                    evidence.append((content_type, int(object_id)))
+                ledger_entries.append((
+                    int(row['ledger']) if ledger_numbers else row['ledger'],
+                    Decimal(row['amount']),
+                ))
+        except (ValueError, InvalidOperation) as e:
+            raise ValueError("Line {}: {}".format(
+                line_num, e if isinstance(e, ValueError)
+                else "Invalid amount."))
+        yield {
+            'idempotency_key': key,
+            'posted_timestamp': posted_timestamp,
+            'notes': rows[0].get('notes') or '',
+            'evidence': evidence,
+            'ledger_entries': ledger_entries,
+        }
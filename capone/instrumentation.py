@@ -0,0 +1,224 @@
+"""
+Measurement of the phases of postings.
+
+`create_transaction`, `void_transaction`, and `create_transactions` send
+`capone.signals.posting_measured` when they return or raise, but only if it
+has receivers: otherwise nothing is measured, and the cost of the
+instrumentation is a few function calls per posting.  Each posting is
+measured in these phases:
+
+- `prepare`: resolving Ledgers, validating, and, for voids, reading the
+  voided Transaction's entries and evidence;
+- `lock`: waiting for the locks on the Ledgers;
+- `write`: writing the Transaction, its entries and evidence, and the
+  LedgerBalances;
+- `commit`: committing the database transaction, or releasing the
+  savepoint inside a caller's atomic block.
+
+While they are measured, postings lock their Ledgers in a statement of
+their own, so that `lock` is the time spent waiting for the locks; this
+costs one more round trip per posting.  Statements are counted in the
+connection's query log, as `CaptureQueriesContext` does, so they are also
+logged to `django.db.backends` as they are when DEBUG is on.
+
+Receivers can be written against the signal directly, or
+`log_posting_metrics` or a `StatsdPostingMetrics` can be connected:
+
+    posting_measured.connect(log_posting_metrics)
+    posting_measured.connect(StatsdPostingMetrics(client), weak=False)
+"""
+import logging
+import threading
+import time
+from collections import deque
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import connection
+
+from capone.signals import posting_measured
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class PostingMetrics(object):
+    """
+    The measurements of one call to the posting API.
+
+    `durations` maps each phase to the seconds spent in it; `statements` is
+    the number of SQL statements executed and `rows` the number of rows
+    written.
+    """
+    def __init__(self):
+        self.durations = OrderedDict()
+        self.statements = 0
+        self.rows = 0
+
+
+class _QueryLog(deque):
+    """
+    A connection's query log that counts the statements appended to it.
+    """
+    def __init__(self, maxlen):
+        super(_QueryLog, self).__init__(maxlen=maxlen)
+        self.appended = 0
+
+    def append(self, query):
+        self.appended += 1
+        super(_QueryLog, self).append(query)
+
+
+@contextmanager
+def _count_statements(metrics):
+    """
+    Count the statements executed on the connection in this block.
+
+    The connection's query log is swapped for a `_QueryLog` in the block,
+    and the statements logged are added to the original log afterwards.
+    """
+    queries_log = connection.queries_log
+    force_debug_cursor = connection.force_debug_cursor
+    connection.queries_log = _QueryLog(queries_log.maxlen)
+    connection.force_debug_cursor = True
+    try:
+        yield
+    finally:
+        metrics.statements += connection.queries_log.appended
+        queries_log.extend(connection.queries_log)
+        connection.queries_log = queries_log
+        connection.force_debug_cursor = force_debug_cursor
+
+
+def is_measuring():
+    """
+    Return whether a posting is being measured in this thread.
+    """
+    return getattr(_local, 'metrics', None) is not None
+
+
+@contextmanager
+def measure_posting(function):
+    """
+    Measure the posting API call `function` in this block.
+
+    `posting_measured` is sent at the end of the block if it has receivers.
+    A posting made while another is being measured, such as the postings of
+    a batch, is measured as part of the outer one.
+    """
+    transaction_model = apps.get_model('capone', 'Transaction')
+    if is_measuring() or not posting_measured.has_listeners(
+            transaction_model):
+        yield
+        return
+
+    metrics = _local.metrics = PostingMetrics()
+    exception = None
+    started = time.perf_counter()
+    try:
+        with _count_statements(metrics):
+            yield
+    except Exception as e:
+        exception = e
+        raise
+    finally:
+        metrics.durations['total'] = time.perf_counter() - started
+        _local.metrics = None
+        posting_measured.send(
+            sender=transaction_model,
+            function=function,
+            durations=metrics.durations,
+            statements=metrics.statements,
+            rows=metrics.rows,
+            exception=exception,
+        )
+
+
+def add_duration(phase, seconds):
+    """
+    Add `seconds` to the duration of `phase` of the posting being measured.
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.durations[phase] = (
+            metrics.durations.get(phase, 0) + seconds)
+
+
+@contextmanager
+def phase(name):
+    """
+    Measure this block as part of phase `name`.
+    """
+    if not is_measuring():
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_duration(name, time.perf_counter() - started)
+
+
+def add_rows(count):
+    """
+    Count `count` rows as written by the posting being measured.
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.rows += count
+
+
+def log_posting_metrics(
+        sender, function, durations, statements, rows, exception, **kwargs):
+    """
+    A `posting_measured` receiver that logs each posting's measurements.
+
+    Postings are logged at INFO level, or WARNING if they failed, to the
+    `capone.instrumentation` logger.
+    """
+    logger.log(
+        logging.INFO if exception is None else logging.WARNING,
+        "%s took %.2fms (%s) in %d statements writing %d rows%s",
+        function.__name__,
+        durations['total'] * 1000,
+        ', '.join(
+            '{} {:.2f}ms'.format(name, seconds * 1000)
+            for name, seconds in durations.items()
+            if name != 'total'
+        ),
+        statements,
+        rows,
+        '' if exception is None else ': {!r}'.format(exception),
+    )
+
+
+class StatsdPostingMetrics(object):
+    """
+    A `posting_measured` receiver that sends measurements to statsd.
+
+    `client` is a statsd client with `timing(stat, milliseconds)` and
+    `incr(stat, count)` methods, such as `statsd.StatsClient`.  For each
+    posting, the duration of each phase is sent as the timer
+    `<prefix>.<function>.<phase>`, and the statements, rows, and errors are
+    added to the counters `<prefix>.<function>.statements`, `.rows`, and
+    `.errors`.  Connect it with `weak=False`.
+    """
+    def __init__(self, client, prefix='capone'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(
+            self, sender, function, durations, statements, rows, exception,
+            **kwargs):
+        name = '{}.{}'.format(self.prefix, function.__name__)
+        for phase_name, seconds in durations.items():
+            self.client.timing(
+                '{}.{}'.format(name, phase_name), seconds * 1000)
+        self.client.incr(name + '.statements', statements)
+        self.client.incr(name + '.rows', rows)
+        if exception is not None:
+            self.client.incr(name + '.errors', 1)
@@ -0,0 +1,94 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError
+from django.db.transaction import atomic
+
+from capone.models import Ledger
+from capone.models import Transaction
+from capone.utils import set_local_timeouts
+
+
+class ChunkedCommand(BaseCommand):
+    """
+    A command that works through capone's tables a chunk at a time.
+
+    Each chunk is processed in a database transaction of its own, with the
+    `--statement-timeout` and `--lock-timeout` limits, and its progress is
+    written to stdout.  A chunk that times out or fails is reported and
+    skipped, and `failed_chunks` counts them.
+    """
+    default_chunk_size = 10
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=self.default_chunk_size,
+            help="The number of Ledgers to process in each database "
+                 "transaction.")
+        parser.add_argument(
+            '--statement-timeout', default='5min',
+            help="The longest a statement may run, as a Postgres "
+                 "duration; 0 is no limit.")
+        parser.add_argument(
+            '--lock-timeout', default='10s',
+            help="The longest a statement may wait for a lock, as a "
+                 "Postgres duration; 0 is no limit.")
+
+    def ledger_chunks(self, chunk_size):
+        """
+        Return the ids of all Ledgers in lists of `chunk_size`.
+        """
+        ids = list(Ledger.objects.order_by('id').values_list('id', flat=True))
+        return [
+            ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+    def transaction_chunks(self, chunk_size):
+        """
+        Return ranges of `chunk_size` Transaction ids covering all of them.
+        """
+        first = Transaction.objects.order_by('id').values_list(
+            'id', flat=True).first()
+        last = Transaction.objects.order_by('-id').values_list(
+            'id', flat=True).first()
+        if first is None:
+            return []
+        return [
+            (start, min(start + chunk_size - 1, last))
+            for start in range(first, last + 1, chunk_size)
+        ]
+
+    def process_chunks(self, chunks, process, options, unit, size=len):
+        """
+        Call `process(chunk)` for each of `chunks` and return the results.
+
+        `size(chunk)` is the number of `unit`s in a chunk, for the progress
+        report; the result of a failed chunk is None.
+        """
+        results = []
+        done = 0
+        total = sum(map(size, chunks))
+        started = time.perf_counter()
+        for i, chunk in enumerate(chunks, 1):
+            try:
+                with atomic():
+                    set_local_timeouts(
+                        options['statement_timeout'], options['lock_timeout'])
+                    results.append(process(chunk))
+            except OperationalError as e:
+                self.failed_chunks += 1
+                results.append(None)
+                self.stderr.write("Chunk {} of {} failed: {}".format(
+                    i, len(chunks), str(e).strip()))
+            done += size(chunk)
+            elapsed = time.perf_counter() - started
+            rate = done / elapsed if elapsed else 0
+            self.stdout.write(
+                "Chunk {} of {}: {} of {} {} ({:.0f}/s, {:.0f}s "
+                "left).".format(
+                    i, len(chunks), done, total, unit, rate,
+                    (total - done) / rate if rate else 0))
+        return results
+
+    def execute(self, *args, **options):
+        self.failed_chunks = 0
+        return super(ChunkedCommand, self).execute(*args, **options)
@@ -0,0 +1,72 @@
+from django.core.management.base import CommandError
+
+from capone.management.commands._chunked import ChunkedCommand
+from capone.management.commands.capone_verify_balances import format_drift
+from capone.utils import find_unbalanced_transactions
+from capone.utils import find_unsynced_entry_timestamps
+from capone.utils import find_wrong_void_flags
+from capone.utils import verify_ledger_balances
+
+
+class Command(ChunkedCommand):
+    help = (
+        "Check capone's invariants: that every Transaction balances, that "
+        "void flags and LedgerEntry timestamps match their Transactions, "
+        "and that every LedgerBalance matches the LedgerEntries.  Fails if "
+        "any doesn't hold."
+    )
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--transaction-chunk-size', type=int, default=100000,
+            help="The number of Transaction ids to check in each database "
+                 "transaction.")
+
+    def handle(self, *args, **options):
+        problems = 0
+
+        self.stdout.write("Checking transactions.")
+        results = self.process_chunks(
+            self.transaction_chunks(options['transaction_chunk_size']),
+            lambda ids: (
+                find_unbalanced_transactions(*ids),
+                find_wrong_void_flags(*ids),
+                find_unsynced_entry_timestamps(*ids),
+            ),
+            options,
+            'transaction ids',
+            size=lambda ids: ids[1] - ids[0] + 1,
+        )
+        for unbalanced, void_flags, timestamps in filter(None, results):
+            for transaction_id, total in unbalanced:
+                self.stdout.write(
+                    "Transaction {} doesn't balance: its entries total "
+                    "{}.".format(transaction_id, total))
+            for transaction_id in void_flags:
+                self.stdout.write(
+                    "Transaction {} has the wrong void flags.".format(
+                        transaction_id))
+            for entry_id in timestamps:
+                self.stdout.write(
+                    "LedgerEntry {} has the wrong posted_timestamp.".format(
+                        entry_id))
+            problems += len(unbalanced) + len(void_flags) + len(timestamps)
+
+        self.stdout.write("Checking ledger balances.")
+        results = self.process_chunks(
+            self.ledger_chunks(options['chunk_size']),
+            verify_ledger_balances,
+            options,
+            'ledgers',
+        )
+        for drift in filter(None, results):
+            for row in drift:
+                self.stdout.write(format_drift(row))
+            problems += len(drift)
+
+        self.stdout.write("Found {} problem(s).".format(problems))
+        if problems or self.failed_chunks:
+            raise CommandError(
+                "{} problem(s) and {} failed chunk(s).".format(
+                    problems, self.failed_chunks))
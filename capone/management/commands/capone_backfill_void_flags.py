@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from capone.utils import backfill_void_flags
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the denormalized `is_void` and `is_voided` flags on "
+        "capone Transactions."
+    )
+
+    def handle(self, *args, **options):
+        count = backfill_void_flags()
+        self.stdout.write(
+            "Updated void flags on {} transaction(s).".format(count))
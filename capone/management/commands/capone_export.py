@@ -0,0 +1,92 @@
+import os
+import time
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils.dateparse import parse_datetime
+
+from capone.export import export_tables
+from capone.export import TABLES
+
+
+EXTENSIONS = {
+    'csv': 'csv',
+    'binary': 'copy',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Export capone's Transactions, LedgerEntries, "
+        "TransactionRelatedObjects, and LedgerBalances with COPY, one file "
+        "per table, all read under the same snapshot."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output_dir',
+            help="The directory to write <table>.csv or <table>.copy to.")
+        parser.add_argument(
+            '--tables', nargs='+', choices=list(TABLES), default=list(TABLES),
+            help="The tables to export; all of them by default.")
+        parser.add_argument(
+            '--format', choices=list(EXTENSIONS), default='csv',
+            help="CSV with a header row, or Postgres's binary COPY format.")
+        parser.add_argument(
+            '--joined', action='store_true',
+            help="Include the names of Ledgers, TransactionTypes, and "
+                 "evidence ContentTypes.")
+        parser.add_argument(
+            '--since',
+            help="Only export Transactions posted at or after this time.")
+        parser.add_argument(
+            '--until',
+            help="Only export Transactions posted before this time.")
+        parser.add_argument(
+            '--first-id', type=int, default=0,
+            help="Only export Transactions with at least this id.")
+        parser.add_argument(
+            '--last-id', type=int, default=None,
+            help="Only export Transactions with at most this id.")
+        parser.add_argument(
+            '--database',
+            help="The database to export from; by default, the one "
+                 "capone's models are read from.")
+
+    def handle(self, *args, **options):
+        filters = {}
+        for name in ('since', 'until'):
+            if options[name] is not None:
+                filters[name] = parse_datetime(options[name])
+                if filters[name] is None:
+                    raise CommandError(
+                        "--{} must be a date and time, not {!r}.".format(
+                            name, options[name]))
+        if options['last_id'] is not None:
+            filters['last_id'] = options['last_id']
+        os.makedirs(options['output_dir'], exist_ok=True)
+
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            files = {
+                table: stack.enter_context(open(os.path.join(
+                    options['output_dir'],
+                    '{}.{}'.format(table, EXTENSIONS[options['format']]),
+                ), 'wb'))
+                for table in options['tables']
+            }
+            rows = export_tables(
+                files,
+                format=options['format'],
+                joined=options['joined'],
+                first_id=options['first_id'],
+                using=options['database'],
+                **filters
+            )
+
+        for table, count in rows.items():
+            self.stdout.write("Exported {} {} to {}.".format(
+                count, table, files[table].name))
+        self.stdout.write("Exported {} row(s) in {:.1f}s.".format(
+            sum(rows.values()), time.perf_counter() - started))
@@ -0,0 +1,116 @@
+import time
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils.dateparse import parse_datetime
+
+from capone.models import get_or_create_manual_transaction_type
+from capone.synthetic import DEFAULT_END
+from capone.synthetic import generate_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate random capone Transactions for load and performance "
+        "testing, writing them with COPY and then rebuilding "
+        "LedgerBalances.  The same --seed generates the same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'transactions', type=int,
+            help="The number of Transactions to generate.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--ledgers', type=int, default=100,
+            help="The number of Ledgers to post to.")
+        parser.add_argument(
+            '--ledger-skew', type=float, default=1.0,
+            help="The exponent of the Zipf-like popularity of Ledgers; "
+                 "0 posts to all Ledgers equally.")
+        parser.add_argument(
+            '--evidence', type=int, default=10000,
+            help="The number of evidence objects to draw from.")
+        parser.add_argument(
+            '--evidence-model', default='auth.User',
+            help="The model of the evidence, as app_label.ModelName.  "
+                 "Its objects needn't exist.")
+        parser.add_argument('--max-entries', type=int, default=10)
+        parser.add_argument('--max-evidence', type=int, default=5)
+        parser.add_argument('--void-fraction', type=float, default=0.02)
+        parser.add_argument(
+            '--backdated-fraction', type=float, default=0.05)
+        parser.add_argument(
+            '--end', default=DEFAULT_END.isoformat(),
+            help="The time the last Transaction is created.")
+        parser.add_argument(
+            '--days', type=int, default=365,
+            help="The number of days the Transactions are spread over.")
+        parser.add_argument(
+            '--username', default='capone-synthetic',
+            help="The user who creates the Transactions, created if need "
+                 "be.")
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument(
+            '--no-rebuild', action='store_false', dest='rebuild',
+            help="Don't rebuild LedgerBalances afterwards.")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['evidence_model'])
+        except ValueError:
+            raise CommandError(
+                "--evidence-model must be app_label.ModelName, not "
+                "{!r}.".format(options['evidence_model']))
+        except LookupError as e:
+            raise CommandError(str(e))
+        end = parse_datetime(options['end'])
+        if end is None:
+            raise CommandError(
+                "--end must be a date and time, not {!r}.".format(
+                    options['end']))
+        if options['max_entries'] < 2 or options['max_evidence'] < 1:
+            raise CommandError(
+                "--max-entries must be at least 2 and --max-evidence at "
+                "least 1.")
+
+        user_model = get_user_model()
+        user, _ = user_model.objects.get_or_create(
+            **{user_model.USERNAME_FIELD: options['username']})
+        started = time.perf_counter()
+
+        def progress(counts):
+            self.stdout.write(
+                "Wrote {} of {} transaction(s), {} entries ({:.0f} "
+                "transactions/s).".format(
+                    counts.transactions, options['transactions'],
+                    counts.entries,
+                    counts.transactions / (time.perf_counter() - started)))
+
+        counts = generate_dataset(
+            options['transactions'],
+            user=user,
+            content_type=ContentType.objects.get_for_model(model),
+            type=get_or_create_manual_transaction_type(),
+            seed=options['seed'],
+            ledgers=options['ledgers'],
+            ledger_skew=options['ledger_skew'],
+            evidence=options['evidence'],
+            max_entries=options['max_entries'],
+            max_evidence=options['max_evidence'],
+            void_fraction=options['void_fraction'],
+            backdated_fraction=options['backdated_fraction'],
+            end=end,
+            days=options['days'],
+            batch_size=options['batch_size'],
+            rebuild=options['rebuild'],
+            progress=progress,
+        )
+        self.stdout.write(
+            "Generated {} transaction(s) with {} entries and {} related "
+            "objects in {:.1f}s.".format(
+                counts.transactions, counts.entries, counts.related_objects,
+                time.perf_counter() - started))
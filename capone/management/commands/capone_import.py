@@ -0,0 +1,106 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from capone.cache import get_or_create_transaction_type
+from capone.importer import import_transactions
+from capone.importer import import_transactions_parallel
+from capone.importer import read_postings_csv
+
+
+class Command(BaseCommand):
+    help = (
+        "Import historical Transactions from a CSV file of entries, loading "
+        "them with COPY in chunks.  Transactions whose idempotency keys "
+        "were already imported are skipped, so an interrupted import can be "
+        "run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file',
+            help="A CSV file with the columns idempotency_key, "
+                 "posted_timestamp, ledger, amount, and optionally evidence "
+                 "and notes.")
+        parser.add_argument(
+            '--username', required=True,
+            help="The user who creates the Transactions.")
+        parser.add_argument(
+            '--type',
+            help="The name of the Transactions' TransactionType, created if "
+                 "need be; Manual by default.")
+        parser.add_argument(
+            '--ledger-numbers', action='store_true',
+            help="The ledger column holds Ledger numbers, not names.")
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help="Experimental: import postings on disjoint sets of Ledgers "
+                 "in this many processes at once; 0 for one per CPU.")
+        parser.add_argument(
+            '--batch-size', type=int, default=100000,
+            help="With --processes, the number of postings to split "
+                 "between the processes at a time.")
+        parser.add_argument(
+            '--no-merge-balances', action='store_false',
+            dest='merge_balances',
+            help="Don't update LedgerBalances; rebuild them afterwards with "
+                 "capone_rebuild_balances.")
+
+    def handle(self, *args, **options):
+        user_model = get_user_model()
+        try:
+            user = user_model.objects.get(
+                **{user_model.USERNAME_FIELD: options['username']})
+        except user_model.DoesNotExist:
+            raise CommandError(
+                "There is no user {!r}.".format(options['username']))
+        type = None
+        if options['type']:
+            type = get_or_create_transaction_type(options['type'])
+        started = time.perf_counter()
+
+        def progress(result):
+            self.stdout.write(
+                "Imported {} transaction(s), skipped {}, {} error(s) "
+                "({:.0f} transactions/s).".format(
+                    result.imported, result.skipped, len(result.errors),
+                    result.imported / (time.perf_counter() - started)))
+
+        with open(options['file'], newline='') as file:
+            try:
+                postings = read_postings_csv(
+                    file, ledger_numbers=options['ledger_numbers'])
+                kwargs = {
+                    'user': user,
+                    'type': type,
+                    'chunk_size': options['chunk_size'],
+                    'merge_balances': options['merge_balances'],
+                    'progress': progress,
+                }
+                if options['processes'] == 1:
+                    result = import_transactions(postings, **kwargs)
+                else:
+                    result = import_transactions_parallel(
+                        postings,
+                        processes=options['processes'] or None,
+                        batch_size=options['batch_size'],
+                        **kwargs
+                    )
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for index, idempotency_key, error in result.errors:
+            self.stderr.write("Transaction {!r}: {}".format(
+                idempotency_key, error))
+        self.stdout.write(
+            "Imported {} transaction(s) with {} entries and {} related "
+            "objects, skipped {}, in {:.1f}s.".format(
+                result.imported, result.entries, result.related_objects,
+                result.skipped, time.perf_counter() - started))
+        if result.errors:
+            raise CommandError(
+                "{} transaction(s) weren't imported.".format(
+                    len(result.errors)))
@@ -0,0 +1,44 @@
+from functools import partial
+
+from django.core.management.base import CommandError
+
+from capone.management.commands._chunked import ChunkedCommand
+from capone.management.commands.capone_verify_balances import format_drift
+from capone.utils import repair_ledger_balances
+
+
+class Command(ChunkedCommand):
+    help = (
+        "Correct the capone LedgerBalances that disagree with the "
+        "LedgerEntries, locking a few Ledgers at a time."
+    )
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Report the wrong balances without locking or correcting "
+                 "them, and fail if there are any.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        results = self.process_chunks(
+            self.ledger_chunks(options['chunk_size']),
+            partial(repair_ledger_balances, dry_run=dry_run),
+            options,
+            'ledgers',
+        )
+        drift = [row for result in results if result for row in result]
+        for row in drift:
+            self.stdout.write(format_drift(row))
+
+        if dry_run:
+            self.stdout.write(
+                "Would correct {} ledger balance(s).".format(len(drift)))
+        else:
+            self.stdout.write(
+                "Corrected {} ledger balance(s).".format(len(drift)))
+        if (dry_run and drift) or self.failed_chunks:
+            raise CommandError(
+                "{} wrong ledger balance(s) and {} failed chunk(s).".format(
+                    len(drift), self.failed_chunks))
@@ -0,0 +1,36 @@
+from django.core.management.base import CommandError
+
+from capone.management.commands._chunked import ChunkedCommand
+from capone.utils import verify_ledger_balances
+
+
+class Command(ChunkedCommand):
+    help = (
+        "Check every capone LedgerBalance against the LedgerEntries, a few "
+        "Ledgers at a time, and fail if any is wrong."
+    )
+
+    def handle(self, *args, **options):
+        results = self.process_chunks(
+            self.ledger_chunks(options['chunk_size']),
+            verify_ledger_balances,
+            options,
+            'ledgers',
+        )
+        drift = [row for result in results if result for row in result]
+        for row in drift:
+            self.stdout.write(format_drift(row))
+
+        self.stdout.write(
+            "Found {} wrong ledger balance(s).".format(len(drift)))
+        if drift or self.failed_chunks:
+            raise CommandError(
+                "{} wrong ledger balance(s) and {} failed chunk(s).".format(
+                    len(drift), self.failed_chunks))
+
+
+def format_drift(row):
+    return (
+        "Ledger {0.ledger_id}, object {0.related_object_content_type_id}:"
+        "{0.related_object_id}: recorded {0.recorded}, actual "
+        "{0.actual}.".format(row))
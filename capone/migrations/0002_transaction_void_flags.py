@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+BACKFILL_VOID_FLAGS_SQL = '''\
+UPDATE capone_transaction SET is_void = TRUE WHERE voids_id IS NOT NULL;
+
+UPDATE capone_transaction SET is_voided = TRUE
+WHERE id IN (
+  SELECT voids_id FROM capone_transaction WHERE voids_id IS NOT NULL);
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capone', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='is_void',
+            field=models.BooleanField(default=False, help_text='Whether this Transaction voids another Transaction.'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='is_voided',
+            field=models.BooleanField(default=False, help_text='Whether this Transaction has been voided by another Transaction.'),
+        ),
+        migrations.RunSQL(
+            BACKFILL_VOID_FLAGS_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX capone_transaction_live_idx '
+            'ON capone_transaction (posted_timestamp, id) '
+            'WHERE NOT is_void AND NOT is_voided;',
+            reverse_sql='DROP INDEX capone_transaction_live_idx;',
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+BACKFILL_POSTED_TIMESTAMP_SQL = '''\
+UPDATE capone_ledgerentry
+SET posted_timestamp = capone_transaction.posted_timestamp
+FROM capone_transaction
+WHERE capone_ledgerentry.transaction_id = capone_transaction.id;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capone', '0002_transaction_void_flags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgerentry',
+            name='posted_timestamp',
+            field=models.DateTimeField(help_text='Time the transaction of this entry was posted.  Kept in sync with the Transaction.', null=True),
+        ),
+        migrations.RunSQL(
+            BACKFILL_POSTED_TIMESTAMP_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['ledger', 'posted_timestamp', 'id'], name='capone_entry_ledger_posted_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capone', '0003_ledgerentry_posted_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='idempotency_key',
+            field=models.CharField(blank=True, help_text='Optional client-supplied key that makes posting this Transaction idempotent.', max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+BACKFILL_POSTED_TIMESTAMP_SQL = '''\
+UPDATE capone_ledgerentry
+SET posted_timestamp = capone_transaction.posted_timestamp
+FROM capone_transaction
+WHERE capone_ledgerentry.transaction_id = capone_transaction.id
+  AND capone_ledgerentry.posted_timestamp IS NULL;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('capone', '0004_transaction_idempotency_key'),
+    ]
+
+    operations = [
+        # Entries written without `create_transaction` since `0003` may not
+        # have a timestamp yet.
+        migrations.RunSQL(
+            BACKFILL_POSTED_TIMESTAMP_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='posted_timestamp',
+            field=models.DateTimeField(help_text='Time the transaction of this entry was posted.  Kept in sync with the Transaction.'),
+        ),
+    ]
@@ -9,9 +9,13 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db import router
 from django.db.models import Q
 from django.utils.translation import gettext_lazy as _
 
+from capone.cache import cached_balance
+from capone.cache import get_or_create_transaction_type
+from capone.cache import ledger_balance_cache_key
 from capone.exceptions import TransactionBalanceException
 
 
@@ -68,9 +72,16 @@ class MatchType(Enum):
 
 class TransactionQuerySet(models.QuerySet):
     def non_void(self):
+        """
+        Filter out Transactions that void or have been voided by another.
+
+        This filter uses the denormalized `is_void` and `is_voided` flags
+        rather than joining `Transaction` to itself, so it can be answered
+        from the partial index on live Transactions.
+        """
         return self.filter(
-            voided_by__voids_id__isnull=True,
-            voids__isnull=True,
+            is_void=False,
+            is_voided=False,
         )
 
     def filter_by_related_objects(
@@ -92,10 +103,12 @@ class TransactionQuerySet(models.QuerySet):
             `related_objects` *exactly*: they may not have other evidence (c.f.
             ALL).
 
-        The current implementation of EXACT is not as performant as the other
-        options, even though it still creates a constant number of queries, so
-        be careful using it with large numbers of `related_objects`.
+        Each option is a single query, with at most one join or subquery no
+        matter how many `related_objects` there are.
         """
+        if not isinstance(match_type, MatchType):
+            raise ValueError("Invalid match_type.")
+
         content_types = ContentType.objects.get_for_models(
             *[type(o) for o in related_objects])
 
@@ -113,53 +126,100 @@ class TransactionQuerySet(models.QuerySet):
                 Q(),
             )
             return self.filter(combined_query).distinct()
-        elif match_type == MatchType.ALL:
-            for related_object in related_objects:
-                self = self.filter(
-                    related_objects__related_object_content_type=(
-                        content_types[type(related_object)]),
-                    related_objects__related_object_id=related_object.id,
-                )
-            return self
-        elif match_type == MatchType.NONE:
-            for related_object in related_objects:
-                self = self.exclude(
-                    related_objects__related_object_content_type=(
-                        content_types[type(related_object)]),
-                    related_objects__related_object_id=related_object.id,
-                )
+
+        if not related_objects:
+            if match_type == MatchType.EXACT:
+                return self.filter(related_objects__isnull=True)
             return self
-        elif match_type == MatchType.EXACT:
-            for related_object in related_objects:
-                self = (
-                    self
-                    .filter(
-                        related_objects__related_object_content_type=(
-                            content_types[type(related_object)]),
-                        related_objects__related_object_id=related_object.id,
-                    )
-                    .prefetch_related(
-                        'related_objects',
-                    )
-                )
 
-            exact_matches = []
-            related_objects_id_tuples = {
-                (
-                    related_object.id,
-                    content_types[type(related_object)].id
+        has_evidence = reduce(
+            operator.or_,
+            [
+                Q(
+                    related_object_content_type=(
+                        content_types[type(related_object)]),
+                    related_object_id=related_object.id,
                 )
                 for related_object in related_objects
-            }
-            for matched in self:
-                matched_objects = {
-                    (tro.related_object_id, tro.related_object_content_type_id)
-                    for tro in matched.related_objects.all()}
-                if matched_objects == related_objects_id_tuples:
-                    exact_matches.append(matched.id)
-            return self.filter(id__in=exact_matches)
+            ],
+        )
+        # TransactionRelatedObjects are unique, so a Transaction has all of
+        # the evidence if it has as many matching TransactionRelatedObjects
+        # as there are distinct objects.
+        evidence_count = len({
+            (content_types[type(related_object)].id, related_object.id)
+            for related_object in related_objects
+        })
+        with_evidence = (
+            TransactionRelatedObject.objects
+            .filter(has_evidence)
+            .values('transaction_id')
+        )
+
+        if match_type == MatchType.ALL:
+            return self.filter(id__in=(
+                with_evidence
+                .annotate(matches=models.Count('id'))
+                .filter(matches=evidence_count)
+                .values('transaction_id')
+            ))
+        elif match_type == MatchType.NONE:
+            return self.exclude(id__in=with_evidence)
         else:
-            raise ValueError("Invalid match_type.")
+            # EXACT: all of the evidence, and no other.
+            return self.filter(id__in=(
+                TransactionRelatedObject.objects
+                .filter(transaction_id__in=with_evidence)
+                .values('transaction_id')
+                .annotate(
+                    matches=models.Sum(models.Case(
+                        models.When(has_evidence, then=1),
+                        default=0,
+                        output_field=models.IntegerField(),
+                    )),
+                    evidence=models.Count('id'),
+                )
+                .filter(matches=evidence_count, evidence=evidence_count)
+                .values('transaction_id')
+            ))
+
+    def with_entries(self):
+        """
+        Prefetch the LedgerEntries of these Transactions and their Ledgers.
+        """
+        return self.prefetch_related(
+            models.Prefetch(
+                'entries',
+                queryset=LedgerEntry.objects.select_related('ledger'),
+            ),
+        )
+
+    def with_evidence(self):
+        """
+        Prefetch the evidence of these Transactions and the evidence objects.
+
+        The TransactionRelatedObjects are grouped by ContentType and the
+        objects they point to are loaded with one query per ContentType, so
+        `tro.related_object` doesn't query the database for each piece of
+        evidence.
+        """
+        return self.prefetch_related('related_objects__related_object')
+
+    def summaries(self):
+        """
+        Return a dict from each Transaction to its `Transaction.summary`.
+
+        LedgerEntries are prefetched with their Ledgers and evidence with its
+        ContentTypes, so all of the summaries are built in a constant number
+        of queries rather than several per Transaction.
+        """
+        transactions = self.with_entries().prefetch_related(
+            'related_objects__related_object_content_type',
+        )
+        return {
+            transaction: transaction.summary()
+            for transaction in transactions
+        }
 
 
 class TransactionType(models.Model):
@@ -189,7 +249,7 @@ def get_or_create_manual_transaction_type():
     """
     Callable for getting or creating the default `TransactionType`.
     """
-    return TransactionType.objects.get_or_create(name='Manual')[0]
+    return get_or_create_transaction_type('Manual')
 
 
 def get_or_create_manual_transaction_type_id():
@@ -199,6 +259,9 @@ def get_or_create_manual_transaction_type_id():
     return get_or_create_manual_transaction_type().id
 
 
+VOID_FLAG_FIELDS = ('is_void', 'is_voided')
+
+
 class Transaction(models.Model):
     """
     The main model for representing a financial event in `capone`.
@@ -227,10 +290,28 @@ class Transaction(models.Model):
         null=True,
         related_name='voided_by',
         on_delete=models.deletion.CASCADE)
+    # `is_void` and `is_voided` denormalize `voids` and `voided_by` so that
+    # `TransactionQuerySet.non_void` doesn't need a self-join.  They are
+    # maintained by `void_transaction` and can be recomputed with
+    # `capone.utils.backfill_void_flags`; `save` only writes them when a
+    # Transaction is created, so that saving a stale instance can't undo a
+    # void.
+    is_void = models.BooleanField(
+        help_text=_("Whether this Transaction voids another Transaction."),
+        default=False)
+    is_voided = models.BooleanField(
+        help_text=_("Whether this Transaction has been voided by another Transaction."),  # noqa: E501
+        default=False)
 
     notes = models.TextField(
         help_text=_("Any notes to go along with this Transaction."),
         blank=True)
+    idempotency_key = models.CharField(
+        help_text=_("Optional client-supplied key that makes posting this Transaction idempotent."),  # noqa: E501
+        max_length=255,
+        null=True,
+        blank=True,
+        unique=True)
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.deletion.CASCADE)
@@ -272,7 +353,25 @@ class Transaction(models.Model):
 
     def save(self, **kwargs):
         self.full_clean()
+        adding = self._state.adding
+        if not adding:
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key
+                ]
+            kwargs['update_fields'] = [
+                name for name in update_fields
+                if name not in VOID_FLAG_FIELDS
+            ]
         super(Transaction, self).save(**kwargs)
+        if not adding:
+            (
+                self.entries
+                .exclude(posted_timestamp=self.posted_timestamp)
+                .update(posted_timestamp=self.posted_timestamp)
+            )
 
     def __str__(self):
         return "Transaction %s" % self.transaction_id
@@ -312,11 +411,22 @@ class Ledger(models.Model):
     modified_at = models.DateTimeField(
         auto_now=True)
 
-    def get_balance(self):
+    def get_balance(self, using=None):
         """
         Get the current sum of all the amounts on the entries in this Ledger.
+
+        The entries are read from the database with alias `using`, which
+        defaults to the one chosen by the database routers.
+
+        This is cached if `CAPONE_BALANCE_CACHE` is set: see `capone.cache`.
         """
-        return sum([entry.amount for entry in self.entries.all()])
+        using = using or router.db_for_read(LedgerEntry, instance=self)
+        return cached_balance(
+            ledger_balance_cache_key(self.id),
+            lambda: sum([
+                entry.amount for entry in self.entries.using(using)]),
+            using=using,
+        )
 
     def __str__(self):
         return "Ledger %s" % self.name
@@ -331,6 +441,12 @@ class LedgerEntry(models.Model):
     """
     class Meta:
         verbose_name_plural = "ledger entries"
+        indexes = [
+            models.Index(
+                fields=['ledger', 'posted_timestamp', 'id'],
+                name='capone_entry_ledger_posted_idx',
+            ),
+        ]
 
     ledger = models.ForeignKey(
         Ledger,
@@ -354,11 +470,21 @@ class LedgerEntry(models.Model):
         max_digits=24,
         decimal_places=4)
 
+    # Denormalized from `Transaction.posted_timestamp` so that statements for
+    # a single Ledger can be read in posting order straight from an index.
+    posted_timestamp = models.DateTimeField(
+        help_text=_("Time the transaction of this entry was posted.  Kept in sync with the Transaction."))  # noqa: E501
+
     created_at = models.DateTimeField(
         auto_now_add=True)
     modified_at = models.DateTimeField(
         auto_now=True)
 
+    def save(self, **kwargs):
+        if self.posted_timestamp is None:
+            self.posted_timestamp = self.transaction.posted_timestamp
+        super(LedgerEntry, self).save(**kwargs)
+
     def __str__(self):
         return "LedgerEntry: ${amount} in {ledger}".format(
             amount=self.amount, ledger=self.ledger.name)
@@ -0,0 +1,106 @@
+"""
+Helpers for Postgres `COPY`, which moves rows far faster than INSERT and
+SELECT.
+
+Rows are loaded in `COPY`'s text format: one line per row, with columns
+separated by tabs and NULL written as `\\N`.  They are exported as CSV or
+in `COPY`'s binary format.
+"""
+import io
+from datetime import date
+from datetime import datetime
+
+from django.db import connection
+
+
+COPY_FROM_SQL = 'COPY {table} ({columns}) FROM STDIN'
+
+_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def copy_text(value):
+    """
+    Format `value` as a column of `COPY`'s text format.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str):
+        return value.translate(_ESCAPES)
+    return str(value)
+
+
+def copy_line(row):
+    """
+    Format the sequence `row` as a line of `COPY`'s text format.
+    """
+    return '\t'.join(map(copy_text, row)) + '\n'
+
+
+def copy_rows(table, columns, rows, cursor=None):
+    """
+    Load `rows`, sequences of values for `columns`, into `table` with COPY.
+
+    The rows are formatted in memory and sent in one `COPY`, so callers
+    loading more rows than fit in memory should call this once per chunk.
+    Returns the number of rows loaded.
+    """
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write(copy_line(row))
+        count += 1
+    buffer.seek(0)
+
+    sql = COPY_FROM_SQL.format(
+        table=connection.ops.quote_name(table),
+        columns=', '.join(map(connection.ops.quote_name, columns)),
+    )
+    if cursor is None:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, buffer)
+    else:
+        cursor.copy_expert(sql, buffer)
+    return count
+
+
+COPY_TO_SQL = 'COPY ({query}) TO STDOUT WITH ({options})'
+
+
+def copy_query(query, params, file, format='csv', cursor=None):
+    """
+    Write the rows of `query` with `params` to the binary `file` with COPY.
+
+    `format` is `'csv'`, written with a header row, or `'binary'`, Postgres's
+    binary COPY format, which `COPY ... FROM` loads without parsing.  The
+    rows are streamed to `file` as Postgres sends them, so memory use
+    doesn't grow with their number.  Returns the number of rows written.
+    """
+    options = {
+        'csv': 'FORMAT csv, HEADER',
+        'binary': 'FORMAT binary',
+    }[format]
+    if cursor is None:
+        with connection.cursor() as cursor:
+            return _copy_query(cursor, query, params, file, options)
+    return _copy_query(cursor, query, params, file, options)
+
+
+def _copy_query(cursor, query, params, file, options):
+    # COPY can't take parameters, so they are interpolated by the client.
+    sql = COPY_TO_SQL.format(
+        query=cursor.mogrify(query, params).decode(),
+        options=options,
+    )
+    cursor.copy_expert(sql, file)
+    return cursor.rowcount
@@ -0,0 +1,78 @@
+"""
+A database router that sends reads of `capone`'s models to replicas.
+
+Add it to `DATABASE_ROUTERS` and list the aliases of your replicas in
+`CAPONE_REPLICA_DATABASES`:
+
+    DATABASE_ROUTERS = ['capone.routers.CaponeReplicaRouter']
+    CAPONE_REPLICA_DATABASES = ['replica']
+
+Postings always write to, and lock rows in, the default database.  Reads
+go to the default database as well while it is in an atomic block, so
+that they see the database transaction's own writes, and inside
+`use_primary`, so that a request can read what it has just posted before
+the replicas have caught up.  The relations of objects read from a
+replica are read from the same replica.
+"""
+import random
+import threading
+from contextlib import ContextDecorator
+
+from django.conf import settings
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+
+
+_local = threading.local()
+
+
+class use_primary(ContextDecorator):
+    """
+    Read `capone`'s models from the default database in this block.
+
+    Can also be used as a decorator.
+    """
+    def __enter__(self):
+        _local.use_primary = getattr(_local, 'use_primary', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _local.use_primary -= 1
+
+
+def _replicas():
+    return getattr(settings, 'CAPONE_REPLICA_DATABASES', ())
+
+
+class CaponeReplicaRouter(object):
+    """
+    Route reads of `capone`'s models to a random replica.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'capone':
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in _replicas():
+            return instance._state.db
+        if (
+            not _replicas()
+            or getattr(_local, 'use_primary', 0)
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return random.choice(_replicas())
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'capone':
+            return None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS}.union(_replicas())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if app_label == 'capone' and db in _replicas():
+            return False
+        return None
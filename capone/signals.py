@@ -0,0 +1,18 @@
+from django.dispatch import Signal
+
+
+# Sent by `capone.api.actions` before it retries a posting that failed with
+# a deadlock, serialization failure, or lock timeout.  Receivers get
+# `function`, the API function being retried, `attempt`, the number of the
+# attempt that failed, starting at 1, `exception`, and `delay`, the number of
+# seconds before the next attempt.  Connect to it to count retries.
+posting_retried = Signal()
+
+# Sent by `capone.api.actions` after each call to `create_transaction`,
+# `void_transaction`, or `create_transactions` if it has receivers.
+# Receivers get `function`, the API function called, `durations`, a dict
+# from the name of each phase of the posting, and `total`, to seconds,
+# `statements`, the number of SQL statements executed, `rows`, the number
+# of rows written, and `exception`, the exception raised, if any.  See
+# `capone.instrumentation`.
+posting_measured = Signal()
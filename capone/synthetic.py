@@ -0,0 +1,324 @@
+"""
+Generation of large synthetic datasets for load and performance testing.
+
+`generate_dataset` writes random Transactions straight into `capone`'s
+tables with `COPY`, in chunks of `batch_size` Transactions, so that it
+scales to hundreds of millions of LedgerEntries with memory proportional to
+one chunk.  The data looks like production data:
+
+- Ledgers are posted to with a Zipf-like skew, so that a few are hot;
+- most Transactions have two entries and one piece of evidence, but some
+  have up to `max_entries` entries and `max_evidence` pieces of evidence;
+- a `void_fraction` of Transactions are voided by the next Transaction;
+- a `backdated_fraction` of Transactions are posted up to
+  `BACKDATED_DAYS` before they were created.
+
+The same arguments generate the same data: all randomness comes from
+`seed`.  Evidence is the ids `1` to `evidence` of `content_type`, which
+needn't exist.  LedgerBalances are rebuilt afterwards.
+"""
+import random
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from django.db import connection
+from django.db.models import Max
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from capone.models import Ledger
+from capone.pgcopy import copy_rows
+from capone.utils import rebuild_ledger_balances
+
+
+BACKDATED_DAYS = 30
+
+DEFAULT_END = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+RESERVE_TRANSACTION_IDS_SQL = '''\
+SELECT nextval(pg_get_serial_sequence('capone_transaction', 'id'))
+FROM generate_series(1, %s)
+'''
+
+ANALYZE_SQL = '''\
+ANALYZE
+  capone_transaction,
+  capone_ledgerentry,
+  capone_transactionrelatedobject,
+  capone_ledgerbalance
+'''
+
+TRANSACTION_COLUMNS = [
+    'id',
+    'transaction_id',
+    'voids_id',
+    'is_void',
+    'is_voided',
+    'notes',
+    'idempotency_key',
+    'created_by_id',
+    'posted_timestamp',
+    'created_at',
+    'modified_at',
+    'type_id',
+]
+
+LEDGER_ENTRY_COLUMNS = [
+    'transaction_id',
+    'ledger_id',
+    'entry_id',
+    'amount',
+    'posted_timestamp',
+    'created_at',
+    'modified_at',
+]
+
+RELATED_OBJECT_COLUMNS = [
+    'transaction_id',
+    'related_object_content_type_id',
+    'related_object_id',
+    'created_at',
+    'modified_at',
+]
+
+
+GeneratedCounts = namedtuple('GeneratedCounts', [
+    'transactions',
+    'entries',
+    'related_objects',
+])
+
+
+class _Posting(object):
+    """
+    A generated Transaction, before it has an id.
+    """
+    def __init__(self, entries, evidence, created_at, posted_timestamp):
+        self.entries = entries
+        self.evidence = evidence
+        self.created_at = created_at
+        self.posted_timestamp = posted_timestamp
+        self.voids = None
+        self.is_voided = False
+
+
+def synthetic_ledgers(count):
+    """
+    Return the `count` Ledgers named `Synthetic Ledger <n>`, creating them.
+    """
+    names = ['Synthetic Ledger {}'.format(i) for i in range(count)]
+    existing = {
+        ledger.name: ledger
+        for ledger in Ledger.objects.filter(name__in=names)
+    }
+    number = (Ledger.objects.aggregate(number=Max('number'))['number']
+              or 0) + 1
+    missing = []
+    for i, name in enumerate(names):
+        if name not in existing:
+            missing.append(Ledger(
+                name=name,
+                number=number + len(missing),
+                increased_by_debits=i % 2 == 0,
+            ))
+    for ledger in Ledger.objects.bulk_create(missing):
+        existing[ledger.name] = ledger
+    return [existing[name] for name in names]
+
+
+class _Generator(object):
+    def __init__(
+            self, rng, ledgers, ledger_skew, evidence, max_entries,
+            max_evidence, void_fraction, backdated_fraction, start, step):
+        self.rng = rng
+        self.ledger_ids = [ledger.id for ledger in ledgers]
+        self.cum_weights = list(accumulate(
+            1 / (rank + 1) ** ledger_skew for rank in range(len(ledgers))))
+        self.evidence = evidence
+        self.max_entries = max_entries
+        self.max_evidence = max_evidence
+        self.void_fraction = void_fraction
+        self.backdated_fraction = backdated_fraction
+        self.start = start
+        self.step = step
+
+    def ledger_id(self):
+        return self.rng.choices(
+            self.ledger_ids, cum_weights=self.cum_weights)[0]
+
+    def posting(self, index):
+        rng = self.rng
+        pairs = 1
+        if self.max_entries > 2 and rng.random() < 0.2:
+            pairs = rng.randint(2, self.max_entries // 2)
+        entries = []
+        for _ in range(pairs):
+            amount = Decimal(rng.randint(1, 1000000)).scaleb(-2)
+            entries.append((self.ledger_id(), amount))
+            entries.append((self.ledger_id(), -amount))
+
+        count = 1
+        if self.max_evidence > 1 and rng.random() < 0.3:
+            count = rng.randint(2, self.max_evidence)
+        evidence = sorted(rng.sample(
+            range(1, self.evidence + 1), min(count, self.evidence)))
+
+        created_at = self.start + self.step * index
+        posted_timestamp = created_at
+        if rng.random() < self.backdated_fraction:
+            posted_timestamp -= timedelta(
+                seconds=rng.uniform(0, BACKDATED_DAYS * 86400))
+        return _Posting(entries, evidence, created_at, posted_timestamp)
+
+    def void(self, posting, index):
+        created_at = self.start + self.step * index
+        void = _Posting(
+            [(ledger_id, -amount) for ledger_id, amount in posting.entries],
+            posting.evidence,
+            created_at,
+            created_at,
+        )
+        void.voids = posting
+        posting.is_voided = True
+        return void
+
+    def postings(self, first, count):
+        """
+        Generate the postings numbered `first` to `first + count - 1`.
+        """
+        postings = []
+        while len(postings) < count:
+            index = first + len(postings)
+            posting = self.posting(index)
+            postings.append(posting)
+            if (
+                len(postings) < count
+                and self.rng.random() < self.void_fraction
+            ):
+                postings.append(self.void(posting, index + 1))
+        return postings
+
+
+def _write(cursor, postings, user_id, type_id, content_type_id, rng):
+    cursor.execute(RESERVE_TRANSACTION_IDS_SQL, [len(postings)])
+    for posting, (transaction_id,) in zip(postings, cursor.fetchall()):
+        posting.id = transaction_id
+
+    transactions = [
+        (
+            posting.id,
+            uuid.UUID(int=rng.getrandbits(128), version=4),
+            None if posting.voids is None else posting.voids.id,
+            posting.voids is not None,
+            posting.is_voided,
+            '',
+            None,
+            user_id,
+            posting.posted_timestamp,
+            posting.created_at,
+            posting.created_at,
+            type_id,
+        )
+        for posting in postings
+    ]
+    entries = [
+        (
+            posting.id,
+            ledger_id,
+            uuid.UUID(int=rng.getrandbits(128), version=4),
+            amount,
+            posting.posted_timestamp,
+            posting.created_at,
+            posting.created_at,
+        )
+        for posting in postings
+        for ledger_id, amount in posting.entries
+    ]
+    related_objects = [
+        (
+            posting.id,
+            content_type_id,
+            object_id,
+            posting.created_at,
+            posting.created_at,
+        )
+        for posting in postings
+        for object_id in posting.evidence
+    ]
+    return GeneratedCounts(
+        copy_rows(
+            'capone_transaction', TRANSACTION_COLUMNS, transactions, cursor),
+        copy_rows(
+            'capone_ledgerentry', LEDGER_ENTRY_COLUMNS, entries, cursor),
+        copy_rows(
+            'capone_transactionrelatedobject', RELATED_OBJECT_COLUMNS,
+            related_objects, cursor),
+    )
+
+
+def generate_dataset(
+    transactions,
+    user,
+    content_type,
+    type,
+    seed=0,
+    ledgers=100,
+    ledger_skew=1.0,
+    evidence=10000,
+    max_entries=10,
+    max_evidence=5,
+    void_fraction=0.02,
+    backdated_fraction=0.05,
+    end=DEFAULT_END,
+    days=365,
+    batch_size=10000,
+    rebuild=True,
+    progress=None,
+):
+    """
+    Write `transactions` random Transactions and return `GeneratedCounts`.
+
+    The Transactions are created by `user`, of TransactionType `type`, in
+    the `ledgers` Ledgers returned by `synthetic_ledgers`, with evidence of
+    `content_type`, and spread evenly over the `days` days before `end`.
+    Each chunk of `batch_size` Transactions is written in a database
+    transaction of its own, after which `progress(counts)` is called with
+    the `GeneratedCounts` so far.  Then, if `rebuild` is true, the
+    LedgerBalances are rebuilt, and the tables are analyzed.
+    """
+    rng = random.Random(seed)
+    generator = _Generator(
+        rng,
+        synthetic_ledgers(ledgers),
+        ledger_skew,
+        evidence,
+        max_entries,
+        max_evidence,
+        void_fraction,
+        backdated_fraction,
+        start=end - timedelta(days=days),
+        step=timedelta(days=days) / max(transactions, 1),
+    )
+
+    counts = GeneratedCounts(0, 0, 0)
+    while counts.transactions < transactions:
+        postings = generator.postings(
+            counts.transactions,
+            min(batch_size, transactions - counts.transactions))
+        with atomic(), connection.cursor() as cursor:
+            written = _write(
+                cursor, postings, user.id, type.id, content_type.id, rng)
+        counts = GeneratedCounts(*map(sum, zip(counts, written)))
+        if progress is not None:
+            progress(counts)
+
+    if rebuild:
+        with atomic():
+            rebuild_ledger_balances()
+    with connection.cursor() as cursor:
+        cursor.execute(ANALYZE_SQL)
+    return counts
@@ -27,6 +27,8 @@ DATABASES = {
         'USER': os.environ.get('POSTGRES_USER', 'django'),
     },
 }
+# A second connection to the same database stands in for a read replica.
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
 
 ALLOWED_HOSTS = []
 
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from decimal import Decimal
+
+import pytest
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.test.signals import update_connections_time_zone
+
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.aio import acreate_transaction
+from capone.api.aio import aget_balances_for_objects
+from capone.api.aio import aledger_statement
+from capone.api.aio import avoid_transaction
+from capone.api.queries import ledger_statement
+from capone.models import LedgerEntry
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test the coroutine versions of the `capone` API.
+"""
+
+AMOUNT = Decimal(100)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@pytest.fixture
+def create_objects(transactional_db, settings):
+    # The synchronous API runs in another thread, which doesn't see the
+    # `USE_TZ` set for this test unless its connection is told.
+    run(sync_to_async(update_connections_time_zone)(setting='USE_TZ'))
+
+    user = UserFactory()
+    orders = OrderFactory.create_batch(3)
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+
+    def add_transaction(order):
+        return acreate_transaction(
+            user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(AMOUNT)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(AMOUNT)),
+            ],
+        )
+
+    yield user, orders, ar_ledger, cash_ledger, add_transaction
+
+    # Close the connection of the thread that runs the synchronous API.
+    run(sync_to_async(connections.close_all)())
+
+
+def test_postings(create_objects):
+    user, orders, ar_ledger, cash_ledger, add_transaction = create_objects
+
+    transactions = run(asyncio.gather(*[
+        add_transaction(order) for order in orders + orders[:1]]))
+    voiding_transaction = run(avoid_transaction(transactions[-1], user))
+
+    assert voiding_transaction.voids == transactions[-1]
+    assert ar_ledger.get_balance() == credit(AMOUNT * 3)
+
+
+def test_balances(create_objects):
+    user, orders, ar_ledger, cash_ledger, add_transaction = create_objects
+    run(asyncio.gather(*[add_transaction(order) for order in orders[:2]]))
+
+    balances = run(aget_balances_for_objects(orders))
+
+    assert balances == {
+        orders[0]: {ar_ledger: credit(AMOUNT), cash_ledger: debit(AMOUNT)},
+        orders[1]: {ar_ledger: credit(AMOUNT), cash_ledger: debit(AMOUNT)},
+        orders[2]: {},
+    }
+
+
+def test_calls_run_in_worker_threads(create_objects):
+    user, orders, ar_ledger, cash_ledger, add_transaction = create_objects
+    started = threading.Event()
+    released = threading.Event()
+
+    def block():
+        started.set()
+        return released.wait(timeout=10)
+
+    async def read_while_database_thread_is_busy():
+        busy = asyncio.ensure_future(sync_to_async(block)())
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        balances = await aget_balances_for_objects(orders)
+        released.set()
+        return balances, await busy
+
+    balances, released_in_time = run(read_while_database_thread_is_busy())
+    assert balances == {order: {} for order in orders}
+    assert released_in_time
+
+
+def test_ledger_statement(create_objects):
+    user, orders, ar_ledger, cash_ledger, add_transaction = create_objects
+    for order in orders + orders:
+        run(add_transaction(order))
+
+    async def read_statement(**kwargs):
+        return [line async for line in aledger_statement(ar_ledger, **kwargs)]
+
+    lines = run(read_statement(chunk_size=4))
+    assert lines == list(ledger_statement(ar_ledger))
+    assert len(lines) == 6
+    assert lines[-1].balance == credit(AMOUNT * 6)
+
+    assert run(read_statement(after=lines[-1].continuation_token)) == []
+
+    async def read_first_line():
+        async for line in aledger_statement(ar_ledger, chunk_size=2):
+            return line
+
+    assert run(read_first_line()) == lines[0]
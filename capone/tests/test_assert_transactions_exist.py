@@ -0,0 +1,210 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.queries import assert_transaction_in_ledgers_for_amounts_with_evidence  # noqa: E501
+from capone.api.queries import assert_transactions_exist
+from capone.models import Ledger
+from capone.models import LedgerEntry
+from capone.tests.factories import CreditCardTransactionFactory
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import TransactionFactory
+from capone.tests.factories import TransactionTypeFactory
+from capone.tests.factories import UserFactory
+from capone.tests.models import CreditCardTransaction
+from capone.tests.models import Order
+
+
+AMOUNT = Decimal('100')
+
+
+@pytest.fixture
+def create_objects():
+    user = UserFactory()
+    ttype = TransactionTypeFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    now = timezone.now()
+
+    def add_transaction(evidence, amount=AMOUNT, ledger=None):
+        return TransactionFactory(
+            user,
+            evidence=evidence,
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(amount)),
+                LedgerEntry(
+                    ledger=ledger or cash_ledger, amount=debit(amount)),
+            ],
+            notes='notes',
+            type=ttype,
+            posted_timestamp=now,
+        )
+
+    def expectation(evidence, amount=AMOUNT, ledger=None, **kwargs):
+        return dict(
+            ledger_amount_pairs=[
+                (ar_ledger.name, credit(amount)),
+                ((ledger or cash_ledger).name, debit(amount)),
+            ],
+            evidence=evidence,
+            **kwargs
+        )
+
+    return user, ttype, cash_ledger, now, add_transaction, expectation
+
+
+def test_assert_transactions_exist(
+        create_objects, django_assert_num_queries):
+    user, ttype, cash_ledger, now, add_transaction, expectation = (
+        create_objects)
+    orders = OrderFactory.create_batch(10)
+    credit_card_transaction = CreditCardTransactionFactory()
+    expectations = []
+    for n, order in enumerate(orders, start=1):
+        add_transaction([order], amount=Decimal(n))
+        expectations.append(expectation(
+            [order],
+            amount=Decimal(n),
+            notes='notes',
+            posted_timestamp=now,
+            type=ttype,
+            user=user,
+        ))
+    add_transaction([orders[0], credit_card_transaction])
+    expectations.append(expectation([orders[0], credit_card_transaction]))
+    add_transaction([])
+    expectations.append(expectation([]))
+
+    for kwargs in expectations:
+        assert_transaction_in_ledgers_for_amounts_with_evidence(**kwargs)
+
+    ContentType.objects.get_for_models(Order, CreditCardTransaction)
+    # The Ledgers are read once each, as they aren't cached until the
+    # test's transaction commits.
+    with django_assert_num_queries(3 + 2):
+        assert_transactions_exist(expectations)
+
+    with django_assert_num_queries(0):
+        assert_transactions_exist([])
+
+
+def test_assert_transactions_exist_reports_every_failure(create_objects):
+    user, ttype, cash_ledger, now, add_transaction, expectation = (
+        create_objects)
+    order_1, order_2, order_3, order_4, order_5 = OrderFactory.create_batch(5)
+    add_transaction([order_1])
+    add_transaction([order_2])
+    add_transaction([order_2])
+    wrong_amount = add_transaction([order_3])
+    wrong_fields = add_transaction([order_4])
+    add_transaction([order_5], ledger=LedgerFactory())
+    other_type = TransactionTypeFactory()
+    other_user = UserFactory()
+
+    with pytest.raises(AssertionError) as excinfo:
+        assert_transactions_exist([
+            expectation([order_1]),
+            expectation([order_2]),
+            expectation([order_3], amount=AMOUNT + 1),
+            expectation(
+                [order_4],
+                notes='other notes',
+                posted_timestamp=now - timedelta(days=1),
+                type=other_type,
+                user=other_user,
+            ),
+            expectation([order_5]),
+            expectation([order_1, order_2]),
+            expectation([]),
+        ])
+
+    failures = str(excinfo.value).split('\n')
+    assert len(failures) == 9
+    assert failures[0].startswith('Expectation #1 ')
+    assert failures[0].endswith(': 2 matching Transactions')
+
+    assert failures[1].startswith('Expectation #2 ')
+    assert 'Transaction {} has entries ['.format(
+        wrong_amount.transaction_id) in failures[1]
+    assert "Decimal('-100.0000')" in failures[1].split(' has entries ')[1]
+
+    assert all(
+        failure.startswith('Expectation #3 ') for failure in failures[2:6])
+    assert [failure.split(' has ')[1] for failure in failures[2:6]] == [
+        "notes 'notes', not 'other notes'",
+        "posted_timestamp {!r}, not {!r}".format(
+            wrong_fields.posted_timestamp, now - timedelta(days=1)),
+        "type_id {}, not {}".format(ttype.id, other_type.id),
+        "created_by_id {}, not {}".format(user.id, other_user.id),
+    ]
+
+    assert [failure.split(' (')[0] for failure in failures[6:]] == [
+        'Expectation #4',
+        'Expectation #5',
+        'Expectation #6',
+    ]
+    assert all(
+        failure.endswith(': 0 matching Transactions')
+        for failure in failures[6:]
+    )
+
+
+def test_assert_transactions_exist_ledgers(create_objects):
+    """
+    Test expectations with Ledgers given as Ledgers, names, and numbers.
+    """
+    user, ttype, cash_ledger, now, add_transaction, expectation = (
+        create_objects)
+    orders = OrderFactory.create_batch(3)
+    for order in orders:
+        add_transaction([order])
+    by_name = expectation([orders[0]])
+    ar_ledger = Ledger.objects.get(name=by_name['ledger_amount_pairs'][0][0])
+
+    assert_transactions_exist([
+        by_name,
+        dict(
+            ledger_amount_pairs=[
+                (cash_ledger, debit(AMOUNT)),
+                (ar_ledger, credit(AMOUNT)),
+            ],
+            evidence=[orders[1]],
+        ),
+        dict(
+            ledger_amount_pairs=[
+                (ar_ledger.number, credit(AMOUNT)),
+                (cash_ledger.name, debit(AMOUNT)),
+            ],
+            evidence=[orders[2]],
+        ),
+    ])
+
+    with pytest.raises(AssertionError) as excinfo:
+        assert_transactions_exist([
+            dict(
+                ledger_amount_pairs=[
+                    (ar_ledger, credit(AMOUNT)),
+                    ('no such ledger', debit(AMOUNT)),
+                ],
+                evidence=[orders[0]],
+            ),
+            dict(
+                ledger_amount_pairs=[
+                    (ar_ledger, credit(AMOUNT)),
+                    (cash_ledger, debit(AMOUNT + 1)),
+                ],
+                evidence=[orders[0]],
+            ),
+        ])
+    failures = str(excinfo.value).split('\n')
+    assert failures[0].startswith('Expectation #0 ')
+    assert failures[0].endswith(': Ledger does not exist')
+    assert failures[1].startswith('Expectation #1 ')
+    assert ' has entries [({}, '.format(
+        min(ar_ledger.id, cash_ledger.id)) in failures[1]
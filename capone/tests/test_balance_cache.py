@@ -0,0 +1,263 @@
+from decimal import Decimal
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db.transaction import atomic
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.api.queries import get_balances_for_object
+from capone import cache as cache_module
+from capone.api.queries import get_balances_for_objects
+from capone.cache import cached_balance
+from capone.cache import cached_balances
+from capone.cache import ledger_balance_cache_key
+from capone.cache import object_balances_cache_key
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+from capone.utils import rebuild_ledger_balances
+
+
+"""
+Test the optional balance cache in `capone.cache`.
+"""
+
+AMOUNT = Decimal('50.00')
+
+
+class Rollback(Exception):
+    pass
+
+
+@pytest.fixture
+def balance_cache(settings):
+    settings.CAPONE_BALANCE_CACHE = 'default'
+    cache = caches['default']
+    cache.clear()
+    # The transaction of the previous test may have posted before it was
+    # rolled back.
+    cache_module._pending.invalidations = False
+    yield cache
+    cache.clear()
+
+
+@pytest.fixture
+def create_objects():
+    order = OrderFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    user = UserFactory()
+
+    def add_transaction():
+        return create_transaction(
+            user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(AMOUNT)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(AMOUNT)),
+            ],
+        )
+
+    return order, ar_ledger, cash_ledger, user, add_transaction
+
+
+def order_key(order):
+    return object_balances_cache_key(
+        ContentType.objects.get_for_model(order).id, order.id)
+
+
+def test_cache_disabled_by_default(create_objects):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    add_transaction()
+    cache = caches['default']
+    cache.clear()
+
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+
+    assert cache.get(order_key(order)) is None
+    assert cache.get(ledger_balance_cache_key(ar_ledger.id)) is None
+
+
+def test_cached_reads(
+        balance_cache,
+        create_objects,
+        django_assert_num_queries,
+        transactional_db):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    add_transaction()
+    other_order = OrderFactory()
+
+    ContentType.objects.get_for_model(order)
+    with django_assert_num_queries(1):
+        assert get_balances_for_object(order) == {
+            ar_ledger: credit(AMOUNT),
+            cash_ledger: debit(AMOUNT),
+        }
+    with django_assert_num_queries(1):
+        assert ar_ledger.get_balance() == credit(AMOUNT)
+    with django_assert_num_queries(1):
+        assert get_balances_for_object(other_order) == {}
+
+    with django_assert_num_queries(0):
+        balances = get_balances_for_object(order)
+        assert balances == {
+            ar_ledger: credit(AMOUNT),
+            cash_ledger: debit(AMOUNT),
+        }
+        assert balances[LedgerFactory.build(id=0)] == Decimal(0)
+        assert get_balances_for_object(order) == {
+            ar_ledger: credit(AMOUNT),
+            cash_ledger: debit(AMOUNT),
+        }
+        assert ar_ledger.get_balance() == credit(AMOUNT)
+        assert get_balances_for_object(other_order) == {}
+
+
+def test_cached_batch_reads(
+        balance_cache,
+        create_objects,
+        django_assert_num_queries,
+        transactional_db):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    add_transaction()
+    other_order, new_order = OrderFactory.create_batch(2)
+    get_balances_for_object(other_order)
+
+    ContentType.objects.get_for_model(order)
+    with django_assert_num_queries(1):
+        assert get_balances_for_objects([order, other_order]) == {
+            order: {ar_ledger: credit(AMOUNT), cash_ledger: debit(AMOUNT)},
+            other_order: {},
+        }
+    assert balance_cache.get(order_key(order)) is not None
+
+    # Only the balances missing from the cache are read.
+    with django_assert_num_queries(1):
+        assert get_balances_for_objects([order, new_order]) == {
+            order: {ar_ledger: credit(AMOUNT), cash_ledger: debit(AMOUNT)},
+            new_order: {},
+        }
+    with django_assert_num_queries(0):
+        assert get_balances_for_objects([order, other_order, new_order]) == {
+            order: {ar_ledger: credit(AMOUNT), cash_ledger: debit(AMOUNT)},
+            other_order: {},
+            new_order: {},
+        }
+
+
+def test_uncommitted_postings_bypass_cache(balance_cache, create_objects):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    assert get_balances_for_object(order) == {}
+    assert ar_ledger.get_balance() == 0
+
+    add_transaction()
+
+    assert get_balances_for_object(order) == {
+        ar_ledger: credit(AMOUNT),
+        cash_ledger: debit(AMOUNT),
+    }
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+    assert balance_cache.get(order_key(order))[1] == []
+    assert balance_cache.get(ledger_balance_cache_key(ar_ledger.id))[1] == 0
+
+
+def test_commit_invalidates_cache(
+        balance_cache, create_objects, transactional_db):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    transaction = add_transaction()
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+    assert cash_ledger.get_balance() == debit(AMOUNT)
+
+    add_transaction()
+    assert balance_cache.get(order_key(order)) is None
+    assert balance_cache.get(ledger_balance_cache_key(ar_ledger.id)) is None
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT) * 2
+    assert ar_ledger.get_balance() == credit(AMOUNT) * 2
+
+    void_transaction(transaction, user)
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+    assert cash_ledger.get_balance() == debit(AMOUNT)
+
+
+def test_rollback_does_not_poison_cache(
+        balance_cache,
+        create_objects,
+        django_assert_num_queries,
+        transactional_db):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    add_transaction()
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+
+    with pytest.raises(Rollback):
+        with atomic():
+            add_transaction()
+            assert (
+                get_balances_for_object(order)[ar_ledger]
+                == credit(AMOUNT) * 2
+            )
+            assert ar_ledger.get_balance() == credit(AMOUNT) * 2
+            raise Rollback
+
+    with atomic():
+        with pytest.raises(Rollback):
+            with atomic():
+                add_transaction()
+                raise Rollback
+        # The savepoint with the posting was rolled back, so the cached
+        # balances are still right, though this transaction doesn't use them.
+        assert balance_cache.get(order_key(order)) is not None
+        assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+
+    with pytest.raises(Rollback):
+        with atomic():
+            add_transaction()
+            raise Rollback
+    # A transaction that hasn't written anything uses the cache again.
+    with atomic():
+        with django_assert_num_queries(1):
+            assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+
+
+def test_rebuild_clears_cache(
+        balance_cache, create_objects, transactional_db):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    add_transaction()
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+
+    LedgerBalance.objects.update(balance=Decimal('1.00'))
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+
+    rebuild_ledger_balances()
+    assert balance_cache.get(order_key(order)) is None
+    assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+
+
+def test_invalidation_during_read(
+        balance_cache, create_objects, transactional_db):
+    order, ar_ledger, cash_ledger, user, add_transaction = create_objects
+    key = ledger_balance_cache_key(ar_ledger.id)
+
+    def read_then_post(keys):
+        balance = ar_ledger.get_balance()
+        add_transaction()
+        return {key: balance}
+
+    # The balance read before the posting is stored after its invalidation,
+    # but with the generation that the invalidation replaced.
+    assert cached_balances([key], read_then_post) == {key: Decimal(0)}
+    assert balance_cache.get(key) is not None
+    assert cached_balance(key, ar_ledger.get_balance) == credit(AMOUNT)
+    assert cached_balance(key, lambda: None) == credit(AMOUNT)
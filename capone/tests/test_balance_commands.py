@@ -0,0 +1,220 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections
+from django.db.models import F
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+from capone.utils import rebuild_ledger_balances
+from capone.utils import repair_ledger_balances
+from capone.utils import verify_ledger_balances
+
+
+"""
+Test the `capone_rebuild_balances`, `capone_verify_balances`, and
+`capone_audit` management commands.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def create_objects():
+    user = UserFactory()
+    orders = OrderFactory.create_batch(2)
+    ledgers = LedgerFactory.create_batch(3)
+    transactions = [
+        create_transaction(
+            user,
+            evidence=orders[:i + 1],
+            ledger_entries=[
+                (ledgers[i], credit(AMOUNT)),
+                (ledgers[i + 1], debit(AMOUNT)),
+            ],
+        )
+        for i in range(2)
+    ]
+    void_transaction(transactions[0], user)
+    return orders, ledgers, transactions
+
+
+def corrupt_balances(ledger):
+    LedgerBalance.objects.filter(ledger=ledger).update(
+        balance=F('balance') + 1)
+    return len(verify_ledger_balances())
+
+
+def run(command, *args):
+    stdout = StringIO()
+    stderr = StringIO()
+    try:
+        call_command(command, *args, stdout=stdout, stderr=stderr)
+    except CommandError as e:
+        error = str(e)
+    else:
+        error = None
+    return stdout.getvalue().splitlines(), stderr.getvalue(), error
+
+
+def test_repair_ledger_balances(create_objects):
+    orders, ledgers, transactions = create_objects
+    corrupt_balances(ledgers[1])
+    LedgerBalance.objects.filter(ledger=ledgers[2]).delete()
+    drift = verify_ledger_balances()
+    assert len(drift) == 4
+    assert verify_ledger_balances([ledgers[2].id]) == drift[2:]
+
+    assert repair_ledger_balances(
+        [ledgers[1].id], dry_run=True) == drift[:2]
+    assert verify_ledger_balances() == drift
+
+    assert repair_ledger_balances([ledgers[1].id]) == drift[:2]
+    assert verify_ledger_balances() == drift[2:]
+    assert repair_ledger_balances([ledgers[0].id]) == []
+    assert repair_ledger_balances([ledgers[2].id]) == drift[2:]
+    assert verify_ledger_balances() == []
+
+
+def test_verify_balances(create_objects):
+    orders, ledgers, transactions = create_objects
+    output, errors, error = run(
+        'capone_verify_balances', '--chunk-size', '2')
+    assert output == [
+        'Chunk 1 of 2: 2 of 3 ledgers ' + output[0].split('ledgers ')[1],
+        'Chunk 2 of 2: 3 of 3 ledgers ' + output[1].split('ledgers ')[1],
+        'Found 0 wrong ledger balance(s).',
+    ]
+    assert error is None
+
+    corrupt_balances(ledgers[2])
+    output, errors, error = run('capone_verify_balances')
+    assert output[1:] == [
+        'Ledger {}, object {}:{}: recorded {}, actual {}.'.format(
+            ledgers[2].id, balance.related_object_content_type_id,
+            balance.related_object_id, balance.balance,
+            balance.balance - 1)
+        for balance in LedgerBalance.objects.filter(
+            ledger=ledgers[2]).order_by('related_object_id')
+    ] + ['Found 2 wrong ledger balance(s).']
+    assert error == '2 wrong ledger balance(s) and 0 failed chunk(s).'
+
+
+def test_rebuild_balances(create_objects):
+    orders, ledgers, transactions = create_objects
+    corrupt_balances(ledgers[0])
+    corrupt_balances(ledgers[2])
+
+    output, errors, error = run('capone_rebuild_balances', '--dry-run')
+    assert output[-1] == 'Would correct 3 ledger balance(s).'
+    assert error == '3 wrong ledger balance(s) and 0 failed chunk(s).'
+    assert len(verify_ledger_balances()) == 3
+
+    output, errors, error = run(
+        'capone_rebuild_balances', '--chunk-size', '1',
+        '--statement-timeout', '1min', '--lock-timeout', '1s')
+    assert len(output) == 3 + 3 + 1
+    assert output[-1] == 'Corrected 3 ledger balance(s).'
+    assert error is None
+    assert verify_ledger_balances() == []
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'replica'])
+def test_rebuild_balances_lock_timeout(transactional_db, create_objects):
+    orders, ledgers, transactions = create_objects
+    corrupt_balances(ledgers[0])
+    corrupt_balances(ledgers[2])
+
+    # Another connection holds the lock on a Ledger.
+    replica = connections['replica']
+    replica.set_autocommit(False)
+    try:
+        with replica.cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM capone_ledger WHERE id = %s FOR UPDATE',
+                [ledgers[0].id])
+        output, errors, error = run(
+            'capone_rebuild_balances', '--chunk-size', '1',
+            '--lock-timeout', '100ms')
+    finally:
+        replica.rollback()
+        replica.set_autocommit(True)
+        replica.close()
+
+    assert errors.startswith('Chunk 1 of 3 failed: canceling statement due '
+                             'to lock timeout')
+    assert output[-1] == 'Corrected 2 ledger balance(s).'
+    assert error == '2 wrong ledger balance(s) and 1 failed chunk(s).'
+    assert [row.ledger_id for row in verify_ledger_balances()] == [
+        ledgers[0].id]
+
+
+def test_audit(create_objects):
+    orders, ledgers, transactions = create_objects
+    output, errors, error = run(
+        'capone_audit', '--transaction-chunk-size', '2')
+    assert output[0] == 'Checking transactions.'
+    assert output[1].startswith('Chunk 1 of 2: 2 of 3 transaction ids ')
+    assert output[3] == 'Checking ledger balances.'
+    assert output[-1] == 'Found 0 problem(s).'
+    assert error is None
+
+    unbalanced = transactions[1]
+    LedgerEntry.objects.filter(
+        transaction=unbalanced, ledger=ledgers[1],
+    ).update(amount=credit(AMOUNT * 2))
+    Transaction.objects.filter(id=transactions[0].id).update(
+        is_voided=False)
+    entry = unbalanced.entries.first()
+    LedgerEntry.objects.filter(id=entry.id).update(
+        posted_timestamp=entry.posted_timestamp - timedelta(days=1))
+
+    output, errors, error = run('capone_audit')
+    assert "Transaction {} doesn't balance: its entries total {}.".format(
+        unbalanced.id, credit(Decimal('100.0000'))) in output
+    assert 'Transaction {} has the wrong void flags.'.format(
+        transactions[0].id) in output
+    assert 'LedgerEntry {} has the wrong posted_timestamp.'.format(
+        entry.id) in output
+    assert output[-1] == 'Found 5 problem(s).'
+    assert error == '5 problem(s) and 0 failed chunk(s).'
+
+
+def test_audit_empty():
+    output, errors, error = run('capone_audit')
+    assert output == [
+        'Checking transactions.',
+        'Checking ledger balances.',
+        'Found 0 problem(s).',
+    ]
+    assert error is None
+
+
+def test_rebuild_without_evidence(transactional_db, create_objects):
+    orders, ledgers, transactions = create_objects
+    create_transaction(
+        UserFactory(),
+        ledger_entries=[
+            (ledgers[0], credit(AMOUNT)),
+            (ledgers[1], debit(AMOUNT)),
+        ],
+    )
+    balances = set(LedgerBalance.objects.values_list(
+        'ledger', 'related_object_id', 'balance'))
+
+    rebuild_ledger_balances()
+
+    assert set(LedgerBalance.objects.values_list(
+        'ledger', 'related_object_id', 'balance')) == balances
@@ -0,0 +1,252 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils import timezone
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.columnar import balance_columns
+from capone.columnar import balance_matrix
+from capone.columnar import column_errors
+from capone.columnar import entry_columns
+from capone.columnar import validate_columns
+from capone.exceptions import NoLedgerEntriesException
+from capone.exceptions import TransactionBalanceException
+from capone.models import Ledger
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.tests.factories import CreditCardTransactionFactory
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+from capone.tests.models import Order
+
+
+"""
+Test validating and reading columns of postings with NumPy.
+"""
+
+
+def as_lists(validation):
+    return [column.tolist() for column in validation]
+
+
+def test_validate_columns(db):
+    ledgers = LedgerFactory.create_batch(2)
+    unknown = max(ledger.id for ledger in ledgers) + 1
+    transactions = [0, 0, 2, 2, 3, 3, 4, 4, 4, 5, 5]
+    ledger_ids = [ledgers[0].id, ledgers[1].id] * 4 + [
+        unknown, ledgers[0].id, -1]
+    amounts = [-100, 100, -100, 50, 7, -7, 1, 2, -3, 5, -5]
+
+    validation = validate_columns(
+        transactions, ledger_ids, amounts, count=7)
+
+    assert as_lists(validation) == [
+        [2], [-50], [1, 6], [4, 5], [1, 2, 4, 5, 6]]
+    errors = column_errors(validation)
+    assert [index for index, _ in errors] == [1, 2, 4, 5, 6]
+    assert [type(error) for _, error in errors] == [
+        NoLedgerEntriesException,
+        TransactionBalanceException,
+        Ledger.DoesNotExist,
+        Ledger.DoesNotExist,
+        NoLedgerEntriesException,
+    ]
+    assert str(errors[1][1]) == (
+        "Credits do not equal debits. Mis-match of -0.0050.")
+    assert str(errors[0][1]) == "Transaction has no entries."
+    assert str(errors[2][1]) == "Transaction has entries in unknown Ledgers."
+    assert str(column_errors(validation, decimal_places=2)[1][1]) == (
+        "Credits do not equal debits. Mis-match of -0.50.")
+
+
+def test_validate_unsorted_columns():
+    order = [4, 0, 3, 1, 2]
+    transactions = np.array([0, 0, 1, 1, 2])[order]
+    amounts = np.array([1, -1, 10 ** 15, 1, -2])[order]
+
+    validation = validate_columns(
+        transactions, [1] * 5, amounts, known_ledger_ids=[1])
+
+    assert as_lists(validation) == [
+        [1, 2], [10 ** 15 + 1, -2], [], [], [1, 2]]
+    assert str(column_errors(validation)[0][1]) == (
+        "Credits do not equal debits. Mis-match of %s."
+        % Decimal('100000000000.0001'))
+
+
+def test_validate_columns_with_sparse_ledger_ids():
+    # A table of every id up to the largest would take a terabyte.
+    known = [7, 2 ** 40, 2 ** 40 + 5]
+
+    validation = validate_columns(
+        [0, 0, 1, 1, 2, 2],
+        [2 ** 40, 7, 2 ** 40 + 1, 7, -1, 2 ** 40 + 5],
+        [1, -1, 1, -1, 1, -1],
+        known_ledger_ids=known,
+    )
+
+    assert validation.unknown_ledgers.tolist() == [1, 2]
+
+
+def test_validate_empty_columns():
+    assert as_lists(validate_columns([], [], [], known_ledger_ids=[])) == [
+        [], [], [], [], []]
+    assert as_lists(
+        validate_columns([], [], [], count=2, known_ledger_ids=[])
+    ) == [[], [], [0, 1], [], [0, 1]]
+
+
+@pytest.mark.parametrize('columns, count, error', [
+    (([0, 1], [1], [0]), None, "The columns must have the same length."),
+    (([0, 2], [1, 1], [0, 0]), 2, "Transaction indexes must be from 0 to 1."),
+    (([-1], [1], [0]), None, "Transaction indexes must be from 0 to -1."),
+])
+def test_validate_columns_errors(columns, count, error):
+    with pytest.raises(ValueError) as e:
+        validate_columns(*columns, count=count, known_ledger_ids=[1])
+    assert str(e.value) == error
+
+
+@pytest.fixture
+def create_objects(db):
+    user = UserFactory()
+    orders = OrderFactory.create_batch(3)
+    card = CreditCardTransactionFactory()
+    ledgers = LedgerFactory.create_batch(3)
+    now = timezone.now()
+    transactions = [
+        create_transaction(
+            user,
+            evidence=[orders[i], card],
+            ledger_entries=[
+                (ledgers[0], credit(Decimal('1.2345') * (i + 1))),
+                (ledgers[i % 2 + 1], debit(Decimal('1.2345') * (i + 1))),
+            ],
+            posted_timestamp=now - timedelta(days=i, microseconds=i),
+        )
+        for i in range(3)
+    ]
+    return orders, card, ledgers, transactions, now
+
+
+def utc_datetime64(timestamp):
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return np.datetime64(
+        timezone.make_naive(timestamp, timezone.utc), 'us')
+
+
+def test_entry_columns(create_objects):
+    orders, card, ledgers, transactions, now = create_objects
+
+    columns = entry_columns(chunk_size=4)
+
+    assert list(columns) == [
+        'id', 'transaction_id', 'ledger_id', 'amount', 'posted_timestamp']
+    assert {column.dtype.name for column in columns.values()} == {
+        'int64', 'datetime64[us]'}
+    entries = LedgerEntry.objects.order_by('id')
+    assert columns['id'].tolist() == [entry.id for entry in entries]
+    assert columns['transaction_id'].tolist() == [
+        entry.transaction_id for entry in entries]
+    assert columns['ledger_id'].tolist() == [
+        entry.ledger_id for entry in entries]
+    assert columns['amount'].tolist() == [
+        int(entry.amount * 10000) for entry in entries]
+    assert columns['posted_timestamp'].tolist() == [
+        utc_datetime64(entry.posted_timestamp).tolist() for entry in entries]
+
+
+def test_entry_columns_without_timestamps(create_objects):
+    orders, card, ledgers, transactions, now = create_objects
+    # Entries could be written without a timestamp before migration 0005.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SET CONSTRAINTS ALL IMMEDIATE; '
+            'ALTER TABLE capone_ledgerentry '
+            'ALTER COLUMN posted_timestamp DROP NOT NULL')
+    entry = transactions[1].entries.first()
+    LedgerEntry.objects.filter(id=entry.id).update(posted_timestamp=None)
+
+    columns = entry_columns(chunk_size=4)
+
+    assert np.isnat(columns['posted_timestamp']).tolist() == [
+        entry_id == entry.id for entry_id in columns['id'].tolist()]
+    assert columns['amount'].tolist() == [
+        int(entry.amount * 10000)
+        for entry in LedgerEntry.objects.order_by('id')
+    ]
+
+
+def test_entry_columns_filters(create_objects):
+    orders, card, ledgers, transactions, now = create_objects
+
+    columns = entry_columns(ledger_ids=[ledgers[1].id], decimal_places=2)
+    assert columns['transaction_id'].tolist() == [
+        transactions[0].id, transactions[2].id]
+    assert columns['amount'].tolist() == [123, 370]
+
+    columns = entry_columns(
+        since=now - timedelta(days=2), until=now - timedelta(hours=1))
+    assert set(columns['transaction_id'].tolist()) == {transactions[1].id}
+    columns = entry_columns(
+        first_id=transactions[1].id, last_id=transactions[1].id)
+    assert set(columns['transaction_id'].tolist()) == {transactions[1].id}
+
+    columns = entry_columns(ledger_ids=[])
+    assert [column.tolist() for column in columns.values()] == [[]] * 5
+    assert columns['posted_timestamp'].dtype.name == 'datetime64[us]'
+
+
+def test_balance_columns(create_objects):
+    orders, card, ledgers, transactions, now = create_objects
+
+    columns = balance_columns(chunk_size=2)
+    assert list(columns) == [
+        'ledger_id', 'content_type_id', 'object_id', 'balance']
+    assert list(zip(*(column.tolist() for column in columns.values()))) == [
+        (
+            balance.ledger_id,
+            balance.related_object_content_type_id,
+            balance.related_object_id,
+            int(balance.balance * 10000),
+        )
+        for balance in LedgerBalance.objects.order_by('id')
+    ]
+
+    order_type = ContentType.objects.get_for_model(Order)
+    columns = balance_columns(
+        ledger_ids=[ledgers[0].id], content_type=order_type)
+    assert columns['object_id'].tolist() == [order.id for order in orders]
+    assert columns['balance'].tolist() == [-12345, -24690, -37035]
+    assert balance_columns(content_type=Order)['object_id'].size == 6
+
+
+def test_balance_matrix(create_objects):
+    orders, card, ledgers, transactions, now = create_objects
+
+    matrix = balance_matrix(Order)
+    assert matrix.object_ids.tolist() == [order.id for order in orders]
+    assert matrix.ledger_ids.tolist() == [ledger.id for ledger in ledgers]
+    assert matrix.balances.tolist() == [
+        [-12345, 12345, 0],
+        [-24690, 0, 24690],
+        [-37035, 37035, 0],
+    ]
+
+    matrix = balance_matrix(
+        type(card), ledger_ids=[ledgers[2].id, ledgers[1].id],
+        decimal_places=0)
+    assert matrix.object_ids.tolist() == [card.id]
+    assert matrix.ledger_ids.tolist() == [ledgers[1].id, ledgers[2].id]
+    assert matrix.balances.tolist() == [[5, 2]]
+
+    matrix = balance_matrix(Ledger)
+    assert matrix.balances.shape == (0, 0)
@@ -1,11 +1,13 @@
 from decimal import Decimal as D
 
 import pytest
+from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 
 from capone.exceptions import ExistingLedgerEntriesException
 from capone.exceptions import NoLedgerEntriesException
 from capone.exceptions import TransactionBalanceException
+from capone.models import LedgerBalance
 from capone.models import LedgerEntry
 from capone.models import Transaction
 from capone.api.actions import create_transaction
@@ -183,6 +185,78 @@ def test_setting_posted_timestamp(create_objects):
     assert txn_recognize.posted_timestamp == POSTED_DATETIME
 
 
+def test_create_transaction_round_trips(
+        create_objects, django_assert_num_queries):
+    """
+    Test that a posting is written with one statement after validation.
+    """
+    (
+        user,
+        accounts_receivable,
+        cash_unrecon,
+        cash_recon,
+        revenue,
+        recon_ttype,
+    ) = create_objects
+    order = OrderFactory(amount=AMOUNT)
+    credit_card_transaction = CreditCardTransactionFactory()
+    ledger_entries = [
+        LedgerEntry(ledger=revenue, amount=credit(AMOUNT)),
+        LedgerEntry(ledger=accounts_receivable, amount=debit(D(40))),
+        LedgerEntry(ledger=accounts_receivable, amount=debit(D(60))),
+    ]
+    ContentType.objects.get_for_models(
+        type(order), type(credit_card_transaction))
+
+    # The other two queries are the savepoint of `atomic`.
+    with django_assert_num_queries(3):
+        transaction = create_transaction(
+            user,
+            evidence=[order, credit_card_transaction],
+            ledger_entries=ledger_entries,
+            type=recon_ttype,
+            posted_timestamp=timezone.now(),
+        )
+
+    saved = Transaction.objects.get(id=transaction.id)
+    for field in Transaction._meta.concrete_fields:
+        assert (
+            getattr(saved, field.attname)
+            == getattr(transaction, field.attname)
+        )
+    assert not transaction._state.adding
+    assert set(saved.entries.all()) == set(ledger_entries)
+    for ledger_entry in ledger_entries:
+        assert not ledger_entry._state.adding
+        assert ledger_entry.transaction == transaction
+        assert ledger_entry.transaction_id == transaction.id
+        assert ledger_entry.posted_timestamp == transaction.posted_timestamp
+
+    assert {
+        tro.related_object for tro in saved.related_objects.all()
+    } == {order, credit_card_transaction}
+    for evidence in [order, credit_card_transaction]:
+        assert get_balances_for_object(evidence) == {
+            revenue: credit(AMOUNT),
+            accounts_receivable: debit(AMOUNT),
+        }
+
+    create_transaction(
+        user,
+        evidence=[order],
+        ledger_entries=[
+            LedgerEntry(ledger=revenue, amount=debit(AMOUNT)),
+            LedgerEntry(ledger=cash_recon, amount=credit(AMOUNT)),
+        ],
+    )
+    assert get_balances_for_object(order) == {
+        revenue: D(0),
+        accounts_receivable: debit(AMOUNT),
+        cash_recon: credit(AMOUNT),
+    }
+    assert LedgerBalance.objects.count() == 5
+
+
 def test_debits_not_equal_to_credits(create_objects):
     (
         user,
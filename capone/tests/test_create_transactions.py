@@ -0,0 +1,89 @@
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError
+
+from capone.api.actions import create_transactions
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.queries import get_balances_for_object
+from capone.exceptions import IdempotencyKeyReusedException
+from capone.exceptions import TransactionBalanceException
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import TransactionTypeFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test posting batches of Transactions with `create_transactions`.
+"""
+
+AMOUNT = Decimal(100)
+
+
+def test_create_transactions(django_assert_num_queries):
+    user = UserFactory()
+    ttype = TransactionTypeFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    revenue_ledger = LedgerFactory()
+    orders = OrderFactory.create_batch(5)
+    ContentType.objects.get_for_model(orders[0])
+    missing_user = UserFactory.build(id=0)
+
+    def posting(order, ledger, amount=AMOUNT, user=user, **kwargs):
+        return dict(
+            user=user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(AMOUNT)),
+                LedgerEntry(ledger=ledger, amount=debit(amount)),
+            ],
+            type=ttype,
+            **kwargs
+        )
+
+    postings = [
+        posting(orders[0], cash_ledger),
+        posting(orders[1], revenue_ledger, idempotency_key='order-1'),
+        posting(orders[2], cash_ledger, amount=AMOUNT + 1),
+        posting(orders[3], cash_ledger, notes=None),
+        posting(orders[4], revenue_ledger),
+        posting(orders[1], revenue_ledger, idempotency_key='order-1'),
+        posting(orders[0], cash_ledger, user=missing_user),
+        posting(orders[1], cash_ledger, idempotency_key='order-1'),
+    ]
+
+    # The outer savepoint, checking constraints and locking the Ledgers, a
+    # savepoint and a write for each valid posting, rolling back the three
+    # that fail, looking up the Transaction, entries, and evidence of each
+    # repeated posting, and deferring constraints again in the test's
+    # transaction.
+    with django_assert_num_queries(2 + 1 + 3 * 7 + 3 + 3 * 2 + 1):
+        results = create_transactions(postings)
+
+    assert [result.exception is None for result in results] == [
+        True, True, False, False, True, True, False, False]
+    assert isinstance(results[2].exception, TransactionBalanceException)
+    assert isinstance(results[3].exception, IntegrityError)
+    assert isinstance(results[6].exception, IntegrityError)
+    assert isinstance(
+        results[7].exception, IdempotencyKeyReusedException)
+    assert results[5].transaction == results[1].transaction
+
+    assert set(Transaction.objects.all()) == {
+        results[0].transaction,
+        results[1].transaction,
+        results[4].transaction,
+    }
+    assert ar_ledger.get_balance() == credit(AMOUNT) * 3
+    assert get_balances_for_object(orders[1]) == {
+        ar_ledger: credit(AMOUNT),
+        revenue_ledger: debit(AMOUNT),
+    }
+    assert get_balances_for_object(orders[3]) == {}
+
+    assert create_transactions([]) == []
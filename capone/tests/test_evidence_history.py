@@ -0,0 +1,158 @@
+from datetime import timedelta
+from decimal import Decimal as D
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.queries import evidence_history
+from capone.api.queries import get_balances_for_object
+from capone.models import LedgerEntry
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test `evidence_history`.
+"""
+
+
+@pytest.fixture
+def create_objects():
+    user = UserFactory()
+    ar_ledger = LedgerFactory()
+    revenue_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    order, other_order = OrderFactory.create_batch(2)
+    now = timezone.now()
+
+    def add_transaction(evidence, days_ago, ledger_entries=None):
+        if ledger_entries is None:
+            ledger_entries = [
+                LedgerEntry(ledger=ar_ledger, amount=debit(D(100))),
+                LedgerEntry(ledger=revenue_ledger, amount=credit(D(100))),
+            ]
+        return create_transaction(
+            user,
+            evidence=evidence,
+            ledger_entries=ledger_entries,
+            posted_timestamp=now - timedelta(days=days_ago),
+        )
+
+    return (
+        ar_ledger,
+        revenue_ledger,
+        cash_ledger,
+        order,
+        other_order,
+        add_transaction,
+    )
+
+
+def test_evidence_history(create_objects, django_assert_num_queries):
+    (
+        ar_ledger,
+        revenue_ledger,
+        cash_ledger,
+        order,
+        other_order,
+        add_transaction,
+    ) = create_objects
+    payment = add_transaction(
+        [order, other_order],
+        days_ago=1,
+        ledger_entries=[
+            LedgerEntry(ledger=cash_ledger, amount=debit(D(60))),
+            LedgerEntry(ledger=ar_ledger, amount=credit(D(50))),
+            LedgerEntry(ledger=ar_ledger, amount=credit(D(10))),
+        ],
+    )
+    charge = add_transaction([order], days_ago=2)
+    add_transaction([other_order], days_ago=3)
+    # Same posted_timestamp as `payment`: ties are broken by id.
+    adjustment = add_transaction([order], days_ago=1)
+
+    ContentType.objects.get_for_model(order)
+    with django_assert_num_queries(2):
+        page = evidence_history(order)
+
+    assert page.next_cursor is None
+    assert [item.transaction for item in page.items] == [
+        charge, payment, adjustment]
+
+    charge_item, payment_item, adjustment_item = page.items
+    with django_assert_num_queries(0):
+        assert sorted(
+            (entry.ledger.name, entry.amount)
+            for entry in payment_item.entries
+        ) == sorted([
+            (cash_ledger.name, debit(D(60))),
+            (ar_ledger.name, credit(D(50))),
+            (ar_ledger.name, credit(D(10))),
+        ])
+        assert payment_item.balance_deltas == {
+            cash_ledger: debit(D(60)),
+            ar_ledger: credit(D(60)),
+        }
+        assert charge_item.balance_deltas == {
+            ar_ledger: debit(D(100)),
+            revenue_ledger: credit(D(100)),
+        }
+        assert payment_item.balance_deltas[revenue_ledger] == D(0)
+
+    total = {}
+    for item in page.items:
+        for ledger, delta in item.balance_deltas.items():
+            total[ledger] = total.get(ledger, D(0)) + delta
+    assert total == get_balances_for_object(order)
+
+
+def test_evidence_history_pagination(
+        create_objects, django_assert_num_queries):
+    (
+        ar_ledger,
+        revenue_ledger,
+        cash_ledger,
+        order,
+        other_order,
+        add_transaction,
+    ) = create_objects
+    transactions = [
+        add_transaction([order], days_ago=days_ago)
+        for days_ago in [5, 1, 3, 3, 2, 4, 0]
+    ]
+    add_transaction([other_order], days_ago=2)
+    expected = sorted(
+        transactions, key=lambda t: (t.posted_timestamp, t.id))
+
+    seen = []
+    cursor = None
+    ContentType.objects.get_for_model(order)
+    while True:
+        with django_assert_num_queries(2):
+            page = evidence_history(order, after=cursor, limit=3)
+        assert len(page.items) <= 3
+        seen.extend(item.transaction for item in page.items)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert seen == expected
+
+
+def test_evidence_history_empty(create_objects):
+    (
+        ar_ledger,
+        revenue_ledger,
+        cash_ledger,
+        order,
+        other_order,
+        add_transaction,
+    ) = create_objects
+    add_transaction([other_order], days_ago=0)
+
+    assert evidence_history(order) == ([], None)
@@ -0,0 +1,286 @@
+import csv
+import io
+import os
+import threading
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.transaction import atomic
+from django.db.transaction import TransactionManagementError
+from django.utils import timezone
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.export import export_tables
+from capone.export import TABLES
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.models import TransactionRelatedObject
+from capone.pgcopy import copy_query
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test exporting `capone`'s tables with COPY.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def create_objects(transactional_db):
+    user = UserFactory()
+    orders = OrderFactory.create_batch(2)
+    ledgers = LedgerFactory.create_batch(2)
+    now = timezone.now()
+
+    def post(days_ago=0, evidence=orders[:1]):
+        return create_transaction(
+            user,
+            evidence=evidence,
+            ledger_entries=[
+                (ledgers[0], credit(AMOUNT)),
+                (ledgers[1], debit(AMOUNT)),
+            ],
+            posted_timestamp=now - timedelta(days=days_ago),
+        )
+
+    transactions = [post(days_ago=2), post(days_ago=1, evidence=orders)]
+    transactions.append(void_transaction(transactions[0], user))
+    return user, orders, ledgers, transactions, now, post
+
+
+def export(**kwargs):
+    files = {table: io.BytesIO() for table in TABLES}
+    rows = export_tables(files, **kwargs)
+    return rows, {
+        table: list(csv.DictReader(
+            io.StringIO(files[table].getvalue().decode())))
+        for table in files
+    }
+
+
+def test_export_tables(create_objects):
+    user, orders, ledgers, transactions, now, post = create_objects
+    rows, tables = export()
+
+    assert rows == {
+        'transactions': 3,
+        'entries': 6,
+        'related_objects': 4,
+        'balances': 4,
+    }
+    assert list(rows) == list(TABLES)
+    assert [row['transaction_id'] for row in tables['transactions']] == [
+        str(transaction.transaction_id) for transaction in transactions]
+    assert [
+        (row['is_void'], row['is_voided'], row['voids_id'])
+        for row in tables['transactions']
+    ] == [
+        ('f', 't', ''), ('f', 'f', ''), ('t', 'f', str(transactions[0].id)),
+    ]
+    assert [
+        (int(row['id']), int(row['ledger_id']), Decimal(row['amount']))
+        for row in tables['entries']
+    ] == list(
+        LedgerEntry.objects.order_by('id')
+        .values_list('id', 'ledger_id', 'amount')
+    )
+    assert [
+        int(row['related_object_id']) for row in tables['related_objects']
+    ] == list(
+        TransactionRelatedObject.objects.order_by('id')
+        .values_list('related_object_id', flat=True)
+    )
+    assert [
+        Decimal(row['balance']) for row in tables['balances']
+    ] == list(
+        LedgerBalance.objects.order_by('id').values_list('balance', flat=True)
+    )
+    assert 'ledger_name' not in tables['entries'][0]
+
+
+def test_export_joined(create_objects):
+    user, orders, ledgers, transactions, now, post = create_objects
+    rows, tables = export(joined=True)
+
+    assert {row['type_name'] for row in tables['transactions']} == {'Manual'}
+    entry = tables['entries'][0]
+    assert entry['transaction_uuid'] == str(transactions[0].transaction_id)
+    assert entry['is_voided'] == 't'
+    assert entry['ledger_name'] == ledgers[0].name
+    assert entry['ledger_number'] == str(ledgers[0].number)
+    assert {
+        (row['app_label'], row['model'])
+        for table in ('related_objects', 'balances')
+        for row in tables[table]
+    } == {('tests', 'order')}
+    assert {row['ledger_name'] for row in tables['balances']} == {
+        ledger.name for ledger in ledgers}
+
+
+def test_export_filters(create_objects):
+    user, orders, ledgers, transactions, now, post = create_objects
+
+    rows, tables = export(
+        since=now - timedelta(days=1, hours=1),
+        until=now - timedelta(hours=1))
+    assert [row['id'] for row in tables['transactions']] == [
+        str(transactions[1].id)]
+    assert rows == {
+        'transactions': 1,
+        'entries': 2,
+        'related_objects': 2,
+        'balances': 4,
+    }
+
+    rows, tables = export(
+        first_id=transactions[1].id, last_id=transactions[1].id)
+    assert [row['id'] for row in tables['transactions']] == [
+        str(transactions[1].id)]
+
+    # The void is posted when the Transaction it voids was.
+    rows, tables = export(
+        first_id=transactions[1].id, until=now - timedelta(days=1, hours=1))
+    assert [row['id'] for row in tables['transactions']] == [
+        str(transactions[2].id)]
+    assert {row['transaction_id'] for row in tables['entries']} == {
+        str(transactions[2].id)}
+
+
+def test_export_binary(create_objects):
+    files = {'entries': io.BytesIO()}
+    assert export_tables(files, format='binary') == {'entries': 6}
+    data = files['entries'].getvalue()
+    assert data.startswith(b'PGCOPY\n\xff\r\n\x00')
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMPORARY TABLE imported (LIKE capone_ledgerentry)')
+        cursor.execute(
+            'ALTER TABLE imported DROP COLUMN modified_at')
+        files['entries'].seek(0)
+        cursor.copy_expert(
+            'COPY imported (id, transaction_id, ledger_id, entry_id, amount, '
+            'posted_timestamp, created_at) FROM STDIN WITH (FORMAT binary)',
+            files['entries'])
+        cursor.execute('SELECT id, amount FROM imported ORDER BY id')
+        assert cursor.fetchall() == list(
+            LedgerEntry.objects.order_by('id').values_list('id', 'amount'))
+        cursor.execute('DROP TABLE imported')
+
+
+def test_copy_query(create_objects):
+    file = io.BytesIO()
+    assert copy_query(
+        'SELECT id FROM capone_ledger WHERE id > %(id)s ORDER BY id',
+        {'id': 0}, file) == 2
+    assert file.getvalue().decode().splitlines()[0] == 'id'
+
+
+class PostingFile(io.BytesIO):
+    """
+    A file that posts a Transaction, from another thread, on its first write.
+    """
+    def __init__(self, post):
+        super(PostingFile, self).__init__()
+        self.post = post
+        self.posted = []
+
+    def write(self, data):
+        if not self.posted:
+            thread = threading.Thread(target=self.post_and_close)
+            thread.start()
+            thread.join()
+        return super(PostingFile, self).write(data)
+
+    def post_and_close(self):
+        try:
+            self.posted.append(self.post())
+        finally:
+            connection.close()
+
+
+def test_export_snapshot(create_objects):
+    user, orders, ledgers, transactions, now, post = create_objects
+    transactions_file = PostingFile(post)
+    files = {
+        'transactions': transactions_file,
+        'entries': io.BytesIO(),
+        'related_objects': io.BytesIO(),
+        'balances': io.BytesIO(),
+    }
+
+    rows = export_tables(files)
+
+    assert len(transactions_file.posted) == 1
+    assert LedgerEntry.objects.count() == 8
+    # The posting committed after the export's snapshot was taken, so none
+    # of the tables include it.
+    assert rows == {
+        'transactions': 3,
+        'entries': 6,
+        'related_objects': 4,
+        'balances': 4,
+    }
+    assert str(transactions_file.posted[0].id) not in {
+        row['transaction_id'] for row in csv.DictReader(
+            io.StringIO(files['entries'].getvalue().decode()))
+    }
+
+
+def test_export_errors(create_objects):
+    with pytest.raises(ValueError) as e:
+        export_tables({'ledgers': io.BytesIO()})
+    assert str(e.value) == 'Unknown tables: ledgers'
+
+    with pytest.raises(TransactionManagementError):
+        with atomic():
+            export_tables({'entries': io.BytesIO()})
+
+
+def test_command(create_objects, tmpdir):
+    user, orders, ledgers, transactions, now, post = create_objects
+    stdout = io.StringIO()
+    call_command(
+        'capone_export', str(tmpdir), '--tables', 'transactions', 'entries',
+        '--last-id', str(transactions[1].id),
+        '--since', (now - timedelta(days=1, hours=1)).isoformat(),
+        '--joined', stdout=stdout)
+
+    output = stdout.getvalue().splitlines()
+    assert output[:2] == [
+        'Exported 1 transactions to {}.'.format(
+            os.path.join(str(tmpdir), 'transactions.csv')),
+        'Exported 2 entries to {}.'.format(
+            os.path.join(str(tmpdir), 'entries.csv')),
+    ]
+    assert output[2].startswith('Exported 3 row(s) in ')
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'entries.csv', 'transactions.csv']
+    with open(os.path.join(str(tmpdir), 'entries.csv')) as entries:
+        assert {
+            row['ledger_name'] for row in csv.DictReader(entries)
+        } == {ledger.name for ledger in ledgers}
+
+    call_command(
+        'capone_export', str(tmpdir.join('binary')), '--format', 'binary',
+        '--until', now.isoformat(), stdout=stdout)
+    assert sorted(os.listdir(str(tmpdir.join('binary')))) == [
+        'balances.copy', 'entries.copy', 'related_objects.copy',
+        'transactions.copy']
+
+
+def test_command_errors(tmpdir):
+    with pytest.raises(CommandError) as e:
+        call_command('capone_export', str(tmpdir), '--since', 'yesterday')
+    assert str(e.value) == (
+        "--since must be a date and time, not 'yesterday'.")
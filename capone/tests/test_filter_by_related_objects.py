@@ -153,7 +153,7 @@ def test_filters(match_type, results, create_transactions):
     (MatchType.ANY, 1),
     (MatchType.ALL, 1),
     (MatchType.NONE, 1),
-    (MatchType.EXACT, 4),
+    (MatchType.EXACT, 1),
 ])
 def test_query_counts(
     match_type, query_counts, django_assert_num_queries, create_transactions,
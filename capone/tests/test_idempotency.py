@@ -0,0 +1,126 @@
+from decimal import Decimal
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.queries import get_balances_for_object
+from capone.api.queries import get_transactions_by_idempotency_key
+from capone.exceptions import IdempotencyKeyReusedException
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import TransactionTypeFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test posting Transactions with idempotency keys.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def create_objects():
+    user = UserFactory()
+    order = OrderFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    ttype = TransactionTypeFactory()
+    ContentType.objects.get_for_model(order)
+
+    def add_transaction(idempotency_key=None, amount=AMOUNT):
+        return create_transaction(
+            user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(amount)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(amount)),
+            ],
+            type=ttype,
+            idempotency_key=idempotency_key,
+        )
+
+    return order, ar_ledger, cash_ledger, add_transaction
+
+
+def test_repeated_posting(create_objects, django_assert_num_queries):
+    order, ar_ledger, cash_ledger, add_transaction = create_objects
+    transaction = add_transaction('payment-1')
+    assert transaction.idempotency_key == 'payment-1'
+
+    # The savepoint, the posting that writes nothing, and the lookup of the
+    # Transaction, its entries, and its evidence.
+    with django_assert_num_queries(6):
+        repeated = add_transaction('payment-1')
+
+    assert repeated == transaction
+    assert repeated.idempotency_key == 'payment-1'
+    assert Transaction.objects.count() == 1
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+    assert get_balances_for_object(order) == {
+        ar_ledger: credit(AMOUNT),
+        cash_ledger: debit(AMOUNT),
+    }
+
+    other = add_transaction('payment-2')
+    assert other != transaction
+    assert ar_ledger.get_balance() == credit(AMOUNT * 2)
+
+
+def test_reused_key(create_objects):
+    order, ar_ledger, cash_ledger, add_transaction = create_objects
+    transaction = add_transaction('payment-1')
+
+    with pytest.raises(IdempotencyKeyReusedException) as e:
+        add_transaction('payment-1', amount=AMOUNT * 2)
+    assert str(e.value) == (
+        "Transaction {} with idempotency key 'payment-1' has other entries "
+        "or evidence.".format(transaction))
+
+    with pytest.raises(IdempotencyKeyReusedException):
+        create_transaction(
+            transaction.created_by,
+            evidence=[OrderFactory()],
+            ledger_entries=[
+                (ar_ledger, credit(AMOUNT)),
+                (cash_ledger, debit(AMOUNT)),
+            ],
+            idempotency_key='payment-1',
+        )
+
+    assert Transaction.objects.count() == 1
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+
+
+def test_postings_without_keys(create_objects):
+    order, ar_ledger, cash_ledger, add_transaction = create_objects
+    add_transaction()
+    add_transaction()
+
+    assert Transaction.objects.filter(idempotency_key=None).count() == 2
+    assert ar_ledger.get_balance() == credit(AMOUNT * 2)
+
+
+def test_get_transactions_by_idempotency_key(
+        create_objects, django_assert_num_queries):
+    order, ar_ledger, cash_ledger, add_transaction = create_objects
+    transactions = {
+        key: add_transaction(key)
+        for key in ['payment-1', 'payment-2', 'payment-3']
+    }
+    add_transaction()
+
+    with django_assert_num_queries(1):
+        existing = get_transactions_by_idempotency_key(
+            ['payment-1', 'payment-3', 'payment-4'])
+
+    assert existing == {
+        'payment-1': transactions['payment-1'],
+        'payment-3': transactions['payment-3'],
+    }
+    assert get_transactions_by_idempotency_key([]) == {}
@@ -0,0 +1,457 @@
+import io
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.transaction import atomic
+from django.db.transaction import TransactionManagementError
+from django.utils import timezone
+
+from capone import cache as cache_module
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.queries import get_balances_for_object
+from capone.cache import ledger_balance_cache_key
+from capone.exceptions import NoLedgerEntriesException
+from capone.exceptions import TransactionBalanceException
+from capone.importer import _partition
+from capone.importer import _StagedPosting
+from capone.importer import import_transactions
+from capone.importer import import_transactions_parallel
+from capone.importer import ImportResult
+from capone.importer import read_postings_csv
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import TransactionTypeFactory
+from capone.tests.factories import UserFactory
+from capone.utils import find_unbalanced_transactions
+from capone.utils import verify_ledger_balances
+
+
+"""
+Test bulk importing historical Transactions with COPY.
+"""
+
+AMOUNT = Decimal('100.0000')
+
+
+@pytest.fixture
+def create_objects(db):
+    return (
+        UserFactory(),
+        OrderFactory.create_batch(2),
+        LedgerFactory.create_batch(2),
+    )
+
+
+@pytest.fixture
+def create_parallel_objects(transactional_db):
+    return (
+        UserFactory(),
+        OrderFactory.create_batch(2),
+        LedgerFactory.create_batch(7),
+    )
+
+
+def postings(ledgers, orders, count, prefix='import'):
+    now = timezone.now()
+    return [
+        {
+            'idempotency_key': '{}-{}'.format(prefix, i),
+            'posted_timestamp': now - timedelta(days=i),
+            'notes': 'Imported {}'.format(i),
+            'evidence': orders[:i % 2 + 1],
+            'ledger_entries': [
+                (ledgers[0], credit(AMOUNT)),
+                (ledgers[1].name, debit(AMOUNT)),
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+def test_import_transactions(create_objects):
+    user, orders, ledgers = create_objects
+    create_transaction(
+        user,
+        evidence=orders[:1],
+        ledger_entries=[
+            (ledgers[0], debit(AMOUNT)),
+            (ledgers[1], credit(AMOUNT)),
+        ],
+    )
+    imported = postings(ledgers, orders, 5)
+    progress = []
+
+    result = import_transactions(
+        imported, user, chunk_size=2, progress=progress.append)
+
+    assert result == ImportResult(5, 0, 10, 7, [])
+    assert [r.imported for r in progress] == [2, 4, 5]
+    transaction = Transaction.objects.get(idempotency_key='import-1')
+    assert transaction.created_by == user
+    assert transaction.type.name == 'Manual'
+    assert transaction.notes == 'Imported 1'
+    assert transaction.posted_timestamp == imported[1]['posted_timestamp']
+    assert set(transaction.entries.values_list(
+        'ledger_id', 'amount', 'posted_timestamp')) == {
+        (ledgers[0].id, -AMOUNT, imported[1]['posted_timestamp']),
+        (ledgers[1].id, AMOUNT, imported[1]['posted_timestamp']),
+    }
+    assert {
+        related.related_object for related in transaction.related_objects.all()
+    } == set(orders)
+
+    # Imported balances are merged into the existing ones.
+    assert verify_ledger_balances() == []
+    assert find_unbalanced_transactions() == []
+    assert get_balances_for_object(orders[0]) == {
+        ledgers[0]: -4 * AMOUNT,
+        ledgers[1]: 4 * AMOUNT,
+    }
+
+
+def test_import_restart(create_objects):
+    user, orders, ledgers = create_objects
+    import_transactions(postings(ledgers, orders, 3), user)
+    balances = list(LedgerBalance.objects.values_list('balance', flat=True))
+
+    result = import_transactions(
+        postings(ledgers, orders, 5), user, chunk_size=3)
+
+    assert result == ImportResult(2, 3, 4, 3, [])
+    assert Transaction.objects.count() == 5
+    assert verify_ledger_balances() == []
+    assert balances != list(
+        LedgerBalance.objects.values_list('balance', flat=True))
+
+    assert import_transactions(postings(ledgers, orders, 5), user) == (
+        ImportResult(0, 5, 0, 0, []))
+    assert LedgerEntry.objects.count() == 10
+
+
+def test_import_without_merging_balances(create_objects, settings):
+    user, orders, ledgers = create_objects
+    type = TransactionTypeFactory()
+    settings.CAPONE_BALANCE_CACHE = 'default'
+    caches['default'].clear()
+    cache_module._pending.invalidations = False
+    assert ledgers[0].get_balance() == 0
+    assert caches['default'].get(ledger_balance_cache_key(ledgers[0].id))
+
+    result = import_transactions(
+        postings(ledgers, orders, 2), user, type=type, merge_balances=False)
+
+    assert result.imported == 2
+    assert set(Transaction.objects.values_list('type', flat=True)) == {
+        type.id}
+    assert not LedgerBalance.objects.exists()
+    assert len(verify_ledger_balances()) == 4
+    # Ledger balances are summed from the entries, so the import
+    # invalidated the cached one.
+    assert ledgers[0].get_balance() == 2 * credit(AMOUNT)
+
+
+def test_import_naive_timestamps(create_objects):
+    user, orders, ledgers = create_objects
+    posted_timestamp = datetime(2020, 1, 1)
+    created = create_transaction(
+        user,
+        ledger_entries=[
+            (ledgers[0], credit(AMOUNT)),
+            (ledgers[1], debit(AMOUNT)),
+        ],
+        posted_timestamp=posted_timestamp,
+    )
+
+    import_transactions([{
+        'idempotency_key': 'naive',
+        'posted_timestamp': posted_timestamp,
+        'ledger_entries': [
+            (ledgers[0], credit(AMOUNT)),
+            (ledgers[1], debit(AMOUNT)),
+        ],
+    }], user)
+
+    created.refresh_from_db()
+    imported = Transaction.objects.get(idempotency_key='naive')
+    assert imported.posted_timestamp == created.posted_timestamp
+    assert imported.entries.first().posted_timestamp == (
+        created.posted_timestamp)
+
+
+def test_import_errors(create_objects):
+    user, orders, ledgers = create_objects
+    order_type = ContentType.objects.get_for_model(orders[0])
+    valid = postings(ledgers, orders, 1)[0]
+    invalid = [
+        dict(valid, idempotency_key=''),
+        dict(valid, ledger_entries=[(ledgers[0], AMOUNT)]),
+        dict(valid, idempotency_key='none', ledger_entries=[]),
+        dict(valid, idempotency_key='unknown', ledger_entries=[
+            ('No Such Ledger', AMOUNT), (ledgers[0], -AMOUNT)]),
+        dict(valid, idempotency_key='model', evidence=[('tests.nope', 1)]),
+        dict(valid, idempotency_key='app', evidence=[('order', 1)]),
+        dict(valid, idempotency_key='type id', evidence=[(0, 1)]),
+    ]
+
+    result = import_transactions(
+        invalid + [
+            valid,
+            dict(valid, notes='Again'),
+            dict(
+                valid,
+                idempotency_key='pairs',
+                posted_timestamp=None,
+                notes=None,
+                evidence=[
+                    ('tests.order', orders[0].id),
+                    (order_type, orders[0].id),
+                    (order_type.id, str(orders[1].id)),
+                ],
+            ),
+        ],
+        user,
+        chunk_size=len(invalid),
+    )
+
+    assert [(index, key) for index, key, _ in result.errors] == [
+        (0, ''),
+        (1, 'import-0'),
+        (2, 'none'),
+        (3, 'unknown'),
+        (4, 'model'),
+        (5, 'app'),
+        (6, 'type id'),
+        (8, 'import-0'),
+    ]
+    errors = [error for _, _, error in result.errors]
+    assert [type(error) for error in errors] == [
+        ValueError,
+        TransactionBalanceException,
+        NoLedgerEntriesException,
+        type(ledgers[0]).DoesNotExist,
+        ContentType.DoesNotExist,
+        ValueError,
+        ContentType.DoesNotExist,
+        ValueError,
+    ]
+    assert all(isinstance(error, ObjectDoesNotExist) for error in errors[3:5])
+    assert str(errors[0]) == "Posting has no idempotency_key."
+    assert str(errors[1]) == (
+        "Credits do not equal debits. Mis-match of 100.0000.")
+    assert str(errors[5]) == (
+        "Evidence type 'order' isn't of the form 'app_label.model'.")
+    assert str(errors[7]) == (
+        "Idempotency key 'import-0' is used twice in a chunk.")
+    assert result[:4] == (2, 0, 4, 3)
+
+    transaction = Transaction.objects.get(idempotency_key='pairs')
+    assert transaction.notes == ''
+    assert transaction.posted_timestamp <= timezone.now()
+    assert transaction.related_objects.count() == 2
+    assert verify_ledger_balances() == []
+
+
+CSV = '''\
+idempotency_key,posted_timestamp,ledger,amount,evidence,notes
+first,2020-01-02T03:04:05+00:00,{0},-100,tests.order:{2} tests.order:{3},One
+first,,{1},100,tests.order:{2},
+second,,{1},-50,,
+second,,{0},50,,
+'''
+
+
+def order_ids(orders):
+    return [order.id for order in orders]
+
+
+def test_read_postings_csv(create_objects):
+    user, orders, ledgers = create_objects
+    data = CSV.format(ledgers[0].name, ledgers[1].name, *order_ids(orders))
+
+    assert list(read_postings_csv(io.StringIO(data))) == [
+        {
+            'idempotency_key': 'first',
+            'posted_timestamp': datetime(
+                2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+            'notes': 'One',
+            'evidence': [
+                ('tests.order', orders[0].id),
+                ('tests.order', orders[1].id),
+                ('tests.order', orders[0].id),
+            ],
+            'ledger_entries': [
+                (ledgers[0].name, Decimal(-100)),
+                (ledgers[1].name, Decimal(100)),
+            ],
+        },
+        {
+            'idempotency_key': 'second',
+            'posted_timestamp': None,
+            'notes': '',
+            'evidence': [],
+            'ledger_entries': [
+                (ledgers[1].name, Decimal(-50)),
+                (ledgers[0].name, Decimal(50)),
+            ],
+        },
+    ]
+
+    numbers = list(read_postings_csv(io.StringIO(
+        CSV.format(ledgers[0].number, ledgers[1].number, *order_ids(orders))),
+        ledger_numbers=True))
+    assert numbers[1]['ledger_entries'][0] == (ledgers[1].number, -50)
+
+
+@pytest.mark.parametrize('row, error', [
+    ('a,yesterday,L,1,,', "Line 2: Invalid posted_timestamp 'yesterday'."),
+    ('a,,L,1,,\na,,L,one,,', "Line 3: Invalid amount."),
+    ('a,,L,1,tests.order:x,', "Line 2: invalid literal for int() with base "
+                              "10: 'x'"),
+])
+def test_read_postings_csv_errors(row, error):
+    data = 'idempotency_key,posted_timestamp,ledger,amount,evidence,notes\n'
+    with pytest.raises(ValueError) as e:
+        list(read_postings_csv(io.StringIO(data + row + '\n')))
+    assert str(e.value) == error
+
+
+def run(*args):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    try:
+        call_command('capone_import', *args, stdout=stdout, stderr=stderr)
+    except CommandError as e:
+        error = str(e)
+    else:
+        error = None
+    return stdout.getvalue().splitlines(), stderr.getvalue(), error
+
+
+def test_command(create_parallel_objects, tmpdir):
+    user, orders, ledgers = create_parallel_objects
+    path = tmpdir.join('postings.csv')
+    path.write(CSV.format(
+        ledgers[0].number, ledgers[1].number, *order_ids(orders)))
+
+    stdout, stderr, error = run(
+        str(path), '--username', user.username, '--ledger-numbers',
+        '--type', 'Migration', '--chunk-size', '1')
+
+    assert error is None
+    assert stderr == ''
+    assert stdout[0].startswith(
+        'Imported 1 transaction(s), skipped 0, 0 error(s) (')
+    assert stdout[2].startswith(
+        'Imported 2 transaction(s) with 4 entries and 2 related objects, '
+        'skipped 0, in ')
+    assert set(Transaction.objects.values_list('type__name', flat=True)) == {
+        'Migration'}
+    assert verify_ledger_balances() == []
+
+    stdout, stderr, error = run(
+        str(path), '--username', user.username, '--no-merge-balances',
+        '--processes', '0')
+    assert error == "2 transaction(s) weren't imported."
+    assert stderr.splitlines()[0] == (
+        "Transaction 'first': Ledger matching query does not exist.")
+    assert Transaction.objects.count() == 2
+
+
+def test_command_errors(create_objects, tmpdir):
+    user, orders, ledgers = create_objects
+    path = tmpdir.join('postings.csv')
+    path.write(
+        'idempotency_key,posted_timestamp,ledger,amount\n'
+        'a,,{},x\n'.format(ledgers[0].name))
+
+    assert run(str(path), '--username', 'nobody')[2] == (
+        "There is no user 'nobody'.")
+    assert run(str(path), '--username', user.username)[2] == (
+        "Line 2: Invalid amount.")
+
+
+def staged(key, *ledger_ids):
+    return _StagedPosting(
+        key, None, '', [(ledger_id, AMOUNT) for ledger_id in ledger_ids], [])
+
+
+def test_partition():
+    postings = [
+        staged('a', 1, 2),
+        staged('b', 3, 4),
+        staged('c', 2, 5),
+        staged('d', 6, 7),
+        staged('e', 5, 4),
+        staged('f', 8, 9, 10),
+        staged('g', 7, 1),
+    ]
+
+    partitions, crossing = _partition(postings, 2)
+
+    assert [[posting.idempotency_key for posting in partition]
+            for partition in partitions] == [['a', 'c', 'f'], ['b', 'd']]
+    assert [posting.idempotency_key for posting in crossing] == ['e', 'g']
+
+    partitions, crossing = _partition(postings, 3)
+    assert [len(partition) for partition in partitions] == [2, 2, 1]
+    assert [posting.idempotency_key for posting in crossing] == ['e', 'g']
+
+
+def component_postings(user, orders, ledgers, count, prefix='parallel'):
+    """
+    Return postings in three components of `ledgers`, and some that cross.
+    """
+    return [
+        {
+            'idempotency_key': '{}-{}'.format(prefix, i),
+            'evidence': orders[i % 2:],
+            'ledger_entries': [
+                (ledgers[(i + (i % 5 == 4)) % 3 * 2], credit(AMOUNT)),
+                (ledgers[i % 3 * 2 + 1], debit(AMOUNT)),
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+def test_import_transactions_parallel(create_parallel_objects):
+    user, orders, ledgers = create_parallel_objects
+    postings = component_postings(user, orders, ledgers, 20)
+    postings[3]['ledger_entries'][0] = (ledgers[6], credit(AMOUNT))
+    postings.append(dict(postings[0], idempotency_key=None))
+    progress = []
+
+    result = import_transactions_parallel(
+        postings, user, processes=2, batch_size=12, chunk_size=2,
+        progress=progress.append)
+
+    assert result[:4] == (20, 0, 40, 30)
+    assert [(index, key) for index, key, _ in result.errors] == [(20, None)]
+    assert [r.imported for r in progress] == [12, 20]
+    assert Transaction.objects.count() == 20
+    assert verify_ledger_balances() == []
+    assert find_unbalanced_transactions() == []
+    assert LedgerBalance.objects.filter(ledger=ledgers[6]).count() == 1
+
+    result = import_transactions_parallel(
+        postings[:20], user, processes=4, merge_balances=False)
+    assert result == ImportResult(0, 20, 0, 0, [])
+
+
+def test_import_transactions_parallel_in_atomic(create_objects):
+    user, orders, ledgers = create_objects
+    with pytest.raises(TransactionManagementError):
+        with atomic():
+            import_transactions_parallel([], user)
@@ -0,0 +1,208 @@
+import logging
+from collections import deque
+from decimal import Decimal
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from capone.api.actions import create_transaction
+from capone.api.actions import create_transactions
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.exceptions import TransactionBalanceException
+from capone.instrumentation import log_posting_metrics
+from capone.instrumentation import StatsdPostingMetrics
+from capone.models import get_or_create_manual_transaction_type
+from capone.signals import posting_measured
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test measuring the phases of postings.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def create_objects():
+    user = UserFactory()
+    order = OrderFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    ttype = get_or_create_manual_transaction_type()
+    ContentType.objects.get_for_model(order)
+
+    def posting(amount=AMOUNT):
+        return dict(
+            user=user,
+            evidence=[order],
+            type=ttype,
+            ledger_entries=[
+                (ar_ledger, credit(amount)),
+                (cash_ledger, debit(AMOUNT)),
+            ],
+        )
+
+    return user, posting
+
+
+@pytest.fixture
+def measurements():
+    measurements = []
+
+    def receiver(**kwargs):
+        measurements.append(kwargs)
+
+    posting_measured.connect(receiver)
+    yield measurements
+    posting_measured.disconnect(receiver)
+
+
+def test_not_measured_without_receivers(
+        create_objects, django_assert_num_queries):
+    user, posting = create_objects
+    with django_assert_num_queries(3):
+        create_transaction(**posting())
+
+
+def test_create_transaction(
+        create_objects, measurements, django_assert_num_queries):
+    user, posting = create_objects
+    # The savepoint, the lock, the write, and the savepoint's release.
+    with django_assert_num_queries(4):
+        transaction = create_transaction(**posting())
+
+    measurement, = measurements
+    assert measurement['function'] is create_transaction
+    assert list(measurement['durations']) == [
+        'prepare', 'lock', 'write', 'commit', 'total']
+    assert all(seconds >= 0 for seconds in measurement['durations'].values())
+    assert measurement['durations']['total'] >= sum(
+        seconds for phase, seconds in measurement['durations'].items()
+        if phase != 'total')
+    assert measurement['statements'] == 4
+    # The Transaction, 2 entries, 1 piece of evidence, and 2 LedgerBalances.
+    assert measurement['rows'] == 6
+    assert measurement['exception'] is None
+
+    void_transaction(transaction, user)
+    assert measurements[1]['function'] is void_transaction
+    # Voiding also marks the voided Transaction.
+    assert measurements[1]['rows'] == 7
+
+
+def test_create_transactions(create_objects, measurements):
+    user, posting = create_objects
+    results = create_transactions([posting(), posting(), posting(Decimal(1))])
+
+    measurement, = measurements
+    assert measurement['function'] is create_transactions
+    assert list(measurement['durations']) == [
+        'prepare', 'lock', 'write', 'commit', 'total']
+    assert measurement['rows'] == 12
+    assert measurement['exception'] is None
+    assert isinstance(results[2].exception, TransactionBalanceException)
+
+
+def test_failed_posting(create_objects, measurements):
+    user, posting = create_objects
+    with pytest.raises(TransactionBalanceException) as e:
+        create_transaction(**posting(Decimal(1)))
+
+    measurement, = measurements
+    assert measurement['exception'] is e.value
+    assert list(measurement['durations']) == ['prepare', 'total']
+    assert measurement['statements'] == 0
+
+
+def test_statements_beyond_query_log(create_objects, measurements):
+    user, posting = create_objects
+    queries_log = connection.queries_log
+    connection.queries_log = deque(['earlier'], maxlen=2)
+    try:
+        create_transaction(**posting())
+        log = connection.queries_log
+    finally:
+        connection.queries_log = queries_log
+
+    assert measurements[0]['statements'] == 4
+    assert len(log) == 2
+    assert log[1]['sql'].startswith('RELEASE SAVEPOINT')
+    assert not connection.force_debug_cursor
+
+
+def test_log_posting_metrics(create_objects, caplog):
+    user, posting = create_objects
+    posting_measured.connect(log_posting_metrics)
+    try:
+        with caplog.at_level(logging.INFO, logger='capone.instrumentation'):
+            create_transaction(**posting())
+            with pytest.raises(TransactionBalanceException):
+                create_transaction(**posting(Decimal(1)))
+    finally:
+        posting_measured.disconnect(log_posting_metrics)
+
+    succeeded, failed = caplog.records
+    assert succeeded.levelno == logging.INFO
+    assert succeeded.getMessage().startswith('create_transaction took ')
+    assert 'in 4 statements writing 6 rows' in succeeded.getMessage()
+    assert ', lock ' in succeeded.getMessage()
+    assert failed.levelno == logging.WARNING
+    assert ": TransactionBalanceException('Credits do not equal debits." in (
+        failed.getMessage())
+
+
+class FakeStatsClient(object):
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    def timing(self, stat, milliseconds):
+        self.timings[stat] = milliseconds
+
+    def incr(self, stat, count):
+        self.counters[stat] = self.counters.get(stat, 0) + count
+
+
+def test_statsd_posting_metrics(create_objects):
+    user, posting = create_objects
+    client = FakeStatsClient()
+    posting_measured.connect(
+        StatsdPostingMetrics(client, prefix='ledger'),
+        weak=False,
+        dispatch_uid='statsd',
+    )
+    try:
+        create_transaction(**posting())
+        with pytest.raises(TransactionBalanceException):
+            create_transaction(**posting(Decimal(1)))
+    finally:
+        posting_measured.disconnect(dispatch_uid='statsd')
+
+    assert set(client.timings) == {
+        'ledger.create_transaction.prepare',
+        'ledger.create_transaction.lock',
+        'ledger.create_transaction.write',
+        'ledger.create_transaction.commit',
+        'ledger.create_transaction.total',
+    }
+    assert client.counters == {
+        'ledger.create_transaction.statements': 4,
+        'ledger.create_transaction.rows': 6,
+        'ledger.create_transaction.errors': 1,
+    }
+
+
+def test_commit(transactional_db, create_objects, measurements):
+    user, posting = create_objects
+    create_transaction(**posting())
+
+    measurement, = measurements
+    assert measurement['durations']['commit'] > 0
+    # The lock and the write: BEGIN and COMMIT aren't statements.
+    assert measurement['statements'] == 2
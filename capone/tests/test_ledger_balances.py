@@ -2,6 +2,7 @@ from collections import defaultdict
 from decimal import Decimal
 
 import pytest
+from django.contrib.contenttypes.models import ContentType
 from django.db.models import F
 
 from capone.api.actions import create_transaction
@@ -9,15 +10,20 @@ from capone.api.actions import credit
 from capone.api.actions import debit
 from capone.api.actions import void_transaction
 from capone.api.queries import get_balances_for_object
+from capone.api.queries import get_balances_for_objects
 from capone.models import Ledger
 from capone.models import LedgerBalance
 from capone.models import LedgerEntry
 from capone.models import Transaction
+from capone.tests.factories import CreditCardTransactionFactory
 from capone.tests.factories import LedgerFactory
 from capone.tests.factories import OrderFactory
 from capone.tests.factories import UserFactory
 from capone.tests.models import Order
+from capone.utils import find_unbalanced_transactions
+from capone.utils import LedgerBalanceDrift
 from capone.utils import rebuild_ledger_balances
+from capone.utils import verify_ledger_balances
 
 
 """
@@ -82,6 +88,13 @@ def test_no_balances(create_objects):
     )
 
 
+def test_unsaved_object_balances(create_objects):
+    order_1, order_2, ar_ledger, cash_ledger, other_ledger, _ = create_objects
+    balances = get_balances_for_object(OrderFactory.build())
+    assert balances == {}
+    assert balances[ar_ledger] == Decimal(0)
+
+
 def test_ledger_balance_update(create_objects):
     (
         order_1,
@@ -319,3 +332,87 @@ def test_ledger_balances_filtering(create_objects):
 
     add_transaction([order_2])
     assert all_cash_orders() == {order_1, order_2}
+
+
+def test_get_balances_for_objects(create_objects, django_assert_num_queries):
+    (order_1, order_2, ar_ledger, cash_ledger, other_ledger, user) = (
+        create_objects)
+    credit_card_transaction = CreditCardTransactionFactory(id=order_1.id)
+    for evidence in [[order_1], [order_1, credit_card_transaction]]:
+        create_transaction(
+            user,
+            evidence=evidence,
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(amount)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(amount)),
+            ],
+        )
+
+    objs = [order_1, order_2, credit_card_transaction]
+    get_balances_for_objects(objs)
+    with django_assert_num_queries(1):
+        balances = get_balances_for_objects(objs)
+
+    assert balances == {
+        order_1: {
+            ar_ledger: credit(amount * 2),
+            cash_ledger: debit(amount * 2),
+        },
+        order_2: {},
+        credit_card_transaction: {
+            ar_ledger: credit(amount),
+            cash_ledger: debit(amount),
+        },
+    }
+    for obj in objs:
+        assert balances[obj] == get_balances_for_object(obj)
+    assert balances[order_2][other_ledger] == Decimal(0)
+
+    assert get_balances_for_objects([]) == {}
+
+
+def test_verify_ledger_balances(create_objects):
+    (order_1, order_2, ar_ledger, cash_ledger, other_ledger, user) = (
+        create_objects)
+    transaction = create_transaction(
+        user,
+        evidence=[order_1, order_2],
+        ledger_entries=[
+            LedgerEntry(ledger=ar_ledger, amount=credit(amount)),
+            LedgerEntry(ledger=cash_ledger, amount=debit(amount)),
+        ],
+    )
+    create_transaction(
+        user,
+        ledger_entries=[
+            LedgerEntry(ledger=ar_ledger, amount=credit(amount)),
+            LedgerEntry(ledger=other_ledger, amount=debit(amount)),
+        ],
+    )
+    assert verify_ledger_balances() == []
+    assert find_unbalanced_transactions() == []
+
+    LedgerBalance.objects.filter(
+        ledger=ar_ledger, related_object_id=order_1.id,
+    ).update(balance=F('balance') * 2)
+    LedgerBalance.objects.filter(
+        ledger=cash_ledger, related_object_id=order_2.id,
+    ).delete()
+    LedgerEntry.objects.filter(
+        transaction=transaction, ledger=cash_ledger,
+    ).update(amount=debit(amount * 3))
+
+    order_type = ContentType.objects.get_for_model(Order)
+    assert verify_ledger_balances() == [
+        LedgerBalanceDrift(
+            ar_ledger.id, order_type.id, order_1.id,
+            credit(amount * 2), credit(amount)),
+        LedgerBalanceDrift(
+            cash_ledger.id, order_type.id, order_1.id,
+            debit(amount), debit(amount * 3)),
+        LedgerBalanceDrift(
+            cash_ledger.id, order_type.id, order_2.id,
+            Decimal(0), debit(amount * 3)),
+    ]
+    assert find_unbalanced_transactions() == [
+        (transaction.id, debit(amount * 2))]
@@ -0,0 +1,159 @@
+from datetime import timedelta
+from decimal import Decimal as D
+
+import pytest
+from django.utils import timezone
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.api.queries import ledger_statement
+from capone.models import LedgerEntry
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test `ledger_statement` and the denormalized `LedgerEntry.posted_timestamp`.
+"""
+
+
+@pytest.fixture
+def create_objects():
+    user = UserFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+    now = timezone.now()
+
+    def add_transaction(amount, days_ago):
+        return create_transaction(
+            user,
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=debit(amount)),
+                LedgerEntry(ledger=cash_ledger, amount=credit(amount)),
+            ],
+            posted_timestamp=now - timedelta(days=days_ago),
+        )
+
+    # Created out of posting order to check that statements are ordered by
+    # `posted_timestamp` rather than by creation.
+    transactions = [
+        add_transaction(D(10), days_ago=3),
+        add_transaction(D(20), days_ago=1),
+        add_transaction(D(40), days_ago=2),
+        add_transaction(D(80), days_ago=0),
+    ]
+    return user, ar_ledger, cash_ledger, now, transactions
+
+
+def test_entries_have_posted_timestamp(create_objects):
+    user, ar_ledger, cash_ledger, now, transactions = create_objects
+    for transaction in transactions:
+        for entry in transaction.entries.all():
+            assert entry.posted_timestamp == transaction.posted_timestamp
+
+
+def test_posted_timestamp_follows_transaction(create_objects):
+    user, ar_ledger, cash_ledger, now, transactions = create_objects
+    transaction = transactions[0]
+    transaction.posted_timestamp = now + timedelta(days=1)
+    transaction.save()
+
+    assert {
+        entry.posted_timestamp for entry in transaction.entries.all()
+    } == {now + timedelta(days=1)}
+
+    assert [
+        (line.amount, line.balance) for line in ledger_statement(ar_ledger)
+    ] == [
+        (D(40), D(40)),
+        (D(20), D(60)),
+        (D(80), D(140)),
+        (D(10), D(150)),
+    ]
+
+
+def test_full_statement(create_objects):
+    user, ar_ledger, cash_ledger, now, transactions = create_objects
+    lines = list(ledger_statement(ar_ledger))
+
+    assert [line.transaction_id for line in lines] == [
+        transactions[0].id,
+        transactions[2].id,
+        transactions[1].id,
+        transactions[3].id,
+    ]
+    assert [(line.amount, line.balance) for line in lines] == [
+        (D(10), D(10)),
+        (D(40), D(50)),
+        (D(20), D(70)),
+        (D(80), D(150)),
+    ]
+    assert lines[-1].balance == ar_ledger.get_balance()
+    assert [
+        line.balance for line in ledger_statement(cash_ledger)
+    ] == [D(-10), D(-50), D(-70), D(-150)]
+
+
+def test_statement_range(create_objects):
+    user, ar_ledger, cash_ledger, now, transactions = create_objects
+    lines = list(ledger_statement(
+        ar_ledger,
+        start=now - timedelta(days=2),
+        end=now,
+    ))
+
+    assert [(line.amount, line.balance) for line in lines] == [
+        (D(40), D(50)),
+        (D(20), D(70)),
+    ]
+    assert [line.posted_timestamp for line in lines] == [
+        now - timedelta(days=2),
+        now - timedelta(days=1),
+    ]
+
+    assert list(ledger_statement(ar_ledger, end=now - timedelta(days=3))) == []
+    assert list(ledger_statement(ar_ledger, start=now + timedelta(1))) == []
+
+
+def test_statement_continuation(create_objects):
+    user, ar_ledger, cash_ledger, now, transactions = create_objects
+    void_transaction(transactions[2], user)
+    all_lines = list(ledger_statement(ar_ledger, chunk_size=2))
+    assert len(all_lines) == 5
+
+    lines = []
+    after = None
+    while True:
+        page = []
+        for line in ledger_statement(ar_ledger, after=after):
+            page.append(line)
+            if len(page) == 2:
+                break
+        if not page:
+            break
+        lines.extend(page)
+        after = page[-1].continuation_token
+
+    assert lines == all_lines
+    assert [(line.amount, line.balance) for line in lines] == [
+        (D(10), D(10)),
+        (D(40), D(50)),
+        (D(-40), D(10)),
+        (D(20), D(30)),
+        (D(80), D(110)),
+    ]
+
+
+def test_continuation_overrides_start(create_objects):
+    user, ar_ledger, cash_ledger, now, transactions = create_objects
+    first_line = next(ledger_statement(ar_ledger))
+
+    lines = list(ledger_statement(
+        ar_ledger,
+        start=now,
+        after=first_line.continuation_token,
+    ))
+
+    assert [line.balance for line in lines] == [D(50), D(70), D(150)]
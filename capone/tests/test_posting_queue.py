@@ -0,0 +1,134 @@
+import threading
+from decimal import Decimal
+
+import pytest
+from django.db import IntegrityError
+
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.ingestion import PostingQueue
+from capone.api.queries import get_balances_for_object
+from capone.exceptions import TransactionBalanceException
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test posting Transactions in batches through a `PostingQueue`.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def create_objects(transactional_db):
+    user = UserFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+
+    def posting(order, amount=AMOUNT, user=user):
+        return dict(
+            user=user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(AMOUNT)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(amount)),
+            ],
+        )
+
+    return ar_ledger, posting
+
+
+def test_posting_queue(create_objects):
+    ar_ledger, posting = create_objects
+    orders = OrderFactory.create_batch(40)
+    futures = [None] * len(orders)
+
+    def submit(postings, start):
+        for i in range(start, len(orders), 4):
+            futures[i] = postings.submit(**posting(orders[i]))
+
+    with PostingQueue(batch_size=7, max_delay=0.01) as postings:
+        threads = [
+            threading.Thread(target=submit, args=(postings, start))
+            for start in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        unbalanced = postings.submit(**posting(orders[0], amount=AMOUNT * 2))
+
+    transactions = [future.result() for future in futures]
+    assert set(transactions) == set(Transaction.objects.all())
+    for order, transaction in zip(orders, transactions):
+        assert {
+            tro.related_object for tro in transaction.related_objects.all()
+        } == {order}
+        assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+    with pytest.raises(TransactionBalanceException):
+        unbalanced.result()
+    assert ar_ledger.get_balance() == credit(AMOUNT) * len(orders)
+
+
+def test_failed_posting(create_objects):
+    ar_ledger, posting = create_objects
+    order = OrderFactory()
+    missing_user = UserFactory.build(id=0)
+
+    postings = PostingQueue(max_delay=60)
+    futures = [
+        postings.submit(**posting(order)),
+        postings.submit(**posting(order, user=missing_user)),
+        postings.submit(**posting(order)),
+    ]
+    postings.start()
+    postings.stop()
+
+    # The missing User fails its own posting, not the whole batch.
+    with pytest.raises(IntegrityError):
+        futures[1].result()
+    assert set(Transaction.objects.all()) == {
+        futures[0].result(), futures[2].result()}
+    assert ar_ledger.get_balance() == credit(AMOUNT) * 2
+
+
+def test_failed_batch(create_objects):
+    ar_ledger, posting = create_objects
+    order = OrderFactory()
+    unlockable = posting(order)
+    unlockable['ledger_entries'][1].ledger_id = 'cash'
+
+    postings = PostingQueue(max_delay=60)
+    futures = [
+        postings.submit(**posting(order)),
+        postings.submit(**unlockable),
+    ]
+    postings.start()
+    postings.stop()
+
+    # The Ledger ids can't be sorted to lock them, so no posting is written.
+    for future in futures:
+        with pytest.raises(TypeError):
+            future.result()
+    assert not Transaction.objects.exists()
+
+
+def test_stop_without_start():
+    postings = PostingQueue()
+    postings.stop()
+    assert postings._thread is None
+
+
+def test_batches_are_posted_after_max_delay(create_objects):
+    ar_ledger, posting = create_objects
+    order = OrderFactory()
+
+    with PostingQueue(max_delay=0.01) as postings:
+        cancelled = postings.submit(**posting(order))
+        cancelled.cancel()
+        transaction = postings.submit(**posting(order)).result(timeout=10)
+        assert Transaction.objects.get() == transaction
@@ -0,0 +1,293 @@
+"""
+Guard the number of queries made by each public API function.
+
+Each function is run on inputs of each of `SIZES` and must make the same
+number of queries for all of them, unless its `Case` declares how the
+number grows.  Reference data is cached first, as it would be in a
+long-running process.
+"""
+import inspect
+from collections import namedtuple
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from capone.api import actions
+from capone.api import queries
+from capone.api.actions import create_transaction
+from capone.api.actions import create_transactions
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.api.queries import assert_transaction_in_ledgers_for_amounts_with_evidence  # noqa: E501
+from capone.api.queries import assert_transactions_exist
+from capone.api.queries import evidence_history
+from capone.api.queries import get_balances_for_object
+from capone.api.queries import get_balances_for_objects
+from capone.api.queries import get_transactions_by_idempotency_key
+from capone.api.queries import ledger_statement
+from capone.api.queries import validate_transaction
+from capone.cache import clear_reference_cache
+from capone.cache import warm_reference_cache
+from capone.models import get_or_create_manual_transaction_type
+from capone.models import LedgerEntry
+from capone.models import MatchType
+from capone.models import Transaction
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+SIZES = [1, 10, 100]
+
+AMOUNT = Decimal(100)
+
+
+class Case(namedtuple('Case', ['setup', 'expected'])):
+    """
+    `setup(n)` builds an input of size `n` and returns a function that runs
+    the API function on it.  `expected(n)` is the number of queries it may
+    make, or None if the number must be constant.
+    """
+    __slots__ = ()
+
+
+def post(count, ledgers=None, evidence=None, idempotency_keys=None):
+    """
+    Post `count` Transactions, each between two Ledgers with an Order.
+
+    The Transactions are posted to `ledgers` and have `evidence` if given,
+    and otherwise to new Ledgers and with new Orders.
+    """
+    user = UserFactory()
+    postings = [
+        dict(
+            user=user,
+            evidence=(
+                [OrderFactory()] if evidence is None else evidence),
+            idempotency_key=(
+                None if idempotency_keys is None else idempotency_keys[i]),
+            ledger_entries=[
+                (LedgerFactory() if ledgers is None else ledger,
+                 debit(AMOUNT))
+                for ledger in (ledgers or [None])
+            ] + [
+                (LedgerFactory() if ledgers is None else ledger,
+                 credit(AMOUNT))
+                for ledger in (ledgers or [None])
+            ],
+        )
+        for i in range(count)
+    ]
+    return [result.transaction for result in create_transactions(postings)]
+
+
+def wide_transaction(n):
+    """
+    Post a Transaction with entries in `n` Ledgers and `n` Orders.
+    """
+    ledgers = LedgerFactory.create_batch(n)
+    orders = OrderFactory.create_batch(n)
+    transaction, = post(1, ledgers=ledgers, evidence=orders)
+    return transaction, ledgers, orders
+
+
+def setup_create_transaction(n):
+    user = UserFactory()
+    ledgers = LedgerFactory.create_batch(n)
+    orders = OrderFactory.create_batch(n)
+    warm_reference_cache()
+    return lambda: create_transaction(
+        user,
+        evidence=orders,
+        ledger_entries=[(ledger, debit(AMOUNT)) for ledger in ledgers]
+        + [(ledger, credit(AMOUNT)) for ledger in ledgers],
+    )
+
+
+def setup_create_transactions(n):
+    user = UserFactory()
+    ledger = LedgerFactory()
+    orders = OrderFactory.create_batch(n)
+    warm_reference_cache()
+    return lambda: create_transactions([
+        dict(
+            user=user,
+            evidence=[order],
+            ledger_entries=[
+                (ledger, debit(AMOUNT)), (ledger, credit(AMOUNT))],
+        )
+        for order in orders
+    ])
+
+
+def setup_void_transaction(n):
+    transaction_id = wide_transaction(n)[0].id
+    user = UserFactory()
+    warm_reference_cache()
+    return lambda: void_transaction(
+        Transaction.objects.get(id=transaction_id), user)
+
+
+def setup_get_balances_for_object(n):
+    order = OrderFactory()
+    post(1, ledgers=LedgerFactory.create_batch(n), evidence=[order])
+    warm_reference_cache()
+    return lambda: get_balances_for_object(order)
+
+
+def setup_get_balances_for_objects(n):
+    orders = [transaction.related_objects.get().related_object
+              for transaction in post(n)]
+    warm_reference_cache()
+    return lambda: get_balances_for_objects(orders)
+
+
+def setup_get_transactions_by_idempotency_key(n):
+    keys = ['key-{}'.format(i) for i in range(n)]
+    post(n, idempotency_keys=keys)
+    warm_reference_cache()
+    return lambda: get_transactions_by_idempotency_key(keys)
+
+
+def setup_validate_transaction(n):
+    user = UserFactory()
+    ledgers = LedgerFactory.create_batch(n)
+    entries = [
+        LedgerEntry(ledger=ledger, amount=amount)
+        for ledger in ledgers
+        for amount in [debit(AMOUNT), credit(AMOUNT)]
+    ]
+    return lambda: validate_transaction(user, ledger_entries=entries)
+
+
+def setup_assert_transaction_in_ledgers_for_amounts_with_evidence(n):
+    transaction, ledgers, orders = wide_transaction(n)
+    warm_reference_cache()
+    return lambda: assert_transaction_in_ledgers_for_amounts_with_evidence(
+        ledger_amount_pairs=[
+            (ledger.name, amount)
+            for ledger in ledgers
+            for amount in [debit(AMOUNT), credit(AMOUNT)]
+        ],
+        evidence=orders,
+    )
+
+
+def setup_assert_transactions_exist(n):
+    transactions = post(n)
+    warm_reference_cache()
+    expectations = [
+        dict(
+            ledger_amount_pairs=[
+                (entry.ledger.name, entry.amount)
+                for entry in transaction.entries.all()
+            ],
+            evidence=[
+                tro.related_object
+                for tro in transaction.related_objects.all()
+            ],
+        )
+        for transaction in transactions
+    ]
+    return lambda: assert_transactions_exist(expectations)
+
+
+def setup_ledger_statement(n):
+    ledger = LedgerFactory()
+    post(n, ledgers=[ledger])
+    warm_reference_cache()
+    return lambda: list(ledger_statement(ledger))
+
+
+def setup_evidence_history(n):
+    order = OrderFactory()
+    post(n, evidence=[order])
+    warm_reference_cache()
+    return lambda: evidence_history(order, limit=n)
+
+
+def setup_filter_by_related_objects(match_type):
+    def setup(n):
+        orders = OrderFactory.create_batch(n)
+        post(2, evidence=orders)
+        post(1, evidence=orders[:1])
+        warm_reference_cache()
+        return lambda: list(
+            Transaction.objects.filter_by_related_objects(
+                orders, match_type=match_type)
+        )
+
+    return setup
+
+
+def setup_summaries(n):
+    post(n)
+    warm_reference_cache()
+    return lambda: Transaction.objects.summaries()
+
+
+CASES = {
+    'create_transaction': Case(setup_create_transaction, None),
+    # A savepoint and a write per posting, within the batch's own atomic
+    # block, after locking the Ledgers.
+    'create_transactions': Case(
+        setup_create_transactions, lambda n: 3 * n + 1),
+    'void_transaction': Case(setup_void_transaction, None),
+    'get_balances_for_object': Case(setup_get_balances_for_object, None),
+    'get_balances_for_objects': Case(setup_get_balances_for_objects, None),
+    'get_transactions_by_idempotency_key': Case(
+        setup_get_transactions_by_idempotency_key, None),
+    'validate_transaction': Case(setup_validate_transaction, None),
+    'assert_transaction_in_ledgers_for_amounts_with_evidence': Case(
+        setup_assert_transaction_in_ledgers_for_amounts_with_evidence, None),
+    'assert_transactions_exist': Case(setup_assert_transactions_exist, None),
+    'ledger_statement': Case(setup_ledger_statement, None),
+    'evidence_history': Case(setup_evidence_history, None),
+    'TransactionQuerySet.summaries': Case(setup_summaries, None),
+}
+CASES.update({
+    'TransactionQuerySet.filter_by_related_objects[{}]'.format(
+        match_type.name): Case(
+            setup_filter_by_related_objects(match_type), None)
+    for match_type in MatchType
+})
+
+
+@pytest.fixture(autouse=True)
+def reference_cache(transactional_db):
+    clear_reference_cache()
+    get_or_create_manual_transaction_type()
+    yield
+    clear_reference_cache()
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_query_counts(name):
+    case = CASES[name]
+    counts = {}
+    for n in SIZES:
+        run = case.setup(n)
+        with CaptureQueriesContext(connection) as captured:
+            run()
+        counts[n] = len(captured)
+
+    if case.expected is None:
+        assert len(set(counts.values())) == 1, (
+            "{} makes {} queries for inputs of sizes {}".format(
+                name, list(counts.values()), SIZES))
+    else:
+        assert counts == {n: case.expected(n) for n in SIZES}
+
+
+def test_every_function_is_guarded():
+    functions = {
+        name
+        for module in [actions, queries]
+        for name, function in inspect.getmembers(module, inspect.isfunction)
+        if function.__module__ == module.__name__
+        and not name.startswith('_')
+    }
+    assert functions <= set(CASES)
@@ -0,0 +1,209 @@
+from decimal import Decimal
+
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db.transaction import atomic
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.queries import assert_transaction_in_ledgers_for_amounts_with_evidence  # noqa: E501
+from capone.cache import clear_reference_cache
+from capone.cache import get_ledger
+from capone.cache import get_ledger_by_id
+from capone.cache import get_or_create_transaction_type
+from capone.cache import warm_reference_cache
+from capone.models import get_or_create_manual_transaction_type
+from capone.models import Ledger
+from capone.models import LedgerEntry
+from capone.models import TransactionType
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import TransactionTypeFactory
+from capone.tests.factories import UserFactory
+from capone.tests.models import Order
+
+
+"""
+Test the process-local cache of Ledgers and TransactionTypes.
+"""
+
+
+class Rollback(Exception):
+    pass
+
+
+@pytest.fixture
+def ledger():
+    clear_reference_cache()
+    yield LedgerFactory(name='Cash', number=1000)
+    clear_reference_cache()
+
+
+def test_get_ledger(ledger, transactional_db, django_assert_num_queries):
+    assert get_ledger(ledger) is ledger
+    # Reading a Ledger caches it under its id, name, and number.
+    with django_assert_num_queries(1):
+        assert get_ledger('Cash') == ledger
+        assert get_ledger(1000) == ledger
+        assert get_ledger_by_id(ledger.id) == ledger
+
+    with django_assert_num_queries(0):
+        assert get_ledger('Cash') == ledger
+        assert get_ledger(1000) == ledger
+        assert get_ledger_by_id(ledger.id) == ledger
+
+    # Each caller gets its own copy of a cached Ledger.
+    get_ledger('Cash').name = 'Changed'
+    assert get_ledger('Cash').name == 'Cash'
+    assert get_ledger(1000) is not get_ledger(1000)
+
+    with pytest.raises(Ledger.DoesNotExist):
+        get_ledger('Revenue')
+    with pytest.raises(Ledger.DoesNotExist):
+        get_ledger(1001)
+
+
+def test_uncommitted_reads_are_not_cached(
+        ledger, transactional_db, django_assert_num_queries):
+    with pytest.raises(Rollback):
+        with atomic():
+            other_ledger = LedgerFactory(name='Revenue')
+            assert get_ledger('Revenue') == other_ledger
+            assert get_ledger('Cash') == ledger
+            raise Rollback
+
+    with pytest.raises(Ledger.DoesNotExist):
+        get_ledger('Revenue')
+    with django_assert_num_queries(1):
+        assert get_ledger('Cash') == ledger
+
+
+def test_changes_invalidate_cache(
+        ledger, transactional_db, django_assert_num_queries):
+    get_ledger('Cash')
+    ledger.name = 'Cash (unreconciled)'
+    ledger.save()
+    with pytest.raises(Ledger.DoesNotExist):
+        get_ledger('Cash')
+
+    # The Ledger read before it was saved isn't cached on commit.
+    with atomic():
+        assert get_ledger(1000).name == 'Cash (unreconciled)'
+        ledger.name = 'Cash'
+        ledger.save()
+    with django_assert_num_queries(1):
+        assert get_ledger(1000).name == 'Cash'
+
+    ledger.delete()
+    with pytest.raises(Ledger.DoesNotExist):
+        get_ledger(1000)
+
+    get_or_create_transaction_type('Reconciliation').delete()
+    with django_assert_num_queries(2):
+        assert get_or_create_transaction_type('Reconciliation').id
+
+
+def test_flush_clears_cache(ledger, transactional_db):
+    get_ledger('Cash')
+    call_command('flush', interactive=False)
+    with pytest.raises(Ledger.DoesNotExist):
+        get_ledger('Cash')
+
+
+def test_warm_reference_cache(
+        ledger, transactional_db, django_assert_num_queries):
+    other_ledger = LedgerFactory()
+    ttype = TransactionTypeFactory()
+    ContentType.objects.clear_cache()
+
+    warm_reference_cache()
+
+    with django_assert_num_queries(0):
+        assert get_ledger('Cash') == ledger
+        assert get_ledger(other_ledger.number) == other_ledger
+        assert get_or_create_transaction_type(ttype.name) == ttype
+        ContentType.objects.get_for_model(Order)
+
+
+def test_get_or_create_transaction_type(
+        ledger, transactional_db, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        manual = get_or_create_manual_transaction_type()
+    assert manual == TransactionType.objects.get(name='Manual')
+
+    with django_assert_num_queries(0):
+        assert get_or_create_manual_transaction_type() == manual
+    get_or_create_manual_transaction_type().name = 'Changed'
+    assert get_or_create_manual_transaction_type().name == 'Manual'
+
+
+def test_create_transaction_with_ledger_references(
+        ledger, transactional_db):
+    revenue = LedgerFactory(name='Revenue', number=4000)
+    ar = LedgerFactory(name='A/R', number=1200)
+    order = OrderFactory()
+    create_transaction(
+        UserFactory(),
+        evidence=[order],
+        ledger_entries=[
+            ('Cash', debit(Decimal(100))),
+            (4000, credit(Decimal(150))),
+            (ar, debit(Decimal(50))),
+        ],
+    )
+
+    assert_transaction_in_ledgers_for_amounts_with_evidence(
+        ledger_amount_pairs=[
+            ('Cash', debit(Decimal(100))),
+            (revenue.name, credit(Decimal(150))),
+            ('A/R', debit(Decimal(50))),
+        ],
+        evidence=[order],
+    )
+    assert_transaction_in_ledgers_for_amounts_with_evidence(
+        ledger_amount_pairs=[
+            (1000, debit(Decimal(100))),
+            (revenue, credit(Decimal(150))),
+            (1200, debit(Decimal(50))),
+        ],
+        evidence=[order],
+    )
+    with pytest.raises(AssertionError):
+        assert_transaction_in_ledgers_for_amounts_with_evidence(
+            ledger_amount_pairs=[
+                (1000, debit(Decimal(100))),
+                (4000, credit(Decimal(100))),
+                (1200, debit(Decimal(50))),
+            ],
+            evidence=[order],
+        )
+
+    with pytest.raises(Ledger.DoesNotExist):
+        create_transaction(
+            UserFactory(),
+            ledger_entries=[
+                ('Cash', debit(Decimal(100))),
+                ('Expenses', credit(Decimal(100))),
+            ],
+        )
+
+
+def test_create_transaction_uses_cached_type(
+        ledger, transactional_db, django_assert_num_queries):
+    user = UserFactory()
+
+    def add_transaction():
+        return create_transaction(
+            user,
+            ledger_entries=[
+                LedgerEntry(ledger=ledger, amount=debit(Decimal(100))),
+                LedgerEntry(ledger=ledger, amount=credit(Decimal(100))),
+            ],
+        )
+
+    add_transaction()
+    with django_assert_num_queries(1):
+        transaction = add_transaction()
+    assert transaction.type.name == 'Manual'
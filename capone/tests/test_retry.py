@@ -0,0 +1,201 @@
+import threading
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.db import OperationalError
+from django.db.transaction import atomic
+
+from capone.api.actions import create_transaction
+from capone.api.actions import create_transactions
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.signals import posting_retried
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+
+
+"""
+Test that postings are retried when they conflict with other postings.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def create_objects(transactional_db, settings):
+    settings.CAPONE_POSTING_RETRIES = 2
+    settings.CAPONE_POSTING_RETRY_BACKOFF = 0.001
+    with connection.cursor() as cursor:
+        cursor.execute("SET lock_timeout = '50ms'")
+
+    user = UserFactory()
+    order = OrderFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+
+    def add_transaction():
+        return create_transaction(
+            user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(AMOUNT)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(AMOUNT)),
+            ],
+        )
+
+    yield user, ar_ledger, add_transaction, order
+
+    with connection.cursor() as cursor:
+        cursor.execute('RESET lock_timeout')
+
+
+class RowLock(threading.Thread):
+    """
+    Hold a lock on a row from another connection until `release`.
+    """
+    def __init__(self, obj):
+        super(RowLock, self).__init__()
+        self.obj = obj
+        self.acquired = threading.Event()
+        self._release = threading.Event()
+
+    def run(self):
+        try:
+            with atomic():
+                (
+                    type(self.obj).objects
+                    .select_for_update()
+                    .get(id=self.obj.id)
+                )
+                self.acquired.set()
+                self._release.wait()
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        self.acquired.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        self._release.set()
+        self.join()
+
+
+@pytest.fixture
+def retries():
+    retries = []
+
+    def receiver(**kwargs):
+        retries.append(kwargs)
+
+    posting_retried.connect(receiver)
+    yield retries
+    posting_retried.disconnect(receiver)
+
+
+def test_retry_after_lock_timeout(create_objects, retries):
+    user, ar_ledger, add_transaction, order = create_objects
+
+    with RowLock(ar_ledger) as lock:
+        # Release the lock while the posting waits to be retried.
+        posting_retried.connect(
+            lambda **kwargs: lock.release(), weak=False, dispatch_uid='lock')
+        try:
+            transaction = add_transaction()
+        finally:
+            posting_retried.disconnect(dispatch_uid='lock')
+
+    assert len(retries) == 1
+    assert retries[0]['attempt'] == 1
+    assert retries[0]['exception'].__cause__.pgcode == '55P03'
+    assert 0 <= retries[0]['delay'] <= 0.001
+    assert Transaction.objects.get() == transaction
+    assert ar_ledger.get_balance() == credit(AMOUNT)
+
+    with RowLock(ar_ledger) as lock:
+        posting_retried.connect(
+            lambda **kwargs: lock.release(), weak=False, dispatch_uid='lock')
+        try:
+            voiding_transaction = void_transaction(transaction, user)
+        finally:
+            posting_retried.disconnect(dispatch_uid='lock')
+
+    assert len(retries) == 2
+    assert voiding_transaction.voids == transaction
+    assert transaction.is_voided
+    assert Transaction.objects.get(is_void=True) == voiding_transaction
+    assert ar_ledger.get_balance() == Decimal(0)
+
+
+def test_retry_batch(create_objects, retries):
+    user, ar_ledger, add_transaction, order = create_objects
+    add_transaction()
+
+    # The LedgerBalance is locked while the Ledgers aren't, so the conflict
+    # happens in the savepoint of a posting in the batch.
+    with RowLock(LedgerBalance.objects.get(ledger=ar_ledger)) as lock:
+        posting_retried.connect(
+            lambda **kwargs: lock.release(), weak=False, dispatch_uid='lock')
+        try:
+            results = create_transactions([dict(
+                user=user,
+                evidence=[order],
+                ledger_entries=[
+                    (ar_ledger, credit(AMOUNT)),
+                    (ar_ledger, debit(AMOUNT)),
+                ],
+            )])
+        finally:
+            posting_retried.disconnect(dispatch_uid='lock')
+
+    assert len(retries) == 1
+    assert results[0].exception is None
+    assert Transaction.objects.count() == 2
+
+
+def test_retries_are_bounded(create_objects, retries):
+    user, ar_ledger, add_transaction, order = create_objects
+
+    with RowLock(ar_ledger):
+        with pytest.raises(OperationalError):
+            add_transaction()
+
+    assert [retry['attempt'] for retry in retries] == [1, 2]
+    assert not Transaction.objects.exists()
+
+
+def test_no_retry_in_callers_atomic_block(create_objects, retries):
+    user, ar_ledger, add_transaction, order = create_objects
+
+    with RowLock(ar_ledger):
+        with pytest.raises(OperationalError):
+            with atomic():
+                add_transaction()
+
+    assert retries == []
+    assert not Transaction.objects.exists()
+
+
+def test_other_errors_are_not_retried(create_objects, retries):
+    user, ar_ledger, add_transaction, order = create_objects
+    with connection.cursor() as cursor:
+        cursor.execute("SET statement_timeout = '10ms'")
+    try:
+        with pytest.raises(OperationalError):
+            with RowLock(ar_ledger):
+                add_transaction()
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('RESET statement_timeout')
+
+    assert retries == []
@@ -0,0 +1,145 @@
+from decimal import Decimal
+
+import pytest
+from django.core.cache import caches
+from django.db import connections
+from django.db.transaction import atomic
+from django.test.utils import CaptureQueriesContext
+
+from capone.api.actions import create_transaction
+from capone.api.actions import credit
+from capone.api.actions import debit
+from capone.api.actions import void_transaction
+from capone.api.queries import evidence_history
+from capone.api.queries import get_balances_for_object
+from capone.api.queries import ledger_statement
+from capone.cache import get_ledger
+from capone.cache import ledger_balance_cache_key
+from capone.models import Ledger
+from capone.models import LedgerEntry
+from capone.routers import CaponeReplicaRouter
+from capone.routers import use_primary
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import OrderFactory
+from capone.tests.factories import UserFactory
+from capone.tests.models import Order
+
+
+"""
+Test routing reads of `capone`'s models to read replicas.
+
+The `replica` database in the test settings is a second connection to the
+default database, so these tests check which connection each query uses.
+"""
+
+AMOUNT = Decimal(100)
+
+
+@pytest.fixture
+def replica(transactional_db, settings):
+    settings.CAPONE_REPLICA_DATABASES = ['replica']
+    return CaponeReplicaRouter()
+
+
+@pytest.fixture
+def routed(replica, settings):
+    settings.DATABASE_ROUTERS = ['capone.routers.CaponeReplicaRouter']
+    yield
+    connections['replica'].close()
+
+
+def test_db_for_read(replica, settings):
+    assert replica.db_for_read(LedgerEntry) == 'replica'
+    assert replica.db_for_read(Order) is None
+
+    with use_primary():
+        with use_primary():
+            assert replica.db_for_read(LedgerEntry) == 'default'
+        assert replica.db_for_read(LedgerEntry) == 'default'
+    assert replica.db_for_read(LedgerEntry) == 'replica'
+
+    with atomic():
+        assert replica.db_for_read(LedgerEntry) == 'default'
+
+    ledger = Ledger(name='Cash')
+    ledger._state.db = 'replica'
+    with atomic():
+        assert replica.db_for_read(LedgerEntry, instance=ledger) == 'replica'
+
+    settings.CAPONE_REPLICA_DATABASES = []
+    assert replica.db_for_read(LedgerEntry) == 'default'
+
+
+def test_db_for_write(replica):
+    assert replica.db_for_write(LedgerEntry) == 'default'
+    assert replica.db_for_write(Order) is None
+
+
+def test_allow_relation_and_migrate(replica):
+    ledger = Ledger(name='Cash')
+    ledger._state.db = 'replica'
+    entry = LedgerEntry(amount=AMOUNT)
+    entry._state.db = 'default'
+    assert replica.allow_relation(ledger, entry)
+    entry._state.db = 'other'
+    assert replica.allow_relation(ledger, entry) is None
+
+    assert replica.allow_migrate('replica', 'capone') is False
+    assert replica.allow_migrate('default', 'capone') is None
+    assert replica.allow_migrate('replica', 'tests') is None
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'replica'])
+def test_reads_use_replica(routed, settings):
+    settings.CAPONE_BALANCE_CACHE = 'default'
+    cache = caches['default']
+    cache.clear()
+
+    user = UserFactory()
+    order = OrderFactory()
+    ar_ledger = LedgerFactory()
+    cash_ledger = LedgerFactory()
+
+    # Postings only read and write the default database.
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        transaction = create_transaction(
+            user,
+            evidence=[order],
+            ledger_entries=[
+                LedgerEntry(ledger=ar_ledger, amount=credit(AMOUNT)),
+                LedgerEntry(ledger=cash_ledger, amount=debit(AMOUNT)),
+            ],
+        )
+        get_ledger(ar_ledger.name)
+    assert len(replica_queries) == 0
+
+    # Reads go to the replica, and what they read isn't cached.
+    with CaptureQueriesContext(connections['default']) as default_queries:
+        for _ in range(2):
+            assert ar_ledger.get_balance() == credit(AMOUNT)
+            assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+        assert [
+            line.amount for line in ledger_statement(ar_ledger, after=(
+                transaction.posted_timestamp, 0))
+        ] == [credit(AMOUNT)]
+        page = evidence_history(order)
+        assert page.items[0].transaction == transaction
+        assert len(page.items[0].entries) == 2
+    assert len(default_queries) == 0
+    assert page.items[0].entries[0]._state.db == 'replica'
+    assert cache.get(ledger_balance_cache_key(ar_ledger.id)) is None
+
+    # Reads of the primary can be forced, and are cached.
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        with use_primary():
+            assert ar_ledger.get_balance() == credit(AMOUNT)
+            assert get_balances_for_object(order)[ar_ledger] == credit(AMOUNT)
+        assert get_balances_for_object(
+            order, using='default')[ar_ledger] == credit(AMOUNT)
+        void_transaction(transaction, user)
+    assert len(replica_queries) == 0
+    assert cache.get(ledger_balance_cache_key(ar_ledger.id)) is None
+    assert ar_ledger.get_balance(using='default') == Decimal(0)
+    assert cache.get(ledger_balance_cache_key(ar_ledger.id))[1] == Decimal(0)
+
+    cache.clear()
@@ -0,0 +1,230 @@
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+import pytest
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Count
+from django.db.models import Sum
+from django.utils import timezone
+
+from capone.models import get_or_create_manual_transaction_type
+from capone.models import Ledger
+from capone.models import LedgerBalance
+from capone.models import LedgerEntry
+from capone.models import Transaction
+from capone.models import TransactionRelatedObject
+from capone.pgcopy import copy_line
+from capone.pgcopy import copy_rows
+from capone.synthetic import BACKDATED_DAYS
+from capone.synthetic import DEFAULT_END
+from capone.synthetic import generate_dataset
+from capone.synthetic import GeneratedCounts
+from capone.synthetic import synthetic_ledgers
+from capone.tests.factories import LedgerFactory
+from capone.tests.factories import UserFactory
+from capone.tests.models import Order
+from capone.utils import find_unbalanced_transactions
+from capone.utils import verify_ledger_balances
+
+
+"""
+Test generating synthetic datasets.
+"""
+
+
+def test_copy_line():
+    assert copy_line([
+        1, None, True, False, Decimal('-1.50'), 'a\tb\nc\\d\re',
+        datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+    ]) == (
+        '1\t\\N\tt\tf\t-1.50\ta\\tb\\nc\\\\d\\re\t'
+        '2020-01-02T03:04:05+00:00\n')
+
+
+def test_copy_rows():
+    ledger = LedgerFactory()
+    assert copy_rows('capone_ledger', ['name', 'number', 'description',
+                                       'increased_by_debits', 'created_at',
+                                       'modified_at'], [
+        ('Tab\tLedger', 9001, 'Back\\slash', False,
+         DEFAULT_END, DEFAULT_END),
+    ]) == 1
+    copied = Ledger.objects.exclude(id=ledger.id).get()
+    assert copied.name == 'Tab\tLedger'
+    assert copied.description == 'Back\\slash'
+    assert copied.increased_by_debits is False
+
+
+def test_synthetic_ledgers():
+    LedgerFactory(number=7)
+    first = synthetic_ledgers(2)
+    assert [ledger.name for ledger in first] == [
+        'Synthetic Ledger 0', 'Synthetic Ledger 1']
+    assert [ledger.number for ledger in first] == [8, 9]
+
+    assert synthetic_ledgers(3)[:2] == first
+    assert Ledger.objects.count() == 4
+
+
+def generate(transactions, **kwargs):
+    return generate_dataset(
+        transactions,
+        user=UserFactory(),
+        content_type=ContentType.objects.get_for_model(Order),
+        type=get_or_create_manual_transaction_type(),
+        **kwargs
+    )
+
+
+def snapshot():
+    """
+    Return the generated data, without the ids that depend on the database.
+    """
+    return [
+        (
+            transaction.transaction_id,
+            transaction.voids.transaction_id if transaction.voids else None,
+            transaction.is_void,
+            transaction.is_voided,
+            transaction.posted_timestamp,
+            transaction.created_at,
+            [
+                (entry.ledger.name, entry.entry_id, entry.amount)
+                for entry in transaction.entries.order_by('id')
+            ],
+            sorted(
+                tro.related_object_id
+                for tro in transaction.related_objects.all()
+            ),
+        )
+        for transaction in Transaction.objects.order_by('created_at', 'id')
+    ]
+
+
+def test_generate_dataset():
+    progress = []
+    counts = generate(
+        500,
+        ledgers=10,
+        evidence=50,
+        void_fraction=0.1,
+        backdated_fraction=0.2,
+        batch_size=200,
+        progress=progress.append,
+    )
+
+    assert counts == GeneratedCounts(
+        500,
+        LedgerEntry.objects.count(),
+        TransactionRelatedObject.objects.count(),
+    )
+    assert [p.transactions for p in progress] == [200, 400, 500]
+    assert progress[-1] == counts
+    assert Transaction.objects.count() == 500
+    assert verify_ledger_balances() == []
+    assert find_unbalanced_transactions() == []
+    assert LedgerBalance.objects.exists()
+
+    # Ledgers are skewed: the first is the most popular.
+    popularity = list(
+        LedgerEntry.objects.values('ledger__name')
+        .annotate(count=Count('id'))
+        .order_by('-count')
+        .values_list('ledger__name', flat=True)
+    )
+    assert popularity[0] == 'Synthetic Ledger 0'
+
+    # Some Transactions have more entries or evidence.
+    assert Transaction.objects.annotate(
+        entry_count=Count('entries')).filter(entry_count__gt=2).exists()
+    assert Transaction.objects.annotate(
+        evidence_count=Count('related_objects'),
+    ).filter(evidence_count__gt=1).exists()
+
+    # Each void reverses the Transaction it voids.
+    voids = Transaction.objects.filter(is_void=True)
+    assert voids.exists()
+    assert Transaction.objects.filter(is_voided=True).count() == (
+        voids.count())
+    for void in voids.select_related('voids'):
+        assert void.voids.is_voided
+        assert void.entries.aggregate(total=Sum('amount'))['total'] == 0
+        assert void.entries.get(
+            ledger=void.voids.entries.first().ledger,
+            amount=-void.voids.entries.first().amount)
+    assert Transaction.objects.non_void().count() == (
+        500 - 2 * voids.count())
+
+    # Some Transactions are backdated, all within the year before the end.
+    end = DEFAULT_END if settings.USE_TZ else timezone.make_naive(DEFAULT_END)
+    backdated = [
+        transaction
+        for transaction in Transaction.objects.all()
+        if transaction.posted_timestamp < transaction.created_at
+    ]
+    assert backdated
+    for transaction in backdated:
+        assert transaction.created_at - transaction.posted_timestamp <= (
+            timedelta(days=BACKDATED_DAYS))
+    assert Transaction.objects.filter(
+        created_at__gt=end).count() == 0
+    assert Transaction.objects.filter(
+        created_at__lt=end - timedelta(days=365)).count() == 0
+
+
+def test_generate_dataset_is_deterministic(transactional_db):
+    # Each rebuild truncates LedgerBalances, which Postgres only allows
+    # once the previous rebuild's foreign key checks are committed.
+    generate(100, void_fraction=0.2, batch_size=30)
+    first = snapshot()
+    Transaction.objects.all().delete()
+
+    generate(100, void_fraction=0.2, batch_size=30)
+    assert snapshot() == first
+
+    Transaction.objects.all().delete()
+    generate(100, seed=1, void_fraction=0.2)
+    assert snapshot() != first
+
+
+def test_generate_without_rebuild():
+    generate(10, rebuild=False)
+    assert not LedgerBalance.objects.exists()
+
+
+def test_command():
+    stdout = StringIO()
+    call_command(
+        'capone_generate_dataset', '30', '--batch-size', '20',
+        '--evidence-model', 'tests.Order', '--ledgers', '5',
+        stdout=stdout)
+
+    output = stdout.getvalue().splitlines()
+    assert output[0].startswith('Wrote 20 of 30 transaction(s)')
+    assert output[2].startswith('Generated 30 transaction(s)')
+    assert Ledger.objects.count() == 5
+    assert set(
+        TransactionRelatedObject.objects.values_list(
+            'related_object_content_type', flat=True)
+    ) == {ContentType.objects.get_for_model(Order).id}
+    assert Transaction.objects.values(
+        'created_by__username').distinct().get() == {
+            'created_by__username': 'capone-synthetic'}
+
+
+@pytest.mark.parametrize('arguments, message', [
+    (['--evidence-model', 'tests.Nope'], "doesn't have a 'Nope' model"),
+    (['--evidence-model', 'nope'],
+     '--evidence-model must be app_label.ModelName'),
+    (['--end', 'yesterday'], '--end must be a date and time'),
+    (['--max-entries', '1'], '--max-entries must be at least 2'),
+])
+def test_command_errors(arguments, message):
+    with pytest.raises(CommandError) as e:
+        call_command('capone_generate_dataset', '1', *arguments)
+    assert message in str(e.value)
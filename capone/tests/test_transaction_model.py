@@ -2,6 +2,7 @@
 from decimal import Decimal
 
 import pytest
+from django.db import IntegrityError
 from django.utils import timezone
 
 from capone.api.actions import create_transaction
@@ -81,6 +82,93 @@ def test_transaction_summary():
     }
 
 
+def test_transaction_summaries(django_assert_num_queries):
+    """
+    Test that TransactionQuerySet.summaries matches Transaction.summary.
+    """
+    ledger_1, ledger_2 = LedgerFactory.create_batch(2)
+    transactions = [
+        TransactionFactory(
+            evidence=[OrderFactory(), CreditCardTransactionFactory()],
+            ledger_entries=[
+                LedgerEntry(ledger=ledger_1, amount=credit(Decimal(n))),
+                LedgerEntry(ledger=ledger_2, amount=debit(Decimal(n))),
+            ],
+        )
+        for n in range(1, 6)
+    ]
+    TransactionFactory()
+
+    queryset = Transaction.objects.filter(
+        id__in=[transaction.id for transaction in transactions],
+    ).order_by('id')
+    with django_assert_num_queries(4):
+        summaries = queryset.summaries()
+
+    assert list(summaries) == transactions
+    for transaction, summary in summaries.items():
+        assert summary == transaction.summary()
+
+    with django_assert_num_queries(0):
+        assert Transaction.objects.none().summaries() == {}
+
+
+def test_with_entries_and_evidence(django_assert_num_queries):
+    """
+    Test prefetching entries and evidence with a constant number of queries.
+    """
+    ledger_1, ledger_2 = LedgerFactory.create_batch(2)
+    user = UserFactory()
+    expected = {}
+    for n in range(1, 6):
+        evidence = [
+            OrderFactory(),
+            OrderFactory(),
+            CreditCardTransactionFactory(),
+            UserFactory(),
+        ]
+        transaction = TransactionFactory(
+            user=user,
+            evidence=evidence,
+            ledger_entries=[
+                LedgerEntry(ledger=ledger_1, amount=credit(Decimal(n))),
+                LedgerEntry(ledger=ledger_2, amount=debit(Decimal(n))),
+            ],
+        )
+        expected[transaction] = (
+            {
+                (ledger_1.name, credit(Decimal(n))),
+                (ledger_2.name, debit(Decimal(n))),
+            },
+            set(evidence),
+        )
+
+    queryset = (
+        Transaction.objects
+        .filter(id__in=[transaction.id for transaction in expected])
+        .with_entries()
+        .with_evidence()
+    )
+    # Transactions, entries with Ledgers, TransactionRelatedObjects, and one
+    # query for each of the three evidence ContentTypes.
+    with django_assert_num_queries(6):
+        actual = {
+            transaction: (
+                {
+                    (entry.ledger.name, entry.amount)
+                    for entry in transaction.entries.all()
+                },
+                {
+                    tro.related_object
+                    for tro in transaction.related_objects.all()
+                },
+            )
+            for transaction in queryset
+        }
+
+    assert actual == expected
+
+
 def test_setting_explicit_timestamp_field():
     transaction = TransactionFactory()
     old_posted_timestamp = transaction.posted_timestamp
@@ -89,6 +177,42 @@ def test_setting_explicit_timestamp_field():
     assert old_posted_timestamp != transaction.posted_timestamp
 
 
+def test_saving_new_transaction():
+    """
+    Test that Transactions can still be created without the API functions.
+    """
+    transaction = Transaction(
+        created_by=UserFactory(),
+        posted_timestamp=timezone.now(),
+    )
+    transaction.save()
+    assert Transaction.objects.get(id=transaction.id).type.name == 'Manual'
+
+
+def test_saving_new_entries():
+    """
+    Test that entries saved without the API functions get a timestamp.
+    """
+    transaction = Transaction(
+        created_by=UserFactory(),
+        posted_timestamp=timezone.now(),
+    )
+    transaction.save()
+    ledger = LedgerFactory()
+    for amount in [credit(Decimal(1)), debit(Decimal(1))]:
+        LedgerEntry(
+            transaction=transaction, ledger=ledger, amount=amount,
+        ).save()
+
+    assert [
+        entry.posted_timestamp for entry in transaction.entries.all()
+    ] == [transaction.posted_timestamp] * 2
+
+    with pytest.raises(IntegrityError):
+        LedgerEntry.objects.filter(
+            transaction=transaction).update(posted_timestamp=None)
+
+
 def test_editing_transactions():
     """
     Test that validation is still done when editing a Transaction.
@@ -152,3 +276,34 @@ def test_non_void():
     assert not filtered_out_by_non_void(transaction_1)
     assert filtered_out_by_non_void(transaction_2)
     assert filtered_out_by_non_void(voiding_transaction)
+
+
+def test_saving_stale_voided_transaction():
+    """
+    Test that saving a stale instance of a voided Transaction keeps it void.
+    """
+    order = OrderFactory()
+    ar_ledger = LedgerFactory()
+    user = UserFactory()
+    transaction = create_transaction(
+        user,
+        evidence=[order],
+        ledger_entries=[
+            LedgerEntry(ledger=ar_ledger, amount=credit(Decimal(50))),
+            LedgerEntry(ledger=LedgerFactory(), amount=debit(Decimal(50))),
+        ],
+    )
+    stale = Transaction.objects.get(id=transaction.id)
+    voiding_transaction = void_transaction(transaction, user)
+
+    stale.notes = 'x'
+    stale.save()
+    stale.is_voided = False
+    stale.save(update_fields=['is_voided', 'notes'])
+
+    transaction.refresh_from_db()
+    assert transaction.notes == 'x'
+    assert transaction.is_voided
+    assert set(Transaction.objects.non_void()) == set()
+    assert voiding_transaction.is_void
+    assert ar_ledger.get_balance() == Decimal(0)
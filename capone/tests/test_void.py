@@ -1,18 +1,22 @@
 from decimal import Decimal as D
 
 import pytest
+from django.core.management import call_command
 from django.utils import timezone
 
 from capone.api.actions import create_transaction
 from capone.api.actions import credit
 from capone.api.actions import debit
 from capone.api.actions import void_transaction
+from capone.api.queries import get_balances_for_object
 from capone.exceptions import UnvoidableTransactionException
 from capone.models import LedgerEntry
+from capone.models import Transaction
 from capone.tests.factories import LedgerFactory
 from capone.tests.factories import TransactionFactory
 from capone.tests.factories import TransactionTypeFactory
 from capone.tests.factories import UserFactory
+from capone.utils import backfill_void_flags
 
 
 amount = D(100)
@@ -235,3 +239,163 @@ def test_given_timestamp(create_objects):
         charge_txn, creation_user,
         posted_timestamp=now)
     assert now == void_txn.posted_timestamp
+
+
+def test_void_flags(create_objects):
+    """
+    Test that voiding sets the denormalized `is_void` and `is_voided` flags.
+    """
+    (
+        creation_user,
+        ar_ledger,
+        rev_ledger,
+        creation_user_ar_ledger,
+        ttype,
+    ) = create_objects
+    txn = TransactionFactory(creation_user, ledger_entries=[
+        LedgerEntry(amount=debit(amount), ledger=ar_ledger),
+        LedgerEntry(amount=credit(amount), ledger=rev_ledger),
+    ])
+    assert not txn.is_void
+    assert not txn.is_voided
+
+    void_txn = void_transaction(txn, creation_user)
+    assert txn.is_voided
+    assert not txn.is_void
+    assert void_txn.is_void
+    assert not void_txn.is_voided
+
+    txn.refresh_from_db()
+    void_txn.refresh_from_db()
+    assert txn.is_voided
+    assert not txn.is_void
+    assert void_txn.is_void
+    assert not void_txn.is_voided
+
+
+def test_backfill_void_flags(create_objects):
+    """
+    Test recomputing void flags that have gotten out of sync.
+    """
+    (
+        creation_user,
+        ar_ledger,
+        rev_ledger,
+        creation_user_ar_ledger,
+        ttype,
+    ) = create_objects
+    txn = TransactionFactory(creation_user, ledger_entries=[
+        LedgerEntry(amount=debit(amount), ledger=ar_ledger),
+        LedgerEntry(amount=credit(amount), ledger=rev_ledger),
+    ])
+    void_txn = void_transaction(txn, creation_user)
+    other_txn = TransactionFactory(creation_user)
+
+    assert backfill_void_flags() == 0
+
+    Transaction.objects.update(is_void=False, is_voided=False)
+    Transaction.objects.filter(id=other_txn.id).update(is_voided=True)
+    assert set(Transaction.objects.non_void()) == {txn, void_txn}
+
+    assert backfill_void_flags() == 3
+    assert set(Transaction.objects.non_void()) == {other_txn}
+    assert set(Transaction.objects.filter(is_void=True)) == {void_txn}
+    assert set(Transaction.objects.filter(is_voided=True)) == {txn}
+
+
+def test_backfill_void_flags_command(create_objects, capsys):
+    """
+    Test the `capone_backfill_void_flags` management command.
+    """
+    (
+        creation_user,
+        ar_ledger,
+        rev_ledger,
+        creation_user_ar_ledger,
+        ttype,
+    ) = create_objects
+    txn = TransactionFactory(creation_user)
+    void_transaction(txn, creation_user)
+    Transaction.objects.update(is_void=False, is_voided=False)
+
+    call_command('capone_backfill_void_flags')
+
+    assert capsys.readouterr().out == (
+        "Updated void flags on 2 transaction(s).\n")
+    assert not Transaction.objects.non_void().exists()
+
+
+def test_void_prefetched_transaction(create_objects):
+    """
+    Test voiding Transactions whose evidence and entries were prefetched.
+    """
+    (
+        creation_user,
+        ar_ledger,
+        rev_ledger,
+        creation_user_ar_ledger,
+        ttype,
+    ) = create_objects
+    evidence = UserFactory.create_batch(3)
+    for _ in range(2):
+        TransactionFactory(creation_user, evidence=evidence, ledger_entries=[
+            LedgerEntry(amount=debit(amount), ledger=ar_ledger),
+            LedgerEntry(amount=credit(amount), ledger=rev_ledger),
+        ])
+
+    for transaction in Transaction.objects.with_entries().with_evidence():
+        voiding_transaction = void_transaction(transaction, creation_user)
+        assert voiding_transaction.voids == transaction
+        assert set(
+            tro.related_object
+            for tro in voiding_transaction.related_objects.all()
+        ) == set(evidence)
+
+    assert ar_ledger.get_balance() == D(0)
+    assert rev_ledger.get_balance() == D(0)
+
+
+def test_void_round_trips(create_objects, django_assert_num_queries):
+    """
+    Test that voiding reads the voided Transaction and writes in one go.
+    """
+    (
+        creation_user,
+        ar_ledger,
+        rev_ledger,
+        creation_user_ar_ledger,
+        ttype,
+    ) = create_objects
+    evidence = UserFactory.create_batch(3)
+    transaction = TransactionFactory(
+        creation_user,
+        evidence=evidence,
+        ledger_entries=[
+            LedgerEntry(amount=debit(amount), ledger=ar_ledger),
+            LedgerEntry(amount=credit(amount), ledger=rev_ledger),
+        ],
+        type=ttype,
+    )
+    transaction = Transaction.objects.get(id=transaction.id)
+
+    # The savepoint of `atomic`, `voided_by`, the entries, the evidence keys,
+    # the type, and the write.
+    with django_assert_num_queries(7):
+        voiding_transaction = void_transaction(transaction, creation_user)
+
+    assert transaction.is_voided
+    assert Transaction.objects.get(id=transaction.id).is_voided
+    voiding_transaction = Transaction.objects.get(id=voiding_transaction.id)
+    assert voiding_transaction.is_void
+    assert voiding_transaction.voids == transaction
+    assert voiding_transaction.type == ttype
+    assert set(
+        tro.related_object for tro in voiding_transaction.related_objects.all()
+    ) == set(evidence)
+    assert ar_ledger.get_balance() == D(0)
+    assert rev_ledger.get_balance() == D(0)
+    for user in evidence:
+        assert get_balances_for_object(user) == {
+            ar_ledger: D(0),
+            rev_ledger: D(0),
+        }
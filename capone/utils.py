@@ -1,5 +1,24 @@
+from collections import namedtuple
+
 from django.db import connection
 
+from capone.cache import clear_balance_cache
+from capone.cache import invalidate_balances_on_commit
+
+# The largest value of Postgres's `integer`, and so of any id.
+MAX_ID = 2 ** 31 - 1
+
+# Lock the ledgers to which we are posting to serialize postings to them.
+# Postings, imports, and repairs all lock Ledgers with this, in the same
+# order.
+LOCK_LEDGERS_SQL = '''\
+SELECT 1
+FROM capone_ledger
+WHERE id = ANY(%(ledger_ids)s)
+ORDER BY id  -- Avoid deadlocks.
+FOR UPDATE;
+'''
+
 REBUILD_LEDGER_BALANCES_SQL = '''\
 SELECT 1 FROM capone_ledger ORDER BY id FOR UPDATE;
 
@@ -22,12 +41,11 @@ SELECT
   current_timestamp
 FROM
   capone_ledgerentry
+-- Transactions without evidence have no LedgerBalances.
 INNER JOIN
-  capone_transaction
-    ON (capone_ledgerentry.transaction_id = capone_transaction.id)
-LEFT OUTER JOIN
   capone_transactionrelatedobject
-    ON (capone_transaction.id = capone_transactionrelatedobject.transaction_id)
+    ON (capone_ledgerentry.transaction_id
+        = capone_transactionrelatedobject.transaction_id)
 GROUP BY
   capone_ledgerentry.ledger_id,
   capone_transactionrelatedobject.related_object_content_type_id,
@@ -41,7 +59,304 @@ def rebuild_ledger_balances():
 
     This is only needed if the LedgerBalance entries get out of sync, for
     example after data migrations which change historical transactions.
+    It locks every Ledger until the database transaction ends;
+    `repair_ledger_balances` repairs a few Ledgers at a time.
     """
     cursor = connection.cursor()
     cursor.execute(REBUILD_LEDGER_BALANCES_SQL)
     cursor.close()
+    clear_balance_cache()
+
+
+BACKFILL_VOID_FLAGS_SQL = '''\
+UPDATE capone_transaction
+SET
+  is_void = flags.is_void,
+  is_voided = flags.is_voided
+FROM (
+  SELECT
+    capone_transaction.id,
+    capone_transaction.voids_id IS NOT NULL AS is_void,
+    voided_by.id IS NOT NULL AS is_voided
+  FROM
+    capone_transaction
+  LEFT OUTER JOIN
+    capone_transaction voided_by
+      ON (voided_by.voids_id = capone_transaction.id)
+) flags
+WHERE
+  capone_transaction.id = flags.id
+  AND (
+    capone_transaction.is_void != flags.is_void
+    OR capone_transaction.is_voided != flags.is_voided);
+'''
+
+
+def backfill_void_flags():
+    """
+    Recompute the denormalized `is_void` and `is_voided` Transaction flags.
+
+    `void_transaction` keeps these flags up to date, so this is only needed
+    if they get out of sync, for example after data migrations which set
+    `Transaction.voids` directly.  Returns the number of Transactions whose
+    flags were changed.
+    """
+    cursor = connection.cursor()
+    cursor.execute(BACKFILL_VOID_FLAGS_SQL)
+    count = cursor.rowcount
+    cursor.close()
+    return count
+
+
+VERIFY_LEDGER_BALANCES_SQL = '''\
+SELECT
+  COALESCE(expected.ledger_id, recorded.ledger_id),
+  COALESCE(
+    expected.related_object_content_type_id,
+    recorded.related_object_content_type_id),
+  COALESCE(expected.related_object_id, recorded.related_object_id),
+  COALESCE(recorded.balance, 0),
+  COALESCE(expected.balance, 0)
+FROM (
+  SELECT
+    capone_ledgerentry.ledger_id,
+    capone_transactionrelatedobject.related_object_content_type_id,
+    capone_transactionrelatedobject.related_object_id,
+    SUM(capone_ledgerentry.amount) AS balance
+  FROM
+    capone_ledgerentry
+  INNER JOIN
+    capone_transactionrelatedobject
+      ON (capone_ledgerentry.transaction_id
+          = capone_transactionrelatedobject.transaction_id)
+  WHERE
+    %(ledger_ids)s::integer[] IS NULL
+    OR capone_ledgerentry.ledger_id = ANY(%(ledger_ids)s)
+  GROUP BY
+    capone_ledgerentry.ledger_id,
+    capone_transactionrelatedobject.related_object_content_type_id,
+    capone_transactionrelatedobject.related_object_id
+) expected
+FULL OUTER JOIN (
+  SELECT *
+  FROM
+    capone_ledgerbalance
+  WHERE
+    %(ledger_ids)s::integer[] IS NULL
+    OR capone_ledgerbalance.ledger_id = ANY(%(ledger_ids)s)
+) recorded
+  ON (expected.ledger_id = recorded.ledger_id
+      AND expected.related_object_content_type_id
+        = recorded.related_object_content_type_id
+      AND expected.related_object_id = recorded.related_object_id)
+WHERE
+  COALESCE(recorded.balance, 0) != COALESCE(expected.balance, 0)
+ORDER BY
+  1, 2, 3
+'''
+
+
+LedgerBalanceDrift = namedtuple('LedgerBalanceDrift', [
+    'ledger_id',
+    'related_object_content_type_id',
+    'related_object_id',
+    'recorded',
+    'actual',
+])
+
+
+def verify_ledger_balances(ledger_ids=None):
+    """
+    Return a `LedgerBalanceDrift` for each LedgerBalance that is wrong.
+
+    `recorded` is the balance in the LedgerBalance, or 0 if there is none,
+    and `actual` is the sum of the LedgerEntries in its Ledger of the
+    Transactions with its evidence.  Only the LedgerBalances of the Ledgers
+    with ids in `ledger_ids` are checked, if it is given.  The list is empty
+    if all LedgerBalances are right.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(VERIFY_LEDGER_BALANCES_SQL, {
+            'ledger_ids': None if ledger_ids is None else list(ledger_ids),
+        })
+        return [LedgerBalanceDrift(*row) for row in cursor.fetchall()]
+
+
+REPAIR_LEDGER_BALANCES_SQL = '''\
+INSERT INTO
+  capone_ledgerbalance (
+    ledger_id,
+    related_object_content_type_id,
+    related_object_id,
+    balance,
+    created_at,
+    modified_at)
+SELECT
+  drift.ledger_id,
+  drift.content_type_id,
+  drift.object_id,
+  drift.balance,
+  current_timestamp,
+  current_timestamp
+FROM
+  unnest(
+    %(ledger_ids)s::integer[],
+    %(content_type_ids)s::integer[],
+    %(object_ids)s::integer[],
+    %(balances)s::numeric[]
+  ) AS drift (ledger_id, content_type_id, object_id, balance)
+ON CONFLICT (ledger_id, related_object_content_type_id, related_object_id)
+DO UPDATE SET
+  balance = EXCLUDED.balance,
+  modified_at = EXCLUDED.modified_at
+'''
+
+
+def repair_ledger_balances(ledger_ids, dry_run=False):
+    """
+    Correct the LedgerBalances of the Ledgers with ids in `ledger_ids`.
+
+    The Ledgers are locked, as by a posting, until the database transaction
+    ends, so call this in an atomic block and repair a few Ledgers at a
+    time to leave the others free for postings.  Returns the
+    `LedgerBalanceDrift`s that were corrected, or that would have been if
+    `dry_run` is true, in which case nothing is locked or written.
+    """
+    ledger_ids = list(ledger_ids)
+    if dry_run:
+        return verify_ledger_balances(ledger_ids)
+
+    with connection.cursor() as cursor:
+        cursor.execute(LOCK_LEDGERS_SQL, {'ledger_ids': ledger_ids})
+        drift = verify_ledger_balances(ledger_ids)
+        if drift:
+            cursor.execute(REPAIR_LEDGER_BALANCES_SQL, {
+                'ledger_ids': [row.ledger_id for row in drift],
+                'content_type_ids': [
+                    row.related_object_content_type_id for row in drift],
+                'object_ids': [row.related_object_id for row in drift],
+                'balances': [row.actual for row in drift],
+            })
+            invalidate_balances_on_commit(
+                {row.ledger_id for row in drift},
+                {
+                    (row.related_object_content_type_id,
+                     row.related_object_id)
+                    for row in drift
+                },
+            )
+    return drift
+
+
+FIND_UNBALANCED_TRANSACTIONS_SQL = '''\
+SELECT
+  transaction_id,
+  SUM(amount)
+FROM
+  capone_ledgerentry
+WHERE
+  transaction_id BETWEEN %(first_id)s AND %(last_id)s
+GROUP BY
+  transaction_id
+HAVING
+  SUM(amount) != 0
+ORDER BY
+  transaction_id
+'''
+
+
+def find_unbalanced_transactions(first_id=0, last_id=MAX_ID):
+    """
+    Return `(transaction_id, total)` for each Transaction that doesn't balance.
+
+    Only Transactions with ids from `first_id` to `last_id` are checked.
+    `create_transaction` never writes such Transactions, so the list is
+    empty unless the tables were changed by other means.  If it is empty,
+    the balances of all Ledgers add up to zero.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(FIND_UNBALANCED_TRANSACTIONS_SQL, {
+            'first_id': first_id, 'last_id': last_id})
+        return cursor.fetchall()
+
+
+FIND_WRONG_VOID_FLAGS_SQL = '''\
+SELECT
+  capone_transaction.id
+FROM
+  capone_transaction
+LEFT OUTER JOIN
+  capone_transaction voided_by
+    ON (voided_by.voids_id = capone_transaction.id)
+WHERE
+  capone_transaction.id BETWEEN %(first_id)s AND %(last_id)s
+  AND (
+    capone_transaction.is_void != (capone_transaction.voids_id IS NOT NULL)
+    OR capone_transaction.is_voided != (voided_by.id IS NOT NULL))
+ORDER BY
+  capone_transaction.id
+'''
+
+
+def find_wrong_void_flags(first_id=0, last_id=MAX_ID):
+    """
+    Return the ids of the Transactions whose void flags are wrong.
+
+    Only Transactions with ids from `first_id` to `last_id` are checked.
+    `backfill_void_flags` corrects them.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(FIND_WRONG_VOID_FLAGS_SQL, {
+            'first_id': first_id, 'last_id': last_id})
+        return [row[0] for row in cursor.fetchall()]
+
+
+FIND_UNSYNCED_ENTRY_TIMESTAMPS_SQL = '''\
+SELECT
+  capone_ledgerentry.id
+FROM
+  capone_ledgerentry
+INNER JOIN
+  capone_transaction
+    ON (capone_ledgerentry.transaction_id = capone_transaction.id)
+WHERE
+  capone_ledgerentry.transaction_id BETWEEN %(first_id)s AND %(last_id)s
+  AND capone_ledgerentry.posted_timestamp
+    IS DISTINCT FROM capone_transaction.posted_timestamp
+ORDER BY
+  capone_ledgerentry.id
+'''
+
+
+def find_unsynced_entry_timestamps(first_id=0, last_id=MAX_ID):
+    """
+    Return the ids of the LedgerEntries with the wrong `posted_timestamp`.
+
+    Only the entries of Transactions with ids from `first_id` to `last_id`
+    are checked.  An entry's `posted_timestamp` should be its Transaction's.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(FIND_UNSYNCED_ENTRY_TIMESTAMPS_SQL, {
+            'first_id': first_id, 'last_id': last_id})
+        return [row[0] for row in cursor.fetchall()]
+
+
+SET_TIMEOUTS_SQL = '''\
+SELECT
+  set_config('statement_timeout', %(statement_timeout)s, true),
+  set_config('lock_timeout', %(lock_timeout)s, true)
+'''
+
+
+def set_local_timeouts(statement_timeout='0', lock_timeout='0'):
+    """
+    Limit statements and lock waits until the database transaction ends.
+
+    The timeouts are Postgres durations, such as `'30s'`; `'0'` is no limit.
+    A statement that exceeds them raises `OperationalError`.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SET_TIMEOUTS_SQL, {
+            'statement_timeout': str(statement_timeout),
+            'lock_timeout': str(lock_timeout),
+        })
@@ -1,6 +1,12 @@
+import django
 import pytest
 
 
+# `capone.api.aio` needs asgiref, which comes with Django 3.0 and later.
+collect_ignore = (
+    ['capone/tests/test_aio.py'] if django.VERSION < (3, 0) else [])
+
+
 @pytest.fixture(autouse=True)
 def enable_db_access_for_all_tests(db):
     """